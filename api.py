@@ -0,0 +1,485 @@
+import asyncio
+import io
+import ipaddress
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from PIL import Image, UnidentifiedImageError
+
+import backends
+import metrics
+import output_store
+import pipeline
+import warm_keeper
+from http_clients import close_clients, get_client
+from scheduler import BATCH, INTERACTIVE, SchedulerFull, priority
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#API HTTP/JSON DEL PIPELINE (SIN GRADIO)
+#########################################################
+
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "7870"))
+# When set, requests must send "Authorization: Bearer <key>" or "X-API-Key: <key>"
+API_KEY = os.getenv("API_KEY")
+# Base of the result URLs handed to clients (e.g. behind a proxy); defaults to the URL the request came in on
+API_PUBLIC_URL = os.getenv("API_PUBLIC_URL", "").rstrip("/")
+API_BACKEND = os.getenv("PULID_BACKEND", "replicate")
+# Finished jobs are forgotten after this many seconds (their images stay in the output store)
+API_JOB_TTL = float(os.getenv("API_JOB_TTL", "3600"))
+API_MAX_FACE_BYTES = int(os.getenv("API_MAX_FACE_BYTES", str(20 * 1024 * 1024)))
+# Hosts face_url may point at, comma separated ("cdn.example.com", or ".example.com" for its subdomains too).
+# Unset, any host resolving only to public addresses is allowed; listed hosts are trusted even on private networks.
+API_FACE_URL_HOSTS = [host.strip().lower() for host in os.getenv("API_FACE_URL_HOSTS", "").split(",") if host.strip()]
+FACE_URL_MAX_REDIRECTS = 3
+SSE_HEARTBEAT = 15
+
+# Same ranges as the Gradio sliders
+LIMITS = {"width": (256, 1536), "height": (256, 1536), "num_steps": (1, 20), "max_sequence_length": (128, 512),
+          "id_weight": (0, 3), "start_step": (0, 10), "guidance_scale": (1, 10), "true_cfg": (1, 10),
+          "timestep_to_start_cfg": (0, 20), "quality": (1, 100), "face_refinement_steps": (0, 5),
+          "num_candidates": (1, 4)}
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+class Job:
+    """One submitted generation; results are written to the output store as they arrive."""
+
+    def __init__(self, face_image, params, quality, face_refinement_steps, num_candidates, backend, strategy,
+                 adaptive, level, user):
+        self.id = uuid.uuid4().hex
+        self.face_image = face_image
+        self.params = params
+        self.quality = quality
+        self.face_refinement_steps = face_refinement_steps
+        self.num_candidates = num_candidates
+        self.backend = backend
+        self.strategy = strategy
+        self.adaptive = adaptive
+        self.level = level
+        self.user = user
+        with priority(level):
+            self.estimate = backends.estimate(backend, params, face_refinement_steps)
+        self.stage = None  # last finished stage, for the ETA
+        self.stage_at = time.monotonic()
+        self.status = "queued"
+        self.message = "Queued"
+        self.error = None
+        self.trace_id = None
+        self.candidates = {}  # index -> {"stage", "generated", "refined", "thumbnail"}, paths in the output store
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+        self._updated = asyncio.Event()
+
+    def update(self, status=None, message=None):
+        if status is not None:
+            self.status = status
+        if message is not None:
+            self.message = message
+        if self.status in TERMINAL_STATUSES and self.finished_at is None:
+            self.finished_at = time.time()
+        # Wake every subscriber, then start a fresh event for the next change
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def to_dict(self, base_url):
+        def url(path):
+            return output_store.url_for(path, f"{base_url}/v1/files")
+
+        candidates = [
+            {"index": index, "stage": candidate["stage"], "generated": url(candidate["generated"]),
+             "refined": url(candidate["refined"] or candidate["generated"]), "thumbnail": url(candidate["thumbnail"])}
+            for index, candidate in sorted(self.candidates.items())
+        ]
+        return {
+            "id": self.id,
+            "status": self.status,
+            "message": self.message,
+            "error": self.error,
+            "trace_id": self.trace_id,
+            "backend": self.backend,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "eta_seconds": None if self.status in TERMINAL_STATUSES else round(
+                self.estimate.remaining(self.stage, time.monotonic() - self.stage_at), 1
+            ),
+            "generated": candidates[0]["generated"] if candidates else None,
+            "refined": candidates[0]["refined"] if candidates else None,
+            "candidates": candidates,
+        }
+
+
+jobs = {}
+
+
+async def run_job(job):
+    with priority(job.level):
+        job.trace_id = metrics.new_trace()
+        job.stage_at = time.monotonic()
+        job.update("running", "Generating image")
+        start_time = time.monotonic()
+        finals = {}
+        try:
+            async for index, stage, image in pipeline.process_stream(
+                job.face_image, job.params, job.quality, job.face_refinement_steps, job.num_candidates,
+                job.backend, job.strategy, adaptive=job.adaptive,
+            ):
+                # Stored as the bytes the upstream returned, no re-encoding
+                stored = await output_store.put_async(image)
+                finals[index] = image
+                candidate = job.candidates.setdefault(
+                    index, {"stage": stage, "generated": None, "refined": None, "thumbnail": None}
+                )
+                candidate["stage"] = stage
+                candidate["generated" if stage == "generation" else "refined"] = stored.path
+                job.stage, job.stage_at = stage, time.monotonic()
+                status = pipeline.describe_stage(stage, job.face_refinement_steps)
+                if job.num_candidates > 1:
+                    status = f"Candidate {index + 1}: {status}"
+                job.update(message=status)
+            generated = {index: candidate["generated"] for index, candidate in job.candidates.items()}
+            outputs = await pipeline.store_finals(finals, generated, job.backend)
+            for index, output in outputs.items():
+                job.candidates[index]["thumbnail"] = output["thumbnail"]
+            if job.user and outputs:
+                await pipeline.remember(job.user, outputs, job.params, job.backend)
+        except asyncio.CancelledError:
+            job.update("canceled", "Canceled")
+            raise
+        except Exception as e:
+            logger.error(f"API job {job.id} failed: {e}")
+            job.error = str(e)
+        finally:
+            job.face_image = None  # the face is only needed while the job runs
+
+        if job.error or not job.candidates:
+            job.update("failed", "Generation failed")
+        else:
+            job.update("succeeded", f"Done in {time.monotonic() - start_time:.1f}s")
+        logger.info(f"API job {job.id} {job.status} in {time.monotonic() - start_time:.1f}s")
+
+
+def prune_jobs():
+    cutoff = time.time() - API_JOB_TTL
+    for job_id, job in list(jobs.items()):
+        if job.finished_at is not None and job.finished_at < cutoff:
+            del jobs[job_id]
+
+
+def coerce(key, value):
+    """Form values arrive as strings; convert them to the type of the pipeline default."""
+    if key == "seed":
+        return pipeline.parse_seed(value)
+    default = pipeline.DEFAULT_PARAMS.get(key)
+    if isinstance(default, str):
+        if not isinstance(value, str):
+            raise HTTPException(422, f"{key} must be a string")
+        return value
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise HTTPException(422, f"{key} must be a number")
+    if value.is_integer():
+        value = int(value)
+    if key in LIMITS and not LIMITS[key][0] <= value <= LIMITS[key][1]:
+        raise HTTPException(422, f"{key} must be between {LIMITS[key][0]} and {LIMITS[key][1]}")
+    return value
+
+
+def parse_options(fields):
+    params = {}
+    for key, value in fields.items():
+        if key in pipeline.DEFAULT_PARAMS:
+            params[key] = coerce(key, value)
+        elif key not in ("face", "face_url", "quality", "face_refinement_steps", "num_candidates", "backend",
+                         "strategy", "adaptive_refinement", "priority", "user"):
+            raise HTTPException(422, f"Unknown field {key!r}")
+
+    options = {
+        "params": params,
+        "quality": int(coerce("quality", fields.get("quality", 100))),
+        "face_refinement_steps": int(coerce("face_refinement_steps", fields.get("face_refinement_steps", 1))),
+        "num_candidates": int(coerce("num_candidates", fields.get("num_candidates", 1))),
+        "backend": fields.get("backend", API_BACKEND),
+        "strategy": fields.get("strategy", "num_outputs"),
+        "adaptive": None,
+        "level": BATCH if fields.get("priority") == "batch" else INTERACTIVE,
+        "user": str(fields["user"]) if fields.get("user") else None,
+    }
+    if options["backend"] not in backends.BACKEND_NAMES:
+        raise HTTPException(422, f"backend must be one of {', '.join(backends.BACKEND_NAMES)}")
+    if options["strategy"] not in ("num_outputs", "seeds"):
+        raise HTTPException(422, "strategy must be num_outputs or seeds")
+    if "adaptive_refinement" in fields:
+        options["adaptive"] = str(fields["adaptive_refinement"]).lower() in ("1", "true", "yes", "on")
+    return options
+
+
+def decode_face(data):
+    if len(data) > API_MAX_FACE_BYTES:
+        raise HTTPException(413, f"Face image is larger than {API_MAX_FACE_BYTES} bytes")
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.convert("RGB")
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(422, "face is not a readable image")
+
+
+def _host_allowed(host):
+    return any(host == allowed or (allowed.startswith(".") and host.endswith(allowed)) for allowed in API_FACE_URL_HOSTS)
+
+
+async def check_face_url(url):
+    """
+    Refuse face_url targets the server must not be made to fetch (SSRF): anything but http(s), hosts outside
+    API_FACE_URL_HOSTS when it is set, and otherwise hosts resolving to a loopback, private, link-local or any
+    other non-public address (the metrics endpoint, cloud metadata, the LAN).
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise HTTPException(422, "face_url must be an http(s) URL")
+    host = parts.hostname.lower()
+    if API_FACE_URL_HOSTS:
+        if not _host_allowed(host):
+            raise HTTPException(422, "face_url host is not allowed")
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, ValueError):
+        raise HTTPException(422, "face_url host does not resolve")
+    for *_, sockaddr in addresses:
+        if not is_public(sockaddr[0]):
+            raise HTTPException(422, "face_url must point at a public address")
+
+
+def is_public(host):
+    address = ipaddress.ip_address(host.split("%")[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global
+
+
+def check_peer(response):
+    """
+    Refuse a face_url response unless it came from a public address. The client resolves the host again when
+    it connects, so a DNS answer changed after check_face_url (DNS rebinding) is caught here, before the body.
+    """
+    if API_FACE_URL_HOSTS:
+        return
+    stream = response.extensions.get("network_stream")
+    peer = stream.get_extra_info("server_addr") if stream is not None else None
+    if not peer or not is_public(peer[0]):
+        raise HTTPException(422, "face_url must point at a public address")
+
+
+async def fetch_face(url):
+    # Redirects are followed by hand so every hop is checked, not just the URL the client sent
+    try:
+        for _ in range(FACE_URL_MAX_REDIRECTS + 1):
+            await check_face_url(url)
+            async with get_client("faces").stream("GET", url, follow_redirects=False) as response:
+                check_peer(response)
+                if response.is_redirect:
+                    url = str(response.url.join(response.headers["location"]))
+                    continue
+                if response.status_code != 200:
+                    raise HTTPException(422, f"face_url returned HTTP {response.status_code}")
+                data = bytearray()
+                async for chunk in response.aiter_bytes():
+                    data += chunk
+                    if len(data) > API_MAX_FACE_BYTES:
+                        raise HTTPException(413, f"Face image is larger than {API_MAX_FACE_BYTES} bytes")
+                return bytes(data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(422, f"Could not download face_url: {e}")
+    raise HTTPException(422, f"face_url redirected more than {FACE_URL_MAX_REDIRECTS} times")
+
+
+def check_key(request):
+    if not API_KEY:
+        return
+    authorization = request.headers.get("authorization", "")
+    key = authorization[7:] if authorization.lower().startswith("bearer ") else request.headers.get("x-api-key")
+    if key != API_KEY:
+        raise HTTPException(401, "Invalid API key")
+
+
+def base_url(request):
+    return API_PUBLIC_URL or str(request.base_url).rstrip("/")
+
+
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return job
+
+#########################################################
+#RUTAS
+#########################################################
+
+@asynccontextmanager
+async def lifespan(app):
+    os.makedirs(output_store.OUTPUT_DIR, exist_ok=True)
+    warm_keeper.start()
+    yield
+    for job in list(jobs.values()):
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+    await close_clients()
+
+
+app = FastAPI(title="PuLID-FLUX + StoryFace API", lifespan=lifespan, docs_url="/v1/docs",
+              openapi_url="/v1/openapi.json", redoc_url=None)
+# Fallback for when nginx does not serve the output store itself (OUTPUT_PUBLIC_URL unset)
+app.mount("/v1/files", StaticFiles(directory=output_store.OUTPUT_DIR, check_dir=False), name="files")
+
+
+@app.post("/v1/jobs", status_code=202)
+async def submit(request: Request):
+    """
+    Start a job. Send multipart/form-data with a `face` file, or JSON / form fields with `face_url`, plus any
+    pipeline.DEFAULT_PARAMS key, quality, face_refinement_steps, num_candidates, backend, strategy,
+    adaptive_refinement, priority ("interactive" or "batch") and user (whose history the results go to).
+    """
+    check_key(request)
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            fields = await request.json()
+        except ValueError:
+            raise HTTPException(422, "Body is not valid JSON")
+        if not isinstance(fields, dict):
+            raise HTTPException(422, "Body must be a JSON object")
+        upload = None
+    else:
+        form = await request.form()
+        upload = form.get("face")
+        fields = {key: value for key, value in form.items() if key != "face"}
+
+    options = parse_options(fields)
+    warm_keeper.prewarm(options["backend"])  # wakes the upstreams while the face is read and decoded
+    with priority(options["level"]):
+        try:
+            estimated_wait = backends.check_admission(options["backend"])
+        except SchedulerFull as e:
+            return JSONResponse({"detail": str(e)}, status_code=503,
+                                headers={"Retry-After": str(max(1, round(e.estimated_wait)))})
+
+    if upload is not None and not isinstance(upload, str):
+        data = await upload.read()
+    elif fields.get("face_url"):
+        data = await fetch_face(str(fields["face_url"]))
+    else:
+        raise HTTPException(422, "Send a face file or a face_url")
+    face_image = await asyncio.to_thread(decode_face, data)
+
+    prune_jobs()
+    job = Job(face_image, **options)
+    jobs[job.id] = job
+    job.task = asyncio.create_task(run_job(job))
+    logger.info(f"API job {job.id} submitted on {job.backend}, estimated wait {estimated_wait:.0f}s, "
+                f"about {job.estimate.total:.0f}s in total")
+
+    body = job.to_dict(base_url(request))
+    body["estimated_wait"] = estimated_wait
+    body["status_url"] = f"{base_url(request)}/v1/jobs/{job.id}"
+    body["events_url"] = f"{body['status_url']}/events"
+    return JSONResponse(body, status_code=202, headers={"Location": body["status_url"]})
+
+
+@app.get("/v1/jobs/{job_id}")
+async def status(job_id: str, request: Request):
+    check_key(request)
+    return get_job(job_id).to_dict(base_url(request))
+
+
+@app.delete("/v1/jobs/{job_id}")
+async def cancel(job_id: str, request: Request):
+    check_key(request)
+    job = get_job(job_id)
+    if job.task is not None and not job.task.done():
+        job.task.cancel()
+        try:
+            await job.task
+        except asyncio.CancelledError:
+            pass
+    return job.to_dict(base_url(request))
+
+
+@app.get("/v1/jobs/{job_id}/events")
+async def events(job_id: str, request: Request):
+    """Server-sent events: an "update" with the job every time a stage finishes, then "complete"."""
+    check_key(request)
+    job = get_job(job_id)
+    url = base_url(request)
+
+    async def stream():
+        while True:
+            # Grab the event before reading the state, so a change in between is not missed
+            updated = job._updated
+            data = json.dumps(job.to_dict(url))
+            if job.status in TERMINAL_STATUSES:
+                yield f"event: complete\ndata: {data}\n\n"
+                return
+            yield f"event: update\ndata: {data}\n\n"
+            while not updated.is_set():
+                if await request.is_disconnected():
+                    return
+                try:
+                    await asyncio.wait_for(updated.wait(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/v1/history")
+async def user_history(user: str, request: Request, limit: int = output_store.HISTORY_LIMIT):
+    """`user`'s latest generations, newest first, with image and thumbnail URLs."""
+    check_key(request)
+    files_url = f"{base_url(request)}/v1/files"
+    entries = await asyncio.to_thread(output_store.history, user, min(limit, output_store.HISTORY_LIMIT))
+    for entry in entries:
+        entry["outputs"] = [
+            {name: output_store.url_for(path, files_url) for name, path in output.items()}
+            for output in entry["outputs"]
+        ]
+    return {"user": user, "entries": entries}
+
+
+@app.get("/v1/health")
+async def health():
+    return {"ok": True, "jobs": sum(job.status in ("queued", "running") for job in jobs.values()),
+            "backends": warm_keeper.status()}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - [%(trace_id)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        handlers=[logging.StreamHandler()]
+    )
+    metrics.install_trace_logging()
+    metrics.start_metrics_server()
+    uvicorn.run(app, host=API_HOST, port=API_PORT)
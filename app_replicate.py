@@ -1,166 +1,56 @@
 import gradio as gr
-import replicate
-import requests
-from PIL import Image
-import io
-import os
 import logging
+import os
 from dotenv import load_dotenv
-import uuid
+
+import frontend
+import metrics
+import pipeline
 
 load_dotenv()
 
+# "replicate" (default), "hf", "stub" or "auto" to route between backends by latency
+BACKEND = os.getenv("PULID_BACKEND", "replicate")
+
 # Set up logging
 logging.basicConfig(
-    filename='system_usage.log',
     level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    format='%(asctime)s - [%(trace_id)s] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    handlers=[logging.StreamHandler()]
 )
+metrics.install_trace_logging()
 logger = logging.getLogger(__name__)
 
 #########################################################
-#LLAMADA A FLUX PULL-ID EN REPLICATE
+#HANDLER DE LA UI (EL PIPELINE ESTA EN pipeline.py)
 #########################################################
 
-def generate_image_pulid_flux(prompt, id_image, width, height, num_steps, neg_prompt, max_sequence_length,
-                            id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg):
-    # Create a unique temporary file name
-    import uuid
-    temp_image_path = f"temp_image_{uuid.uuid4()}.png"
+async def process_all(face_image, prompt, width, height, num_steps, neg_prompt, max_sequence_length, quality,
+                      id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg, face_refinement_steps,
+                      num_candidates=1, candidate_mode="num_outputs", adaptive_refinement=False,
+                      session=None, request: gr.Request = None):
+    metrics.new_trace()
     
-    try:
-        # Save the uploaded image temporarily
-        id_image.save(temp_image_path)
-        
-        # Convert seed to integer
-        try:
-            seed_value = int(seed)
-        except ValueError:
-            seed_value = -1  # Default to -1 if conversion fails
-
-        output = replicate.run(
-            "zsxkib/flux-pulid:8baa7ef2255075b46f4d91cd238c21d31181b3e6a864463f967960bb0112525b",
-            input={
-                "prompt": prompt, 
-                "width": width,
-                "height": height,
-                "true_cfg": true_cfg,
-                "id_weight": id_weight, # 
-                "num_steps": num_steps, 
-                "start_step": start_step,
-                "num_outputs": 1,
-                "output_format": "png",
-                "guidance_scale": guidance_scale,
-                "output_quality": 100,
-                "main_face_image": open(temp_image_path, "rb"),
-                "negative_prompt": neg_prompt,
-                "max_sequence_length": max_sequence_length,
-                "seed": seed_value,  # Use the converted integer value
-                "timestep_to_start_cfg": timestep_to_start_cfg
-            }
-        )
-        
-        if output and isinstance(output, list) and len(output) > 0:
-            image_url = output[0]
-            response = requests.get(image_url)
-            return Image.open(io.BytesIO(response.content))
-        else:
-            print("Unexpected output format from Replicate API")
-            return None
-
-    except Exception as e:
-        print(f"Error in PuLID-FLUX generation: {str(e)}")
-        return None
-    finally:
-        # Close any open file handles before trying to remove
-        try:
-            if 'output' in locals() and hasattr(output, 'close'):
-                output.close()
-        except:
-            pass
-            
-        # Try to remove the temporary file
-        try:
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-        except Exception as e:
-            print(f"Warning: Could not remove temporary file: {e}")
-            
-#########################################################
-#LLAMADA A STORYFACE
-#########################################################
-
-def process_images_storyface(face_image, model_image, quality=100):
-    face_img_bytes = io.BytesIO()
-    face_image.save(face_img_bytes, format='PNG')
-    model_img_bytes = io.BytesIO()
-    model_image.save(model_img_bytes, format='PNG')
+    if face_image is None:
+        yield None, None, [], ""
+        return
 
-    url = os.getenv('URL')
-    if not url:
-        print("Error: StoryFace API URL not found in environment variables.")
-        return None
+    frontend.admit(BACKEND)
 
-    files = [
-        ('images', ('face.png', face_img_bytes.getvalue(), 'image/png')),
-        ('images', ('model.png', model_img_bytes.getvalue(), 'image/png'))
-    ]
-    data = {
-        'watermark': 0,
-        'quality': quality
+    params = {
+        "prompt": prompt, "width": width, "height": height, "num_steps": num_steps, "neg_prompt": neg_prompt,
+        "max_sequence_length": max_sequence_length, "id_weight": id_weight, "start_step": start_step,
+        "guidance_scale": guidance_scale, "seed": seed, "true_cfg": true_cfg,
+        "timestep_to_start_cfg": timestep_to_start_cfg
     }
 
-    try:
-        response = requests.post(url, files=files, data=data)
-        response.raise_for_status()
-        return Image.open(io.BytesIO(response.content))
-    except requests.exceptions.RequestException as e:
-        print(f"Error in StoryFace processing: {str(e)}")
-        return None
-
-#########################################################
-#iTERACION DE N LLAMADAS A STORYFACE
-#########################################################
-    
-def iterative_face_swap(face_image, initial_model_image, refinement_steps, quality=100):
-    """
-    Iteratively apply face swap, using each result as the new model image.
-    Always uses the original face_image as the source face.
-    """
-    current_model = initial_model_image
-    
-    for step in range(refinement_steps):
-        result = process_images_storyface(face_image, current_model, quality)
-        if result is None:
-            return current_model  # Return last successful result
-        current_model = result
-    
-    return current_model
-
-#########################################################
-#PIPELINE DE LAS 3 FUNCIONES ANTERIORES
-#########################################################
-
-def process_all(face_image, prompt, width, height, num_steps, neg_prompt, max_sequence_length, quality,
-                id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg, face_refinement_steps):
-    logger.info("System used")
-    
-    if face_image is None:
-        return None, None
-
-    # Generate initial image with PuLID-FLUX
-    pulid_flux_result = generate_image_pulid_flux(
-        prompt, face_image, width, height, num_steps, neg_prompt, max_sequence_length,
-        id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg
-    )
-    
-    if pulid_flux_result is None:
-        return None, None
-
-    # Apply iterative face swap
-    storyface_result = iterative_face_swap(face_image, pulid_flux_result, face_refinement_steps, quality)
-    return pulid_flux_result, storyface_result
+    # Push the generated image the moment it arrives, then each refinement step as it lands
+    async for outputs in frontend.stream_results(
+        face_image, params, quality, face_refinement_steps, int(num_candidates), BACKEND, candidate_mode,
+        adaptive=adaptive_refinement, user=frontend.user_id(request, session)
+    ):
+        yield outputs
 
 #########################################################
 #GRADIO WEBAPP
@@ -198,6 +88,10 @@ with gr.Blocks(title="Natasquad Image Generation Playground") as demo:
                     value="-1",
                     label="Seed (-1 for random) - Set a specific seed for reproducible results"
             )
+            num_candidates = gr.Slider(
+                minimum=1, maximum=4, value=1, step=1,
+                label="Candidates - Number of images to generate and refine in parallel"
+            )
             
             # Image Size Controls
             gr.Markdown("### Image Size")
@@ -236,7 +130,16 @@ with gr.Blocks(title="Natasquad Image Generation Playground") as demo:
                 timestep_to_start_cfg = gr.Slider(
                     minimum=0, maximum=20, value=1, step=1,
                     label="Timestep to Start CFG"
-                )             
+                )
+                candidate_mode = gr.Radio(
+                    choices=[("One prediction (num_outputs)", "num_outputs"), ("Parallel calls with different seeds", "seeds")],
+                    value="num_outputs",
+                    label="Candidate Mode - How multiple candidates are generated"
+                )
+                adaptive_refinement = gr.Checkbox(
+                    value=pipeline.ADAPTIVE_REFINEMENT,
+                    label="Adaptive Refinement - Stop the face refinement early once it no longer changes the image"
+                )
             
             
             submit_button = gr.Button("Generate Images")
@@ -244,16 +147,21 @@ with gr.Blocks(title="Natasquad Image Generation Playground") as demo:
         with gr.Column():            
             output_pulid_flux = gr.Image(label="Initial Generation")
             output_storyface = gr.Image(label="Result after Face Refinement")
+            output_candidates = gr.Gallery(label="Candidates", columns=2)
+            status = gr.Textbox(label="Status", interactive=False)
                
-    submit_button.click(
+    session = frontend.session_state()
+    generate_event = submit_button.click(
         process_all,
         inputs=[
             face_image, prompt, width, height, num_steps, neg_prompt, max_sequence_length, quality,
-            id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg, face_refinement_steps
+            id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg, face_refinement_steps,
+            num_candidates, candidate_mode, adaptive_refinement, session
         ],
-        outputs=[output_pulid_flux, output_storyface]
+        outputs=[output_pulid_flux, output_storyface, output_candidates, status]
     )
+    frontend.history_gallery(demo, generate_event, output_storyface, session)
+    frontend.prewarm_on_upload(face_image, BACKEND)
 
 if __name__ == "__main__":
-    demo.show_api = False
-    demo.launch(server_port=7880)
\ No newline at end of file
+    frontend.launch(demo, server_port=7880)
\ No newline at end of file
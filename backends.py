@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from PIL import ImageOps
+
+import pipeline
+import warm_keeper
+from circuit_breaker import get_breaker
+from encoded_image import EncodedImage
+from latency_model import Estimate, latency_model
+from metrics import count
+from scheduler import SchedulerFull, scheduler
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#BACKENDS DE GENERACION INTERCAMBIABLES
+#########################################################
+
+LATENCY_WINDOW = int(os.getenv("PULID_LATENCY_WINDOW", "50"))
+# A failed call counts as this many seconds, so failing backends drop to the back of the ranking
+FAILURE_PENALTY = float(os.getenv("PULID_FAILURE_PENALTY", "600"))
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0-100) of a non-empty sequence."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class LatencyTracker:
+    """Sliding window of recent generation latencies per backend."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+
+    def record(self, name, seconds, ok=True):
+        samples = self._samples.setdefault(name, deque(maxlen=self.window))
+        samples.append(seconds if ok else max(seconds, FAILURE_PENALTY))
+
+    def samples(self, name):
+        return list(self._samples.get(name, ()))
+
+    def median(self, name):
+        samples = self.samples(name)
+        return percentile(samples, 50) if samples else None
+
+
+latency_tracker = LatencyTracker()
+
+
+class GenerationBackend:
+    """
+    A PuLID-FLUX generation backend. Every backend takes the same `params` dict (see pipeline.DEFAULT_PARAMS)
+    and returns an EncodedImage, or None on failure.
+    """
+    name = None
+
+    async def generate(self, face_image, params, on_event=None):
+        return await self._guarded(params, lambda params: self._generate(face_image, params, on_event))
+
+    async def _guarded(self, params, call, outputs=1):
+        """
+        Run `call(params)` (params completed with the defaults) behind this backend's circuit breaker and
+        scheduler slot, reporting the outcome to both and to the latency tracker. `outputs` is the number of
+        images the call produces: its slot is charged that many predicted generations, and its latency is only
+        tracked for a single image. A None or empty result is a failure.
+        """
+        # Raises CircuitOpen / SchedulerFull straight away when this backend is failing or its queue is full
+        params = {**pipeline.DEFAULT_PARAMS, **params}
+        breaker = get_breaker(self.name)
+        probe = breaker.before()
+        ok = None
+        try:
+            cost = latency_model.predict(self.name, "generate", params) * outputs
+            async with scheduler.slot(self.name, cost=cost):
+                start_time = time.monotonic()
+                try:
+                    result = await call(params)
+                except asyncio.CancelledError:
+                    # Lost a hedge race: the elapsed time is only a lower bound of the real latency, so it is
+                    # kept when it already says the backend is slower than usual and dropped otherwise
+                    elapsed = time.monotonic() - start_time
+                    median = latency_tracker.median(self.name)
+                    if outputs == 1 and median is not None and elapsed > median:
+                        latency_tracker.record(self.name, elapsed)
+                    raise
+                except Exception:
+                    ok = False
+                    latency_tracker.record(self.name, time.monotonic() - start_time, ok=False)
+                    raise
+                ok = result is not None and result != []
+                if outputs == 1 or not ok:
+                    latency_tracker.record(self.name, time.monotonic() - start_time, ok=ok)
+                return result
+        finally:
+            breaker.after(ok, probe)
+
+    async def _generate(self, face_image, params, on_event):
+        raise NotImplementedError
+
+
+class HFSpaceBackend(GenerationBackend):
+    name = "hf"
+
+    async def _generate(self, face_image, params, on_event):
+        return await pipeline.generate_image_pulid_flux_hf(id_image=face_image, on_event=on_event, **params)
+
+
+class ReplicateBackend(GenerationBackend):
+    name = "replicate"
+
+    async def _generate(self, face_image, params, on_event):
+        return await pipeline.generate_image_pulid_flux_replicate(id_image=face_image, **params)
+
+    async def generate_many(self, face_image, params, num_outputs):
+        """One prediction producing `num_outputs` images (1 to 4), under the same breaker and slot as generate()."""
+        return await self._guarded(params, lambda params: pipeline.generate_images_pulid_flux_replicate(
+            id_image=face_image, num_outputs=num_outputs, **params
+        ), outputs=num_outputs)
+
+
+class LocalStubBackend(GenerationBackend):
+    """Offline stand-in: after STUB_LATENCY seconds returns the face cropped to the requested size."""
+    name = "stub"
+
+    def __init__(self, latency=None):
+        self.latency = float(os.getenv("STUB_LATENCY", "0.5")) if latency is None else latency
+
+    async def _generate(self, face_image, params, on_event):
+        await asyncio.sleep(self.latency)
+        image = await asyncio.to_thread(
+            ImageOps.fit, face_image.convert("RGB"), (int(params["width"]), int(params["height"]))
+        )
+        return EncodedImage.from_image(image)
+
+
+BACKENDS = {backend.name: backend for backend in (HFSpaceBackend(), ReplicateBackend(), LocalStubBackend())}
+
+#########################################################
+#ROUTER CON PETICIONES DE COBERTURA (HEDGING)
+#########################################################
+
+class Router(GenerationBackend):
+    """
+    Sends each job to the backend with the lowest predicted latency for its parameters (see latency_model)
+    plus current queue wait (backends without samples go first so they get measured). If the job is still running after the
+    primary's `hedge_percentile` latency, a duplicate goes to the next backend and whichever returns an
+    image first wins; the loser is cancelled locally (an already started remote prediction still runs to
+    completion upstream).
+    """
+    name = "auto"
+
+    def __init__(self, names, hedge_percentile=90, min_samples=5, tracker=latency_tracker):
+        self.names = list(names)
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.tracker = tracker
+
+    def ranked(self, params=None):
+        def sort_key(name):
+            median = self.tracker.median(name)
+            expected = median or 0
+            if median is not None and params is not None:
+                expected = latency_model.predict(name, "generate", params)
+            # Backends with an open circuit or failing health probes go last: they are only tried as a last resort.
+            # One that has probably gone to sleep is charged the time it takes to wake up.
+            down = get_breaker(name).is_open or warm_keeper.is_down(name)
+            return (down, median is not None,
+                    expected + scheduler.estimated_wait(name) + warm_keeper.cold_penalty(name))
+        return sorted(self.names, key=sort_key)
+
+    def hedge_delay(self, name):
+        samples = self.tracker.samples(name)
+        if len(samples) < self.min_samples:
+            return None
+        return percentile(samples, self.hedge_percentile)
+
+    async def generate(self, face_image, params, on_event=None):
+        ranked = self.ranked({**pipeline.DEFAULT_PARAMS, **params})
+        pending = set()
+        started = 0
+
+        def start_next():
+            nonlocal started
+            backend = BACKENDS[ranked[started]]
+            started += 1
+            pending.add(asyncio.create_task(backend.generate(face_image, params, on_event)))
+
+        start_next()
+        errors = []
+        try:
+            while pending:
+                # Only the first backend is hedged; later ones are plain failover
+                timeout = self.hedge_delay(ranked[0]) if started == 1 and len(ranked) > 1 else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"{ranked[0]} slower than its p{self.hedge_percentile:g} ({timeout:.1f}s), "
+                                f"hedging on {ranked[1]}")
+                    count("hedges", backend=ranked[1])
+                    start_next()
+                    continue
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif task.result() is not None:
+                        return task.result()
+                if not pending and started < len(ranked):
+                    start_next()
+            if errors and all(isinstance(error, SchedulerFull) for error in errors):
+                raise errors[0]  # every backend is saturated
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+ROUTED_BACKENDS = [name.strip() for name in os.getenv("PULID_ROUTER_BACKENDS", "hf,replicate").split(",") if name.strip()]
+router = Router(ROUTED_BACKENDS, hedge_percentile=float(os.getenv("PULID_HEDGE_PERCENTILE", "90")))
+
+BACKEND_NAMES = sorted(BACKENDS) + ["auto"]
+
+
+def get_backend(name):
+    """Backend by name: "hf", "replicate", "stub", or "auto" for the latency-based router."""
+    if name == "auto":
+        return router
+    return BACKENDS[name]
+
+
+def check_admission(name):
+    """
+    Fast admission check before starting a job on backend `name`.
+    Returns the estimated wait in seconds, or raises SchedulerFull (CircuitOpen while the backend is failing).
+    For "auto" a job is admitted while any routed backend is healthy and has room.
+    """
+    if name != "auto":
+        get_breaker(name).check()
+        return scheduler.check_admission(name)
+    waits, error = [], None
+    for routed in router.names:
+        try:
+            get_breaker(routed).check()
+            waits.append(scheduler.check_admission(routed))
+        except SchedulerFull as e:
+            error = e
+    if not waits:
+        raise error
+    return min(waits)
+
+
+def estimate(name, params, face_refinement_steps=1):
+    """
+    Predicted duration of a job on backend `name` (see latency_model.Estimate): the current wait for a slot,
+    generation at these parameters and each StoryFace pass on the generated image. "auto" uses the
+    backend the router would pick first. Upstreams that have probably gone to sleep add their wake-up time.
+    """
+    params = {**pipeline.DEFAULT_PARAMS, **params}
+    if name == "auto":
+        name = router.ranked(params)[0]
+    wake_up = warm_keeper.cold_penalty(name) + (warm_keeper.cold_penalty("storyface") if face_refinement_steps else 0)
+    return Estimate(
+        scheduler.estimated_wait(name) + wake_up,
+        latency_model.predict(name, "generate", params),
+        latency_model.predict("storyface", "swap", params),
+        face_refinement_steps,
+    )
@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from PIL import Image
+
+import backends
+import metrics
+import pipeline
+from http_clients import close_clients
+from scheduler import BATCH, priority
+
+#########################################################
+#GENERACION POR LOTES: CARAS x PROMPTS
+#########################################################
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def load_jobs_file(path):
+    """
+    Read the prompt/parameter file: a JSON list of parameter dicts, or one JSON object per line.
+    Plain text lines are treated as prompts. `quality` and `face_refinement_steps` may be set per entry.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith(".json"):
+        entries = json.loads(text)
+    else:
+        entries = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entries.append(json.loads(line) if line.startswith("{") else {"prompt": line})
+    return entries
+
+
+def list_faces(faces_dir):
+    return sorted(
+        os.path.join(faces_dir, name) for name in os.listdir(faces_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def item_id(face_path, entry):
+    digest = hashlib.sha256(os.path.basename(face_path).encode())
+    digest.update(json.dumps(entry, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def read_manifest(path):
+    """Latest record per item id; a killed run may leave a truncated last line, which is ignored."""
+    records = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["id"]] = record
+    return records
+
+
+def load_face(path):
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+
+async def run_item(item, args):
+    entry = dict(item["params"])
+    quality = entry.pop("quality", args.quality)
+    refinement_steps = entry.pop("face_refinement_steps", args.refinement_steps)
+
+    face_image = await asyncio.to_thread(load_face, item["face"])
+    generated, refined = await pipeline.process_all(face_image, entry, quality, refinement_steps, args.backend,
+                                                    adaptive=args.adaptive_refinement or None)
+    if generated is None:
+        raise RuntimeError("generation failed")
+
+    # Saved in the format the upstream returned, so the bytes are written without re-encoding
+    outputs = {
+        "generated": os.path.join(args.output, f"{item['id']}_generated.{generated.extension}"),
+        "refined": os.path.join(args.output, f"{item['id']}_refined.{refined.extension}"),
+    }
+    await asyncio.gather(
+        asyncio.to_thread(generated.save, outputs["generated"]),
+        asyncio.to_thread(refined.save, outputs["refined"]),
+    )
+    return outputs
+
+
+async def run_batch(args):
+    faces = list_faces(args.faces)
+    entries = load_jobs_file(args.prompts)
+    os.makedirs(args.output, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.output, "manifest.jsonl")
+
+    done = {
+        key: record for key, record in read_manifest(manifest_path).items()
+        if record["status"] == "done" or (args.skip_failed and record["status"] == "failed")
+    }
+    items = [
+        {"id": item_id(face, entry), "face": face, "params": entry}
+        for face in faces for entry in entries
+    ]
+    pending = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} items ({len(faces)} faces x {len(entries)} prompts), "
+          f"{len(items) - len(pending)} already finished, {len(pending)} to run with {args.workers} workers")
+
+    queue = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+    counts = {"done": 0, "failed": 0}
+    durations = []
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        async def worker():
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                start_time = time.monotonic()
+                record = {"id": item["id"], "face": item["face"], "params": item["params"],
+                          "trace_id": metrics.new_trace()}
+                try:
+                    record["outputs"] = await run_item(item, args)
+                    record["status"] = "done"
+                except Exception as e:
+                    record["status"] = "failed"
+                    record["error"] = str(e)
+                record["duration"] = round(time.monotonic() - start_time, 3)
+                record["finished_at"] = time.time()
+                counts[record["status"]] += 1
+                durations.append(record["duration"])
+                manifest.write(json.dumps(record) + "\n")
+                manifest.flush()
+                print(f"[{counts['done'] + counts['failed']}/{len(pending)}] {item['id']} {record['status']} "
+                      f"in {record['duration']:.1f}s")
+
+        start_time = time.monotonic()
+        try:
+            # Batch jobs yield to interactive users on every upstream
+            with priority(BATCH):
+                await asyncio.gather(*(worker() for _ in range(args.workers)))
+        finally:
+            await close_clients()
+        elapsed = time.monotonic() - start_time
+
+    finished = counts["done"] + counts["failed"]
+    print(f"Finished {finished} items in {elapsed:.1f}s: {counts['done']} done, {counts['failed']} failed")
+    if finished:
+        durations.sort()
+        print(f"Throughput: {finished / elapsed * 60:.2f} items/min, "
+              f"median item time {durations[len(durations) // 2]:.1f}s")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the PuLID-FLUX + StoryFace pipeline over faces x prompts")
+    parser.add_argument("--faces", required=True, help="Directory of face images")
+    parser.add_argument("--prompts", required=True,
+                        help="JSON list / JSONL of parameter dicts (see pipeline.DEFAULT_PARAMS) or one prompt per line")
+    parser.add_argument("--output", default="batch_output", help="Directory for generated images")
+    parser.add_argument("--manifest", help="JSONL manifest path (default: <output>/manifest.jsonl)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of items processed concurrently")
+    parser.add_argument("--backend", default="replicate", choices=backends.BACKEND_NAMES,
+                        help="Generation backend; \"auto\" routes by recent latency with hedging")
+    parser.add_argument("--quality", type=int, default=100, help="StoryFace quality")
+    parser.add_argument("--refinement-steps", type=int, default=1, help="StoryFace refinement steps")
+    parser.add_argument("--adaptive-refinement", action="store_true",
+                        help="Stop refining once a StoryFace pass no longer changes the image")
+    parser.add_argument("--skip-failed", action="store_true", help="Don't retry items that failed in a previous run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - [%(trace_id)s] %(message)s')
+    metrics.install_trace_logging()
+    counts = asyncio.run(run_batch(args))
+    raise SystemExit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
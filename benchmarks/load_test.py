@@ -0,0 +1,254 @@
+"""
+Load test: drive the real pipeline (pipeline.process_all) against the local mock servers at increasing
+concurrency and report throughput, latency percentiles, memory per in-flight job and file descriptors.
+
+    python -m benchmarks.load_test --backend hf --concurrency 1,4,16,64 --requests 64
+
+The mock servers run in a separate process so they do not compete with the pipeline for the GIL.
+With --external the endpoints already in the environment (HF_SPACE_URL, REPLICATE_BASE_URL, URL) are used as-is.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import httpx
+from PIL import Image
+
+from benchmarks import mock_servers
+
+#########################################################
+#MEDICION DE MEMORIA Y DESCRIPTORES
+#########################################################
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return None
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+class PeakSampler:
+    """Samples RSS and open file descriptors in the background and keeps the peaks."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_rss = rss_bytes()
+        self.peak_fds = open_fds()
+        self._task = None
+
+    async def _run(self):
+        while True:
+            rss, fds = rss_bytes(), open_fds()
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss, rss)
+            if fds is not None:
+                self.peak_fds = max(self.peak_fds, fds)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+#########################################################
+#EJECUCION POR NIVEL DE CONCURRENCIA
+#########################################################
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def run_level(pipeline, face_image, params, concurrency, total, backend, quality, refinement_steps):
+    """Closed loop: `concurrency` workers issue `total` jobs back to back."""
+    from metrics import new_trace
+    from scheduler import SchedulerFull
+
+    latencies, failures, rejections = [], 0, 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal failures, rejections
+        for _ in remaining:
+            new_trace()
+            start_time = time.perf_counter()
+            try:
+                generated, refined = await pipeline.process_all(face_image, params, quality, refinement_steps, backend)
+            except SchedulerFull:
+                rejections += 1
+                continue
+            if generated is None or refined is None:
+                failures += 1
+            else:
+                latencies.append(time.perf_counter() - start_time)
+
+    baseline_rss, baseline_fds = rss_bytes(), open_fds()
+    sampler = PeakSampler()
+    sampler.start()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(asyncio.create_task(worker()) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+    await sampler.stop()
+
+    result = {
+        "concurrency": concurrency,
+        "requests": total,
+        "ok": len(latencies),
+        "failed": failures,
+        "rejected": rejections,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "peak_fds": sampler.peak_fds,
+        "fds_after": open_fds(),
+        "fds_before": baseline_fds,
+    }
+    if baseline_rss is not None:
+        result["peak_rss_mb"] = round(sampler.peak_rss / 2**20, 1)
+        result["mb_per_inflight_job"] = round((sampler.peak_rss - baseline_rss) / 2**20 / concurrency, 2)
+    return result
+
+
+def print_table(results):
+    columns = ["concurrency", "ok", "failed", "rejected", "throughput_rps", "p50_s", "p95_s", "p99_s",
+               "mb_per_inflight_job", "peak_fds", "fds_after"]
+    print(" ".join(column for column in columns))
+    for result in results:
+        print(" ".join(f"{str(result.get(column, '-')):>{len(column)}}" for column in columns))
+
+
+def print_stage_breakdown():
+    """p50/p95 of every instrumented stage over the whole run (see metrics.py)."""
+    from metrics import registry
+    print(f"\n{'stage':>24} {'backend':>10} {'count':>7} {'p50_s':>8} {'p95_s':>8}")
+    for (stage, backend), histogram in sorted(registry.histograms.items()):
+        print(f"{stage:>24} {backend:>10} {histogram.count:>7} "
+              f"{histogram.quantile(0.5):>8.3f} {histogram.quantile(0.95):>8.3f}")
+
+#########################################################
+#MAIN
+#########################################################
+
+def start_mock_process(args):
+    command = [sys.executable, "-m", "benchmarks.mock_servers", "--host", "127.0.0.1", "--port", str(args.port),
+               "--jitter", str(args.jitter)]
+    for name in ("hf", "replicate", "storyface"):
+        command += [
+            f"--{name}-latency", str(getattr(args, f"{name}_latency")),
+            f"--{name}-error-rate", str(getattr(args, f"{name}_error_rate")),
+            f"--{name}-workers", str(getattr(args, f"{name}_workers")),
+        ]
+    command += ["--hf-cold-start", str(args.hf_cold_start), "--storyface-cold-start", str(args.storyface_cold_start),
+                "--idle-timeout", str(args.idle_timeout)]
+    if args.hf_polling:
+        command.append("--hf-polling")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Mock servers exited during startup")
+        try:
+            # Any answer will do; a request to a mocked service would wake it from its cold start
+            httpx.get(f"http://127.0.0.1:{args.port}/", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock servers did not start in time")
+
+
+async def run(args):
+    # Imported here so that the endpoint variables set in main() are seen at import time
+    import pipeline
+    from http_clients import close_clients
+
+    if args.face:
+        face_image = Image.open(args.face)
+        face_image.load()
+    else:
+        face_image = Image.new("RGB", (512, 512), (200, 170, 150))
+    params = {"width": args.width, "height": args.height, "num_steps": args.num_steps}
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            total = args.requests or concurrency * 4
+            result = await run_level(pipeline, face_image, params, concurrency, total, args.backend,
+                                     args.quality, args.refinement_steps)
+            results.append(result)
+            print(f"concurrency {concurrency}: {result['ok']}/{total} ok, {result['throughput_rps']} req/s, "
+                  f"p95 {result['p95_s']}s", flush=True)
+    finally:
+        await close_clients()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the PuLID-FLUX + StoryFace pipeline against mock upstreams")
+    parser.add_argument("--backend", default="hf", help="Generation backend: hf, replicate, stub or auto")
+    parser.add_argument("--concurrency", default="1,4,16,64",
+                        type=lambda value: [int(level) for level in value.split(",")],
+                        help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=0, help="Jobs per level (default: 4 x concurrency)")
+    parser.add_argument("--refinement-steps", type=int, default=1)
+    parser.add_argument("--quality", type=int, default=100)
+    parser.add_argument("--width", type=int, default=896)
+    parser.add_argument("--height", type=int, default=1152)
+    parser.add_argument("--num-steps", type=int, default=20)
+    parser.add_argument("--face", help="Face image to send (default: a synthetic 512x512 image)")
+    parser.add_argument("--port", type=int, default=8900, help="Port for the mock servers")
+    parser.add_argument("--external", action="store_true", help="Use the endpoints already set in the environment")
+    parser.add_argument("--cache", action="store_true", help="Keep the result cache enabled (off by default)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    mock_servers.add_service_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.cache:
+        os.environ["RESULT_CACHE_ENABLED"] = "0"
+    process = None
+    if not args.external:
+        os.environ.update(mock_servers.endpoints("127.0.0.1", args.port))
+        process = start_mock_process(args)
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print()
+    print_table(results)
+    print_stage_breakdown()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"backend": args.backend, "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
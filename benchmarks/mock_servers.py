@@ -0,0 +1,393 @@
+"""
+Local stand-ins for the upstream services, for benchmarks and offline development:
+
+- /hf         the HF Space `/call/generate_image` submit + result protocol (SSE, or JSON polling with --hf-polling)
+- /replicate  the Replicate files, model versions and predictions API (including webhooks)
+- /storyface  the StoryFace multipart face swap endpoint
+
+Each service simulates a fixed number of GPU workers (requests beyond that queue), a latency with jitter
+and an error rate. The HF Space and StoryFace can also go to sleep when idle (--hf-cold-start, --storyface-cold-start):
+the first request after --idle-timeout seconds without any then waits for them to boot. Run standalone with `python -m benchmarks.mock_servers --port 8900` and point the apps at it:
+
+    HF_SPACE_URL=http://127.0.0.1:8900/hf
+    REPLICATE_BASE_URL=http://127.0.0.1:8900/replicate
+    URL=http://127.0.0.1:8900/storyface/swap
+"""
+import argparse
+import asyncio
+import base64
+import functools
+import io
+import json
+import random
+import threading
+import time
+import uuid
+import httpx
+import uvicorn
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+
+class ServiceConfig:
+    """Behaviour of one mocked upstream."""
+
+    def __init__(self, latency=1.0, jitter=0.2, error_rate=0.0, workers=4, cold_start=0.0, idle_timeout=300.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.workers = workers
+        self.cold_start = cold_start
+        self.idle_timeout = idle_timeout
+
+    def sample_latency(self):
+        return max(0.0, random.gauss(self.latency, self.latency * self.jitter))
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class SimulatedGPU:
+    """`workers` jobs run at once; the rest wait in FIFO order, like a model server queue."""
+
+    def __init__(self, config):
+        self.config = config
+        self.semaphore = asyncio.Semaphore(config.workers)
+        self.waiting = 0
+
+    async def run(self):
+        """Queue, then 'infer'. Returns False when the simulated job fails."""
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            await asyncio.sleep(self.config.sample_latency())
+            return not self.config.should_fail()
+        finally:
+            self.semaphore.release()
+
+
+class SleepsWhenIdle:
+    """
+    ASGI wrapper for a service that scales to zero: after `idle_timeout` seconds without requests, the next
+    request (a health check included) waits `cold_start` seconds for it to boot, and so does any arriving meanwhile.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+        self.last_request = None
+        self.booting = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.config.cold_start:
+            idle = self.last_request is None or time.monotonic() - self.last_request > self.config.idle_timeout
+            if self.booting is None and idle:
+                self.booting = asyncio.ensure_future(asyncio.sleep(self.config.cold_start))
+            if self.booting is not None:
+                await asyncio.shield(self.booting)
+                self.booting = None
+            self.last_request = time.monotonic()
+        await self.app(scope, receive, send)
+
+
+def service_url(request):
+    """Base URL of the (possibly mounted) service that received `request`, with a trailing slash."""
+    return f"{str(request.base_url).rstrip('/')}{request.scope.get('root_path', '')}/"
+
+
+@functools.lru_cache(maxsize=32)
+def placeholder_png(width, height):
+    image = Image.new("RGB", (int(width), int(height)), (120, 110, 100))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+#########################################################
+#HF SPACE: /call/generate_image
+#########################################################
+
+def create_hf_app(config, polling=False):
+    gpu = SimulatedGPU(config)
+    jobs = {}
+
+    async def run_job(job):
+        ok = await gpu.run()
+        job["status"] = "COMPLETE" if ok else "FAILED"
+        job["done"].set()
+
+    async def submit(request):
+        payload = await request.json()
+        data = payload["data"]
+        event_id = uuid.uuid4().hex
+        job = {"status": "QUEUED", "width": data[6], "height": data[7], "done": asyncio.Event(),
+               "submitted_at": time.monotonic()}
+        jobs[event_id] = job
+        job["task"] = asyncio.create_task(run_job(job))
+        return JSONResponse({"event_id": event_id})
+
+    def output(job):
+        return [base64.b64encode(placeholder_png(job["width"], job["height"])).decode(), 0]
+
+    async def result(request):
+        job = jobs.get(request.path_params["event_id"])
+        if job is None:
+            return JSONResponse({"error": "Unknown event id"}, status_code=404)
+
+        if polling:
+            if job["status"] == "COMPLETE":
+                jobs.pop(request.path_params["event_id"], None)
+                return JSONResponse({"status": "COMPLETE", "data": output(job)})
+            if job["status"] == "FAILED":
+                return JSONResponse({"error": "Simulated failure"})
+            return JSONResponse({"status": "QUEUED", "rank": gpu.waiting, "queue_size": gpu.waiting})
+
+        async def events():
+            yield "event: generating\ndata: null\n\n"
+            while not job["done"].is_set():
+                try:
+                    await asyncio.wait_for(job["done"].wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    yield "event: heartbeat\ndata: null\n\n"
+            jobs.pop(request.path_params["event_id"], None)
+            if job["status"] == "COMPLETE":
+                yield f"event: complete\ndata: {json.dumps(output(job))}\n\n"
+            else:
+                yield "event: error\ndata: null\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def health(request):
+        return JSONResponse({"status": "ok", "queue": gpu.waiting})
+
+    return Starlette(routes=[
+        Route("/call/generate_image", submit, methods=["POST"]),
+        Route("/call/generate_image/{event_id}", result),
+        Route("/config", health),
+    ])
+
+#########################################################
+#REPLICATE: files + versions + predictions
+#########################################################
+
+def create_replicate_app(config):
+    gpu = SimulatedGPU(config)
+    predictions = {}
+    files = {}
+    webhook_client = {}
+    created_at = "2024-01-01T00:00:00.000000Z"
+
+    def prediction_json(prediction, base_url):
+        return {
+            "id": prediction["id"],
+            "model": "zsxkib/flux-pulid",
+            "version": prediction["version"],
+            "status": prediction["status"],
+            "input": prediction["input"],
+            "output": prediction["output"],
+            "error": prediction["error"],
+            "logs": "",
+            "created_at": created_at,
+            "urls": {
+                "get": f"{base_url}v1/predictions/{prediction['id']}",
+                "cancel": f"{base_url}v1/predictions/{prediction['id']}/cancel",
+            },
+        }
+
+    async def run_prediction(prediction, base_url):
+        prediction["status"] = "processing"
+        ok = await gpu.run()
+        if prediction["status"] == "canceled":
+            return
+        if ok:
+            count = int(prediction["input"].get("num_outputs", 1))
+            prediction["output"] = [f"{base_url}outputs/{prediction['id']}/{index}.png" for index in range(count)]
+            prediction["status"] = "succeeded"
+        else:
+            prediction["error"] = "Simulated failure"
+            prediction["status"] = "failed"
+        if prediction["webhook"]:
+            if "client" not in webhook_client:
+                webhook_client["client"] = httpx.AsyncClient(timeout=10)
+            try:
+                await webhook_client["client"].post(prediction["webhook"], json=prediction_json(prediction, base_url))
+            except httpx.HTTPError:
+                pass  # Replicate retries webhooks, a lost one is recovered by polling
+
+    async def create_file(request):
+        form = await request.form()
+        upload = form["content"]
+        file_id = uuid.uuid4().hex
+        content = await upload.read()
+        files[file_id] = content
+        return JSONResponse({
+            "id": file_id, "name": upload.filename, "content_type": upload.content_type, "size": len(content),
+            "etag": file_id, "checksums": {}, "metadata": {}, "created_at": created_at, "expires_at": None,
+            "urls": {"get": f"{service_url(request)}v1/files/{file_id}"},
+        }, status_code=201)
+
+    async def get_file(request):
+        if request.path_params["file_id"] not in files:
+            return JSONResponse({"detail": "Not found"}, status_code=404)
+        if request.method == "DELETE":
+            del files[request.path_params["file_id"]]  # lets tests simulate Replicate expiring an upload
+            return Response(status_code=204)
+        return Response(files[request.path_params["file_id"]], media_type="application/octet-stream")
+
+    async def get_version(request):
+        return JSONResponse({
+            "id": request.path_params["version_id"], "created_at": created_at, "cog_version": "0.9.0",
+            "openapi_schema": {},
+        })
+
+    async def create_prediction(request):
+        body = await request.json()
+        image = body["input"].get("main_face_image", "")
+        if "/v1/files/" in image and image.rsplit("/", 1)[-1] not in files:
+            return JSONResponse({"detail": "Input file not found"}, status_code=422)
+        prediction = {
+            "id": uuid.uuid4().hex, "version": body.get("version", ""), "status": "starting",
+            "input": body["input"], "output": None, "error": None, "webhook": body.get("webhook"),
+        }
+        predictions[prediction["id"]] = prediction
+        base_url = service_url(request)
+        prediction["task"] = asyncio.create_task(run_prediction(prediction, base_url))
+        return JSONResponse(prediction_json(prediction, base_url), status_code=201)
+
+    async def get_prediction(request):
+        prediction = predictions.get(request.path_params["prediction_id"])
+        if prediction is None:
+            return JSONResponse({"detail": "Not found"}, status_code=404)
+        return JSONResponse(prediction_json(prediction, service_url(request)))
+
+    async def cancel_prediction(request):
+        prediction = predictions.get(request.path_params["prediction_id"])
+        if prediction is None:
+            return JSONResponse({"detail": "Not found"}, status_code=404)
+        if prediction["status"] in ("starting", "processing"):
+            prediction["status"] = "canceled"
+        return JSONResponse(prediction_json(prediction, service_url(request)))
+
+    async def get_output(request):
+        prediction = predictions.get(request.path_params["prediction_id"])
+        if prediction is None:
+            return Response(status_code=404)
+        return Response(
+            placeholder_png(prediction["input"].get("width", 896), prediction["input"].get("height", 1152)),
+            media_type="image/png",
+        )
+
+    return Starlette(routes=[
+        Route("/v1/files", create_file, methods=["POST"]),
+        Route("/v1/files/{file_id}", get_file, methods=["GET", "DELETE"]),
+        Route("/v1/models/{owner}/{name}/versions/{version_id}", get_version),
+        Route("/v1/predictions", create_prediction, methods=["POST"]),
+        Route("/v1/predictions/{prediction_id}", get_prediction),
+        Route("/v1/predictions/{prediction_id}/cancel", cancel_prediction, methods=["POST"]),
+        Route("/outputs/{prediction_id}/{index}.png", get_output),
+    ])
+
+#########################################################
+#STORYFACE: intercambio de cara multipart
+#########################################################
+
+def create_storyface_app(config):
+    gpu = SimulatedGPU(config)
+
+    async def swap(request: Request):
+        form = await request.form()
+        images = form.getlist("images")
+        if len(images) != 2:
+            return JSONResponse({"detail": "Expected face and model images"}, status_code=422)
+        model_bytes = await images[1].read()
+        if not await gpu.run():
+            return JSONResponse({"detail": "Simulated failure"}, status_code=500)
+        # The "swapped" image is the model image sent back unchanged
+        return Response(model_bytes, media_type="image/png")
+
+    async def health(request):
+        return JSONResponse({"status": "ok", "queue": gpu.waiting})
+
+    return Starlette(routes=[
+        Route("/swap", swap, methods=["POST"]),
+        Route("/health", health),
+    ])
+
+
+def create_app(hf=None, replicate=None, storyface=None, hf_polling=False):
+    """All three mocks behind one server, under /hf, /replicate and /storyface."""
+    hf = hf or ServiceConfig(latency=8.0)
+    storyface = storyface or ServiceConfig(latency=2.0)
+    return Starlette(routes=[
+        Mount("/hf", app=SleepsWhenIdle(create_hf_app(hf, polling=hf_polling), hf)),
+        Mount("/replicate", app=create_replicate_app(replicate or ServiceConfig(latency=6.0))),
+        Mount("/storyface", app=SleepsWhenIdle(create_storyface_app(storyface), storyface)),
+    ])
+
+
+def endpoints(host, port):
+    """Environment variables that point the pipeline at a mock server on host:port."""
+    base = f"http://{host}:{port}"
+    return {
+        "HF_SPACE_URL": f"{base}/hf",
+        "REPLICATE_BASE_URL": f"{base}/replicate",
+        "REPLICATE_API_TOKEN": "mock-token",
+        "URL": f"{base}/storyface/swap",
+    }
+
+
+def start_in_thread(app, host="127.0.0.1", port=8900):
+    """Run `app` with uvicorn in a daemon thread and wait until it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, name="mock-servers", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"Mock server failed to start on {host}:{port}")
+        time.sleep(0.05)
+    return server
+
+
+def add_service_arguments(parser):
+    for name, latency in (("hf", 8.0), ("replicate", 6.0), ("storyface", 2.0)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help=f"Mean {name} latency (s)")
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0, help=f"Fraction of failing {name} calls")
+        parser.add_argument(f"--{name}-workers", type=int, default=4, help=f"Concurrent {name} jobs before queueing")
+    for name in ("hf", "storyface"):
+        parser.add_argument(f"--{name}-cold-start", type=float, default=0.0,
+                            help=f"Seconds {name} takes to boot after sitting idle (0: always warm)")
+    parser.add_argument("--idle-timeout", type=float, default=300.0,
+                        help="Idle seconds after which a service with a cold start goes to sleep")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency standard deviation, as a fraction of the mean")
+    parser.add_argument("--hf-polling", action="store_true", help="Answer HF result requests with JSON instead of SSE")
+
+
+def app_from_args(args):
+    def config(name):
+        return ServiceConfig(
+            latency=getattr(args, f"{name}_latency"), jitter=args.jitter,
+            error_rate=getattr(args, f"{name}_error_rate"), workers=getattr(args, f"{name}_workers"),
+            cold_start=getattr(args, f"{name}_cold_start", 0.0), idle_timeout=args.idle_timeout,
+        )
+    return create_app(config("hf"), config("replicate"), config("storyface"), hf_polling=args.hf_polling)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve mock HF Space, Replicate and StoryFace endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_service_arguments(parser)
+    args = parser.parse_args()
+
+    for key, value in endpoints(args.host, args.port).items():
+        print(f"{key}={value}")
+    uvicorn.run(app_from_args(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
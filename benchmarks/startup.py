@@ -0,0 +1,64 @@
+"""
+Startup-time benchmark: import each entry point in a fresh interpreter and report the import time and which
+heavy dependencies it loaded. Headless entry points (pipeline, batch, api) must not pull in Gradio.
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["pipeline", "batch", "api", "worker", "app", "app_replicate", "show_app"]
+HEADLESS = {"pipeline", "batch", "api", "worker"}
+HEAVY = ["gradio", "replicate", "numpy", "PIL.Image", "uvicorn", "starlette", "fastapi"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module, runs):
+    """Median import time of `module` over `runs` fresh interpreters, and the heavy modules it loaded."""
+    samples, loaded = [], []
+    # Run from a scratch directory so apps that open log files on import leave nothing behind
+    with tempfile.TemporaryDirectory() as cwd:
+        env = {**os.environ, "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                cwd=cwd, env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            samples.append(result["seconds"])
+            loaded = result["loaded"]
+    return statistics.median(samples), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure entry point import times")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modules", default=",".join(MODULES))
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':>14} {'import_s':>9}  heavy dependencies loaded")
+    for module in args.modules.split(","):
+        seconds, loaded = measure(module, args.runs)
+        print(f"{module:>14} {seconds:>9.3f}  {', '.join(loaded) or '-'}")
+        if module in HEADLESS and "gradio" in loaded:
+            print(f"{module} imports gradio, headless workers would pay for the UI stack")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
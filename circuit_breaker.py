@@ -0,0 +1,154 @@
+import logging
+import os
+import time
+from collections import deque
+
+from metrics import count
+from scheduler import SchedulerFull
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#CIRCUIT BREAKERS Y PRESUPUESTO DE REINTENTOS
+#########################################################
+
+# Consecutive failed calls that open a backend's circuit
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit sheds calls before letting probes through
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# Calls let through at once while half-open; the first result decides whether the circuit closes
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+# Retries allowed as a fraction of requests over the last RETRY_BUDGET_WINDOW seconds, plus a small floor
+# so a quiet process can still retry the odd blip
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "5"))
+RETRY_BUDGET_WINDOW = float(os.getenv("RETRY_BUDGET_WINDOW", "10"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(SchedulerFull):
+    """Raised immediately for a backend whose circuit is open; handled wherever SchedulerFull is."""
+
+    def __init__(self, backend, estimated_wait):
+        Exception.__init__(self, f"{backend} is failing, try again in about {estimated_wait:.0f}s")
+        self.backend = backend
+        self.estimated_wait = estimated_wait
+
+
+class CircuitBreaker:
+    """
+    Per-backend breaker: after `failure_threshold` consecutive failures calls are rejected for `reset_timeout`
+    seconds, then up to `half_open_probes` calls go through; a success closes the circuit, a failure reopens it.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT,
+                 half_open_probes=CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def _transition(self, state):
+        if state != self.state:
+            logger.warning(f"Circuit for {self.name} {self.state} -> {state}")
+            count("circuit_transitions", backend=self.name, state=state)
+            self.state = state
+
+    def check(self):
+        """Raise CircuitOpen if a call would be shed right now, without taking a probe slot."""
+        if self.state == OPEN and self.retry_in() > 0:
+            count("circuit_rejections", backend=self.name)
+            raise CircuitOpen(self.name, self.retry_in())
+        if self.state == HALF_OPEN and self.probes >= self.half_open_probes:
+            count("circuit_rejections", backend=self.name)
+            raise CircuitOpen(self.name, self.reset_timeout)
+
+    def before(self):
+        """
+        Admit one call or raise CircuitOpen. Returns True if the call is a half-open probe; pass that on to
+        after(), which every admitted call must reach.
+        """
+        self.check()
+        if self.state == OPEN:
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            self.probes += 1
+            return True
+        return False
+
+    def after(self, ok, probe=False):
+        """Report an admitted call: `ok` True succeeded, False failed, None abandoned (cancelled or never sent)."""
+        if probe:
+            self.probes = max(0, self.probes - 1)
+        if ok is None:
+            return
+        if ok:
+            self.failures = 0
+            if probe and self.state == HALF_OPEN:
+                self._transition(CLOSED)
+            return
+        self.failures += 1
+        # Late results of calls made before the circuit opened don't count as probes
+        if (probe and self.state == HALF_OPEN) or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self.probes = 0
+            self._transition(OPEN)
+
+    @property
+    def is_open(self):
+        return self.state != CLOSED
+
+
+_breakers = {}
+
+
+def get_breaker(backend):
+    breaker = _breakers.get(backend)
+    if breaker is None:
+        breaker = _breakers[backend] = CircuitBreaker(backend)
+    return breaker
+
+
+class RetryBudget:
+    """
+    Process-wide cap on retries: over a sliding window, retries may not exceed `ratio` of requests
+    (plus `minimum`), so an outage cannot multiply the load on every upstream.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN, window=RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+
+    def _prune(self, now):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        self._prune(now)
+        self._requests.append(now)
+
+    def try_retry(self, backend="-"):
+        """True (and the retry is charged) if the budget allows one more retry."""
+        now = time.monotonic()
+        self._prune(now)
+        if len(self._retries) >= self.minimum + self.ratio * len(self._requests):
+            count("retry_budget_exhausted", backend=backend)
+            return False
+        self._retries.append(now)
+        return True
+
+
+retry_budget = RetryBudget()
@@ -0,0 +1,117 @@
+import io
+import os
+import threading
+from PIL import Image
+
+from preprocess import EXTENSIONS, encode_image
+
+#########################################################
+#IMAGENES CODIFICADAS CON DECODIFICACION PEREZOSA
+#########################################################
+
+# Leading bytes of each transfer format
+SIGNATURES = ((b"\x89PNG\r\n\x1a\n", "PNG"), (b"\xff\xd8\xff", "JPEG"), (b"RIFF", "WEBP"))
+FORMATS_BY_EXTENSION = {f".{extension}": image_format for image_format, (extension, _) in EXTENSIONS.items()}
+FORMATS_BY_EXTENSION[".jpeg"] = "JPEG"
+
+
+def sniff_format(data):
+    for signature, image_format in SIGNATURES:
+        if data.startswith(signature) and (image_format != "WEBP" or data[8:12] == b"WEBP"):
+            return image_format
+    return None
+
+
+class EncodedImage:
+    """
+    A stage output kept as the bytes it arrived in. Pixels are decoded only when something needs them
+    (the UI, convergence checks), and the bytes are passed on untouched to the next upstream or to disk
+    when the format fits, instead of decoding and re-encoding at every hop.
+    """
+
+    def __init__(self, data=None, image=None):
+        if data is None and image is None:
+            raise ValueError("EncodedImage needs encoded data or a PIL image")
+        self._data = data
+        self._image = image
+        self._lock = threading.Lock()
+        self.format = sniff_format(data) if data is not None else None
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data=data)
+
+    @classmethod
+    def from_image(cls, image):
+        return cls(image=image)
+
+    @property
+    def image(self):
+        """Decoded PIL image, cached. Blocking: call it from a worker thread for large images."""
+        with self._lock:
+            if self._image is None:
+                self._image = self.open()
+            return self._image
+
+    def open(self):
+        """A freshly decoded PIL image that is not kept around (for one-off pixel access)."""
+        if self._data is None:
+            return self._image
+        image = Image.open(io.BytesIO(self._data))
+        image.load()
+        return image
+
+    @property
+    def data(self):
+        """Encoded bytes; an image built from pixels is encoded as PNG once, on first use."""
+        with self._lock:
+            if self._data is None:
+                self._data = encode_image(self._image, "PNG")
+                self.format = "PNG"
+            return self._data
+
+    @property
+    def size(self):
+        if self._image is not None:
+            return self._image.size
+        with Image.open(io.BytesIO(self._data)) as image:
+            return image.size  # header only, no pixel decoding
+
+    def encoded(self, image_format="PNG", quality=95):
+        """
+        (bytes, format) to send upstream when `image_format` is wanted. The original bytes are reused when they
+        are already in that format, or when PNG is asked for: re-encoding existing bytes losslessly only adds size.
+        """
+        if self._data is not None or image_format == "PNG":
+            data = self.data
+            if self.format == image_format or (image_format == "PNG" and self.format in EXTENSIONS):
+                return data, self.format
+        return encode_image(self.image, image_format, quality), image_format
+
+    @property
+    def extension(self):
+        return EXTENSIONS.get(self.format or "PNG", EXTENSIONS["PNG"])[0]
+
+    def save(self, path):
+        """Write to `path`, copying the bytes when the file extension matches their format."""
+        image_format = FORMATS_BY_EXTENSION.get(os.path.splitext(path)[1].lower(), "PNG")
+        if self.format == image_format or (self._data is None and image_format == "PNG"):
+            data = self.data
+        else:
+            data = encode_image(self.image, image_format, 95)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def as_encoded(image):
+    """Wrap a PIL image (or pass an EncodedImage through); None stays None."""
+    if image is None or isinstance(image, EncodedImage):
+        return image
+    return EncodedImage.from_image(image)
+
+
+def as_pil(image):
+    """PIL image for consumers that need pixels (Gradio); decodes an EncodedImage. Blocking."""
+    if isinstance(image, EncodedImage):
+        return image.image
+    return image
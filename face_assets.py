@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from metrics import count, span
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#CACHE DE CARAS SUBIDAS A REPLICATE
+#########################################################
+
+FACE_ASSETS_ENABLED = os.getenv("REPLICATE_FACE_ASSETS", "1") != "0"
+# Seconds an uploaded face is reused for; shortened to the file's own expires_at when Replicate sets one
+FACE_ASSET_TTL = float(os.getenv("REPLICATE_FACE_ASSET_TTL", str(6 * 3600)))
+FACE_ASSET_MAX_ENTRIES = int(os.getenv("REPLICATE_FACE_ASSET_ENTRIES", "1024"))
+EXPIRY_MARGIN = 300  # stop using a file this many seconds before Replicate deletes it
+
+
+def asset_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _expiry(expires_at, ttl):
+    deadline = time.time() + ttl
+    if expires_at:
+        try:
+            server_deadline = datetime.fromisoformat(expires_at.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return deadline
+        deadline = min(deadline, server_deadline - EXPIRY_MARGIN)
+    return deadline
+
+
+# Validation errors (400/422) only count as a missing upload when they are about the face file; any other invalid
+# input would fail the inline retry just the same
+MISSING_FILE_HINTS = ("main_face_image", "file not found", "file has expired", "could not download")
+
+
+def is_missing_asset(error, url=None):
+    """
+    True if a prediction failed because its input file (`url`, if known) could not be fetched (deleted or expired
+    upstream).
+    """
+    from replicate.exceptions import ModelError, ReplicateError
+    if isinstance(error, ReplicateError):
+        if error.status in (404, 410):
+            return True
+        if error.status not in (400, 422):
+            return False
+        message = f"{error.title or ''} {error.detail or ''}".lower()
+        return any(hint in message for hint in MISSING_FILE_HINTS) or bool(url and url.lower() in message)
+    if isinstance(error, ModelError):
+        message = str(getattr(error.prediction, "error", "") or "").lower()
+        return any(hint in message for hint in ("not found", "404", "410", "expired", "download"))
+    return False
+
+
+class FaceAssetCache:
+    """
+    Content hash of an encoded face -> URL of the copy uploaded to Replicate's files API, so a user
+    iterating on prompts with the same face uploads it once. Entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl=FACE_ASSET_TTL, max_entries=FACE_ASSET_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (url, expires)
+        self._uploads = {}  # key -> in-flight upload task
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        url, expires = entry
+        if time.time() >= expires:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return url
+
+    def put(self, key, url, expires):
+        self._entries[key] = (url, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    async def url_for(self, client, face):
+        """Hosted URL for `face` (a preprocess.PreparedFace), uploading it if it is not cached."""
+        key = asset_key(face.data)
+        url = self.get(key)
+        count("face_asset_lookups", backend="replicate", result="hit" if url else "miss")
+        if url is not None:
+            return url
+
+        # Candidates share a face: concurrent misses wait for a single upload
+        task = self._uploads.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._uploads[key] = asyncio.ensure_future(self._upload(client, key, face))
+            task.add_done_callback(lambda done, key=key: self._uploads.pop(key, None)
+                                   if self._uploads.get(key) is done else None)
+        return await asyncio.shield(task)
+
+    async def _upload(self, client, key, face):
+        upload = io.BytesIO(face.data)
+        upload.name = face.filename
+        with span("upload", "replicate"):
+            uploaded = await client.files.async_create(upload, content_type=face.content_type)
+        count("bytes_sent", len(face.data), backend="replicate")
+        url = uploaded.urls["get"]
+        self.put(key, url, _expiry(uploaded.expires_at, self.ttl))
+        logger.info(f"Uploaded face {key[:12]} to Replicate ({len(face.data) / 1024:.0f}KB)")
+        return url
+
+
+_face_assets = None
+
+
+def get_face_asset_cache():
+    """Process-wide face asset cache, or None when disabled with REPLICATE_FACE_ASSETS=0."""
+    global _face_assets
+    if not FACE_ASSETS_ENABLED:
+        return None
+    if _face_assets is None:
+        _face_assets = FaceAssetCache()
+    return _face_assets
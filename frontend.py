@@ -0,0 +1,156 @@
+import hashlib
+import hmac
+import os
+import secrets
+import gradio as gr
+
+import backends
+import job_queue
+import metrics
+import output_store
+import pipeline
+import warm_keeper
+from scheduler import SchedulerFull
+
+#########################################################
+#PIEZAS COMUNES DE LAS APPS GRADIO
+#########################################################
+
+# Results are handed to Gradio as paths in the output store: served as they are, never copied into Gradio's cache
+gr.set_static_paths([output_store.OUTPUT_DIR])
+
+
+# With JOB_QUEUE_ENABLED=1 jobs are run by `python worker.py` processes instead of inside the Gradio process
+stream_results = job_queue.stream_results if job_queue.JOB_QUEUE_ENABLED else pipeline.stream_results
+
+
+def admit(backend):
+    """Reject a request straight away when `backend` is saturated, and warn the user when the wait is long."""
+    warm_keeper.prewarm(backend)
+    try:
+        if job_queue.JOB_QUEUE_ENABLED:
+            job_queue.check_admission()
+            return
+        estimated_wait = backends.check_admission(backend)
+    except SchedulerFull as e:
+        raise gr.Error(str(e))
+    if estimated_wait >= 1:
+        gr.Info(f"High demand right now, estimated wait about {estimated_wait:.0f}s")
+
+
+# Key the anonymous per-browser history ids are signed with; generated once into SESSION_SECRET_FILE when unset
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+SESSION_SECRET_FILE = os.getenv("SESSION_SECRET_FILE", os.path.join(".cache", "session_secret"))
+
+_session_secret = None
+
+
+def session_secret():
+    global _session_secret
+    if _session_secret is None:
+        secret = SESSION_SECRET
+        if not secret:
+            try:
+                with open(SESSION_SECRET_FILE, encoding="utf-8") as f:
+                    secret = f.read().strip()
+            except OSError:
+                secret = None
+        if not secret:
+            secret = secrets.token_hex(32)
+            os.makedirs(os.path.dirname(SESSION_SECRET_FILE) or ".", exist_ok=True)
+            descriptor = os.open(SESSION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                f.write(secret)
+        _session_secret = secret.encode()
+    return _session_secret
+
+
+def _sign(token):
+    return hmac.new(session_secret(), token.encode(), hashlib.sha256).hexdigest()
+
+
+def new_session():
+    """A random per-browser id with its signature, kept in the browser's localStorage (see history_gallery)."""
+    token = secrets.token_urlsafe(16)
+    return f"{token}.{_sign(token)}"
+
+
+def session_user(session):
+    """History owner of a signed session id, or None when it is missing or was not issued by this server."""
+    if not isinstance(session, str) or "." not in session:
+        return None
+    token, signature = session.rsplit(".", 1)
+    return f"session-{token}" if hmac.compare_digest(signature, _sign(token)) else None
+
+
+def user_id(request, session=None):
+    """
+    Owner of a history: the login when auth is enabled, else the browser's signed session id. Client addresses
+    and forwarded headers are never used: they can be spoofed and are shared by everyone behind one NAT.
+    """
+    if request is not None and request.username:
+        return request.username
+    return session_user(session)
+
+
+def session_state():
+    """The browser's session id, for the apps' generate inputs and history_gallery."""
+    # BrowserState's secret is sent to the browser, so it must not be the signing key; it only has to outlive restarts
+    secret = hmac.new(session_secret(), b"browser-state", hashlib.sha256).hexdigest()
+    return gr.BrowserState(None, storage_key="pulid_session", secret=secret)
+
+
+def _history_items(request, session):
+    """(thumbnail file, image file, caption) for the user's stored outputs, newest first."""
+    user = user_id(request, session)
+    items = []
+    for entry in output_store.history(user) if user else []:
+        for output in entry["outputs"]:
+            thumbnail = os.path.join(output_store.OUTPUT_DIR, output.get("thumbnail") or output["image"])
+            image = os.path.join(output_store.OUTPUT_DIR, output["image"])
+            if os.path.exists(thumbnail) and os.path.exists(image):
+                items.append((thumbnail, image, entry["params"].get("prompt", "")))
+    return items
+
+
+def history(session, request: gr.Request):
+    return [(thumbnail, caption) for thumbnail, _, caption in _history_items(request, session)]
+
+
+def start_session(session, request: gr.Request):
+    """Issue a session id to a browser without a valid one, and show its history."""
+    if session_user(session) is None:
+        session = new_session()
+    return session, history(session, request)
+
+
+def open_history(evt: gr.SelectData, session, request: gr.Request):
+    items = _history_items(request, session)
+    return items[evt.index][1] if evt.index < len(items) else None
+
+
+def history_gallery(demo, generate_event, result_image, session):
+    """
+    The user's recent outputs as thumbnails, loaded with the page and refreshed after `generate_event`.
+    Selecting one shows the full image in `result_image`. `session` is the app's session_state().
+    """
+    with gr.Accordion("History", open=False):
+        gallery = gr.Gallery(label="Your recent images", columns=6, allow_preview=False)
+    demo.load(start_session, session, [session, gallery])
+    generate_event.then(history, session, gallery)
+    gallery.select(open_history, session, result_image)
+    return gallery
+
+
+def prewarm_on_upload(face_image, backend):
+    """Wake `backend`'s upstreams as soon as a face is uploaded, while the user is still writing the prompt."""
+    face_image.upload(lambda: warm_keeper.prewarm(backend), None, None, queue=False, show_progress="hidden")
+
+
+def launch(demo, **kwargs):
+    demo.show_api = False
+    # Concurrency is capped per upstream by the scheduler, not by Gradio's one-at-a-time default
+    demo.queue(default_concurrency_limit=None)
+    metrics.start_metrics_server()
+    warm_keeper.start()
+    demo.launch(**kwargs)
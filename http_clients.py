@@ -0,0 +1,131 @@
+import asyncio
+import json
+import os
+import random
+import httpx
+
+from circuit_breaker import retry_budget
+from metrics import count
+
+#########################################################
+#CLIENTES HTTP COMPARTIDOS POR BACKEND
+#########################################################
+
+# One long-lived client per upstream, so keep-alive connections and TLS
+# sessions are reused across jobs instead of being rebuilt on every call.
+MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "50"))
+# Defaults for every upstream call; long-running calls (StoryFace, HF streams) set their own read timeout
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+
+_clients = {}
+_replicate_clients = {}
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=60,
+    )
+
+
+def upstream_timeout(read):
+    """httpx timeout with the shared connect timeout and `read` seconds for everything else."""
+    return httpx.Timeout(read, connect=CONNECT_TIMEOUT)
+
+
+def get_client(backend):
+    """
+    Return the pooled async client for `backend` ("hf", "replicate", "storyface", ...).
+    Clients are bound to the running event loop, so a new one is built if the loop changes.
+    """
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(backend)
+    if entry is None or entry[0] is not loop or entry[1].is_closed:
+        client = httpx.AsyncClient(
+            limits=_limits(),
+            timeout=upstream_timeout(READ_TIMEOUT),
+            # No connect retries here: request_with_retries is the only retry layer, so every retry draws on the
+            # retry budget
+            transport=httpx.AsyncHTTPTransport(retries=0, limits=_limits()),
+            follow_redirects=True,
+        )
+        _clients[backend] = (loop, client)
+        return client
+    return entry[1]
+
+
+def get_replicate_client():
+    """Return the shared Replicate client (it keeps its own pooled httpx client internally)."""
+    loop = asyncio.get_running_loop()
+    entry = _replicate_clients.get("replicate")
+    if entry is None or entry[0] is not loop:
+        import replicate  # imported on first use: it pulls in pydantic models nothing else needs
+        client = replicate.Client(api_token=os.getenv("REPLICATE_API_TOKEN"), timeout=upstream_timeout(READ_TIMEOUT))
+        _replicate_clients["replicate"] = (loop, client)
+        return client
+    return entry[1]
+
+
+async def close_clients():
+    for loop, client in list(_clients.values()):
+        if loop is asyncio.get_running_loop() and not client.is_closed:
+            await client.aclose()
+    _clients.clear()
+    _replicate_clients.clear()
+
+
+async def request_with_retries(client, method, url, retries=2, backoff_factor=0.5,
+                               status_forcelist=(429, 500, 502, 503, 504), **kwargs):
+    """
+    Retry on connection errors and on the listed status codes. Retries are few, use jittered
+    exponential backoff (or the server's Retry-After) and are drawn from the process-wide retry budget,
+    so an overloaded upstream isn't hit by synchronised bursts of retries.
+    """
+    host = httpx.URL(url).host or "-"
+    retry_budget.record_request()
+    for attempt in range(retries + 1):
+        delay = backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5)
+        try:
+            response = await client.request(method, url, **kwargs)
+            if (response.status_code not in status_forcelist or attempt == retries
+                    or not retry_budget.try_retry(host)):
+                return response
+            retry_after = response.headers.get("retry-after", "")
+            if retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        except httpx.TimeoutException:
+            count("timeouts", stage="request", backend=host)
+            if attempt == retries or not retry_budget.try_retry(host):
+                raise
+        except httpx.TransportError:
+            if attempt == retries or not retry_budget.try_retry(host):
+                raise
+        count("retries", stage="request", backend=host)
+        await asyncio.sleep(delay)
+
+
+async def iter_sse(response):
+    """Yield (event, data) pairs from a text/event-stream response; JSON data is decoded when possible."""
+    event, data_lines = "message", []
+    async for line in response.aiter_lines():
+        if not line:
+            if data_lines:
+                raw = "\n".join(data_lines)
+                try:
+                    data = json.loads(raw)
+                except json.JSONDecodeError:
+                    data = raw
+                yield event, data
+            event, data_lines = "message", []
+        elif line.startswith(":"):
+            continue  # comment / keep-alive
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event = value
+            elif field == "data":
+                data_lines.append(value)
@@ -0,0 +1,298 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing, contextmanager
+
+import output_store
+from metrics import count, trace_id
+from preprocess import encode_image
+from scheduler import INTERACTIVE, SchedulerFull, current_priority
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#COLA DE TRABAJOS PERSISTENTE (SQLITE, SIN BROKER)
+#########################################################
+
+# When enabled the Gradio apps only enqueue jobs; `python worker.py` processes run them
+JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE_ENABLED", "0") == "1"
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", os.path.join(".cache", "jobs.sqlite3"))
+# A worker holds a job for this long and renews the lease while it runs; an expired lease means the worker died
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Runs of a job (first one included) before a job whose workers keep dying is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Jobs waiting for a worker before new ones are refused
+JOB_QUEUE_MAX_PENDING = int(os.getenv("JOB_QUEUE_MAX_PENDING", "256"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+# Finished jobs are deleted from the database after this many seconds (their images stay in the output store)
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 86400)))
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    request TEXT NOT NULL,
+    face BLOB,
+    trace_id TEXT,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority, created_at);
+"""
+
+_initialized = set()
+
+
+@contextmanager
+def connect(path=None):
+    """
+    A connection in autocommit mode (transactions are opened explicitly). Every call opens its own, so it
+    can be used from any thread or process; WAL lets the UI read while workers write.
+    """
+    path = path or JOB_QUEUE_DB
+    if path not in _initialized:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with closing(sqlite3.connect(path, timeout=30, isolation_level=None)) as connection:
+        connection.row_factory = sqlite3.Row
+        if path not in _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            _initialized.add(path)
+        yield connection
+
+
+def _job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["request"] = json.loads(job["request"])
+    job["result"] = json.loads(job["result"]) if job["result"] else {"candidates": {}}
+    return job
+
+#########################################################
+#OPERACIONES SOBRE LA COLA (BLOQUEANTES)
+#########################################################
+
+def enqueue(face_bytes, request, priority=INTERACTIVE, trace=None):
+    """
+    Store a job and return its id. `request` holds the process_stream arguments: params, quality,
+    face_refinement_steps, num_candidates, backend, strategy, adaptive, plus the user whose history gets it.
+    """
+    job_id = uuid.uuid4().hex
+    with connect() as connection:
+        connection.execute(
+            "INSERT INTO jobs (id, status, priority, request, face, trace_id, message, created_at) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, 'Queued', ?)",
+            (job_id, priority, json.dumps(request), face_bytes, trace, time.time()),
+        )
+    count("queue_jobs", event="enqueued")
+    return job_id
+
+
+def claim(worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Take the next job for `worker_id`: the oldest queued one of the most urgent priority, or one whose worker
+    let its lease expire (crashed). Returns the job with its face bytes, or None when there is nothing to do.
+    """
+    now = time.time()
+    with connect() as connection:
+        connection.execute("BEGIN IMMEDIATE")  # one writer at a time, so two workers never claim the same job
+        try:
+            while True:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires_at < ?) "
+                    "ORDER BY priority, created_at LIMIT 1", (now,)
+                ).fetchone()
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None
+                if row["status"] == "running":
+                    logger.warning(f"Job {row['id']} lost its worker {row['lease_owner']} "
+                                   f"(attempt {row['attempts']}/{JOB_MAX_ATTEMPTS})")
+                    count("queue_jobs", event="lease_expired")
+                    if row["attempts"] >= JOB_MAX_ATTEMPTS:
+                        connection.execute(
+                            "UPDATE jobs SET status = 'failed', message = 'Generation failed', error = ?, face = NULL, "
+                            "lease_owner = NULL, finished_at = ? WHERE id = ?",
+                            (f"worker died {row['attempts']} times while running it", now, row["id"]),
+                        )
+                        count("queue_jobs", event="failed")
+                        continue
+                    if row["cancel_requested"]:
+                        connection.execute(
+                            "UPDATE jobs SET status = 'canceled', message = 'Canceled', face = NULL, "
+                            "lease_owner = NULL, finished_at = ? WHERE id = ?", (now, row["id"]),
+                        )
+                        continue
+                # A retried job starts over: images from the lost run stay in the store but are not reported
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires_at = ?, "
+                    "attempts = attempts + 1, started_at = ?, message = 'Generating image', result = NULL "
+                    "WHERE id = ?",
+                    (worker_id, now + lease_seconds, now, row["id"]),
+                )
+                connection.execute("COMMIT")
+                job = _job(row)
+                job["attempts"] += 1
+                return job
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+
+def heartbeat(job_id, worker_id, result=None, message=None, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Renew `worker_id`'s lease on a running job, saving its progress when given.
+    Returns "ok", "cancel" when someone asked to cancel it, or "lost" when the lease went to another worker.
+    """
+    with connect() as connection:
+        cursor = connection.execute(
+            "UPDATE jobs SET lease_expires_at = ?, result = COALESCE(?, result), message = COALESCE(?, message) "
+            "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (time.time() + lease_seconds, json.dumps(result) if result is not None else None, message,
+             job_id, worker_id),
+        )
+        if not cursor.rowcount:
+            return "lost"
+        row = connection.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return "cancel" if row["cancel_requested"] else "ok"
+
+
+def finish(job_id, worker_id, status, result=None, message=None, error=None):
+    """Record the outcome of a job (`status` one of TERMINAL_STATUSES) if `worker_id` still holds it."""
+    with connect() as connection:
+        cursor = connection.execute(
+            "UPDATE jobs SET status = ?, result = COALESCE(?, result), message = ?, error = ?, face = NULL, "
+            "lease_owner = NULL, finished_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (status, json.dumps(result) if result is not None else None, message, error, time.time(),
+             job_id, worker_id),
+        )
+    if cursor.rowcount:
+        count("queue_jobs", event=status)
+    return bool(cursor.rowcount)
+
+
+def release(job_id, worker_id):
+    """Put a job back in the queue without counting the attempt (its worker is shutting down cleanly)."""
+    with connect() as connection:
+        connection.execute(
+            "UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL, attempts = attempts - 1, "
+            "message = 'Queued', result = NULL WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (job_id, worker_id),
+        )
+
+
+def cancel(job_id):
+    """Cancel a job: straight away while queued, else its worker stops it at the next heartbeat."""
+    with connect() as connection:
+        connection.execute(
+            "UPDATE jobs SET status = 'canceled', message = 'Canceled', face = NULL, finished_at = ? "
+            "WHERE id = ? AND status = 'queued'", (time.time(), job_id),
+        )
+        connection.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+
+
+def get(job_id):
+    """The job without its face bytes, or None."""
+    with connect() as connection:
+        row = connection.execute(
+            "SELECT id, status, priority, request, trace_id, message, result, error, attempts, lease_owner, "
+            "lease_expires_at, cancel_requested, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+    return _job(row)
+
+
+def pending():
+    """Jobs waiting for a worker, ahead of any new one."""
+    with connect() as connection:
+        return connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+
+def prune(max_age=JOB_RETENTION):
+    """Delete jobs that finished more than `max_age` seconds ago."""
+    with connect() as connection:
+        cursor = connection.execute("DELETE FROM jobs WHERE finished_at < ?", (time.time() - max_age,))
+    return cursor.rowcount
+
+
+def check_admission():
+    """Refuse a new job when JOB_QUEUE_MAX_PENDING jobs are already waiting (raises SchedulerFull)."""
+    waiting = pending()
+    if waiting >= JOB_QUEUE_MAX_PENDING:
+        count("rejections", backend="queue")
+        raise SchedulerFull("queue", waiting * JOB_POLL_INTERVAL)
+
+#########################################################
+#LADO DE LA UI: ENCOLAR Y LEER LOS RESULTADOS
+#########################################################
+
+async def stream_results(face_image, params, quality=100, face_refinement_steps=1, num_candidates=1,
+                         backend="replicate", strategy="num_outputs", on_event=None, adaptive=None, user=None):
+    """
+    Queued counterpart of pipeline.stream_results, with the same arguments and yields: the job is stored in the
+    queue, a worker process runs it, and each stage is read back from the database as the worker reports it.
+    HF progress events stay in the worker (`on_event` is not called). Cancelling the caller cancels the job.
+    """
+    start_time = time.monotonic()
+    face_bytes = await asyncio.to_thread(encode_image, face_image, "PNG")
+    request = {"params": params, "quality": quality, "face_refinement_steps": face_refinement_steps,
+               "num_candidates": num_candidates, "backend": backend, "strategy": strategy, "adaptive": adaptive,
+               "user": user}
+    job_id = await asyncio.to_thread(enqueue, face_bytes, request, current_priority.get(), trace_id.get())
+    logger.info(f"Queued job {job_id}")
+
+    seen = None
+    try:
+        while True:
+            job = await asyncio.to_thread(get, job_id)
+            if job is None:
+                yield None, None, [], "Job lost"
+                return
+            state = (job["status"], job["message"], json.dumps(job["result"], sort_keys=True))
+            if state != seen:
+                seen = state
+                pulid_flux_result, storyface_result, gallery = _files(job["result"])
+                if job["status"] == "succeeded":
+                    yield (pulid_flux_result, storyface_result or pulid_flux_result, gallery,
+                           f"Done in {time.monotonic() - start_time:.1f}s")
+                    return
+                if job["status"] in TERMINAL_STATUSES:
+                    yield None, None, [], job["message"] or "Generation failed"
+                    return
+                status = job["message"] or "Queued"
+                yield pulid_flux_result, storyface_result, gallery, f"{status} ({time.monotonic() - start_time:.1f}s)"
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    except (asyncio.CancelledError, GeneratorExit):
+        await asyncio.shield(asyncio.to_thread(cancel, job_id))
+        raise
+
+
+def _files(result):
+    """(generated, refined, gallery) of candidate 0 and every candidate, as files in the output store."""
+    candidates = result.get("candidates", {})
+    files = {int(index): candidate for index, candidate in candidates.items()}
+    latest = {index: os.path.join(output_store.OUTPUT_DIR, candidate["refined"] or candidate["generated"])
+              for index, candidate in files.items()}
+    gallery = [(latest[index], f"Candidate {index + 1}") for index in sorted(latest)]
+    first = files.get(0)
+    if first is None:
+        return None, None, gallery
+    generated = os.path.join(output_store.OUTPUT_DIR, first["generated"])
+    refined = os.path.join(output_store.OUTPUT_DIR, first["refined"]) if first["refined"] else None
+    return generated, refined, gallery
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from scheduler import DEFAULT_SERVICE_TIME
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#MODELO DE LATENCIA APRENDIDO DE EJECUCIONES ANTERIORES
+#########################################################
+
+# Finished upstream calls are appended here and reloaded on start, so predictions survive restarts
+LATENCY_HISTORY_FILE = os.getenv("LATENCY_HISTORY_FILE", os.path.join(".cache", "latency_runs.jsonl"))
+# Most recent runs kept per (backend, stage)
+LATENCY_HISTORY_SIZE = int(os.getenv("LATENCY_HISTORY_SIZE", "500"))
+# Below this many runs predictions are scaled priors and timeouts keep their fixed defaults
+LATENCY_MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", "8"))
+# Timeout = prediction x the p99 of observed/predicted x this margin, within the bounds below
+LATENCY_TIMEOUT_MARGIN = float(os.getenv("LATENCY_TIMEOUT_MARGIN", "1.5"))
+LATENCY_MIN_TIMEOUT = float(os.getenv("LATENCY_MIN_TIMEOUT", "30"))
+LATENCY_MAX_TIMEOUT = float(os.getenv("LATENCY_MAX_TIMEOUT", "1800"))
+RIDGE = 1e-3
+
+# Work of a default job (896x1152, 20 steps), which DEFAULT_SERVICE_TIME is measured against
+REFERENCE_MEGAPIXELS = 896 * 1152 / 1e6
+REFERENCE_STEPS = 20
+
+
+def features(stage, params):
+    """
+    Regression inputs of one upstream call. Generation cost grows with pixels x steps, plus a per-step and a
+    text-encoder term; a StoryFace swap only depends on the size of the image it gets.
+    """
+    megapixels = float(params.get("width", 896)) * float(params.get("height", 1152)) / 1e6
+    if stage == "swap":
+        return [1.0, megapixels]
+    steps = float(params.get("num_steps", REFERENCE_STEPS))
+    return [1.0, megapixels * steps, steps, float(params.get("max_sequence_length", 128)) / 128]
+
+
+def prior(backend, stage, params):
+    """Guess before any run is recorded: the scheduler's default service time, half of it scaled by the work."""
+    base = DEFAULT_SERVICE_TIME.get(backend, 30.0)
+    megapixels = float(params.get("width", 896)) * float(params.get("height", 1152)) / 1e6
+    work = megapixels / REFERENCE_MEGAPIXELS
+    if stage != "swap":
+        work *= float(params.get("num_steps", REFERENCE_STEPS)) / REFERENCE_STEPS
+    return base * (0.5 + 0.5 * work)
+
+
+def solve(matrix, vector):
+    """Gaussian elimination with partial pivoting for the small normal equations below."""
+    size = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        if abs(rows[column][column]) < 1e-12:
+            return None
+        for row in range(column + 1, size):
+            factor = rows[row][column] / rows[column][column]
+            for k in range(column, size + 1):
+                rows[row][k] -= factor * rows[column][k]
+    solution = [0.0] * size
+    for row in reversed(range(size)):
+        known = sum(rows[row][k] * solution[k] for k in range(row + 1, size))
+        solution[row] = (rows[row][size] - known) / rows[row][row]
+    return solution
+
+
+class Fit:
+    """Least-squares weights for one (backend, stage), with the spread of observed/predicted for timeouts."""
+
+    def __init__(self, stage, samples):
+        xs = [features(stage, params) for params, _ in samples]
+        ys = [y for _, y in samples]
+        size = len(xs[0])
+        # Ridge on everything but the intercept keeps a few near-identical runs from producing wild slopes
+        matrix = [[sum(x[i] * x[j] for x in xs) + (RIDGE * len(xs) if i == j and i else 0) for j in range(size)]
+                  for i in range(size)]
+        self.weights = solve(matrix, [sum(x[i] * y for x, y in zip(xs, ys)) for i in range(size)])
+        self.floor = min(ys) / 2
+        ratios = sorted(y / self.predict(x) for x, y in zip(xs, ys))
+        self.spread = ratios[min(len(ratios) - 1, int(0.99 * len(ratios)))]
+
+    def predict(self, x):
+        if self.weights is None:
+            return self.floor * 2
+        return max(self.floor, sum(w * v for w, v in zip(self.weights, x)))
+
+
+class LatencyModel:
+    """
+    Per-stage latency of each upstream learned from recorded runs: a linear model over width x height,
+    num_steps and max_sequence_length per (backend, stage), refitted lazily after new runs.
+    Stages are "generate" (one PuLID-FLUX image on a backend) and "swap" (one StoryFace pass).
+    """
+
+    def __init__(self, path=LATENCY_HISTORY_FILE, size=LATENCY_HISTORY_SIZE):
+        self.path = path
+        self.size = size
+        self._samples = {}
+        self._lines = {}  # (backend, stage) -> the history file lines behind _samples, rewritten on compaction
+        self._file_lines = 0
+        self._fits = {}
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._loading = False
+
+    def load(self):
+        """Read the history file once, compacting it to `size` runs per (backend, stage). Blocking."""
+        with self._load_lock:
+            if self._loaded:
+                return
+            read = 0
+            runs = {}
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    for line in f:
+                        read += 1
+                        try:
+                            run = json.loads(line)
+                            runs.setdefault((run["backend"], run["stage"]), deque(maxlen=self.size)).append(
+                                (run["params"], run["seconds"], line.strip()))
+                        except (json.JSONDecodeError, KeyError, TypeError):
+                            continue  # a line cut short by a killed process
+            except OSError:
+                pass
+            with self._lock:
+                for (backend, stage), kept_runs in runs.items():
+                    for params, seconds, line in kept_runs:
+                        self._add(backend, stage, params, seconds, line)
+                self._loaded = True
+                kept = self._file_lines = sum(map(len, self._lines.values()))
+                lines = self._snapshot() if read > kept else None
+            if lines is not None:
+                with self._file_lock:
+                    self._rewrite(lines)
+            if read:
+                logger.info(f"Loaded {kept} latency samples from {self.path}")
+
+    def _load_in_background(self):
+        """Start loading the history from a thread, so a prediction made on the event loop never reads the file."""
+        if self._loaded or self._loading:
+            return
+        self._loading = True
+        threading.Thread(target=self.load, name="latency-history", daemon=True).start()
+
+    def _add(self, backend, stage, params, seconds, line):
+        samples = self._samples.setdefault((backend, stage), deque(maxlen=self.size))
+        samples.append((params, seconds))
+        self._lines.setdefault((backend, stage), deque(maxlen=self.size)).append(line)
+        self._fits.pop((backend, stage), None)
+
+    def _snapshot(self):
+        """Lines of the runs still kept, oldest first within each (backend, stage). Call with the lock held."""
+        return [line for lines in self._lines.values() for line in lines]
+
+    def _rewrite(self, lines):
+        """Replace the history file with `lines`. Call with the file lock held."""
+        # Runs another process appended since this one loaded are dropped, which only costs a few samples
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in lines)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not compact the latency history: {e}")
+
+    def record(self, backend, stage, params, seconds):
+        """
+        Add a successful call that took `seconds` and append it to the history file, which is compacted
+        once it holds twice the runs still kept. Blocking.
+        """
+        params = {key: params[key] for key in ("width", "height", "num_steps", "max_sequence_length")
+                  if key in params}
+        line = json.dumps({"time": time.time(), "backend": backend, "stage": stage, "params": params,
+                           "seconds": round(seconds, 3)})
+        self.load()
+        with self._file_lock:
+            with self._lock:
+                self._add(backend, stage, params, seconds, line)
+                self._file_lines += 1
+                kept = sum(map(len, self._lines.values()))
+                lines = self._snapshot() if self._file_lines > 2 * kept else None
+                if lines is not None:
+                    self._file_lines = kept
+            if lines is not None:
+                self._rewrite(lines)
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                logger.warning(f"Could not record latency sample: {e}")
+
+    async def record_async(self, backend, stage, params, seconds):
+        await asyncio.to_thread(self.record, backend, stage, params, seconds)
+
+    def _fit(self, backend, stage):
+        """
+        Current fit for (backend, stage), or None while there are too few runs (or the history is still
+        loading). Call with the lock held.
+        """
+        self._load_in_background()
+        samples = self._samples.get((backend, stage), ())
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        fit = self._fits.get((backend, stage))
+        if fit is None:
+            fit = self._fits[(backend, stage)] = Fit(stage, list(samples))
+        return fit
+
+    def predict(self, backend, stage, params):
+        """Expected seconds of one `stage` call on `backend` for `params`."""
+        with self._lock:
+            fit = self._fit(backend, stage)
+            samples = self._samples.get((backend, stage), ())
+            if fit is not None:
+                return fit.predict(features(stage, params))
+            guess = prior(backend, stage, params)
+            if samples:
+                # Too few runs for a regression: scale the prior by how far off it has been so far
+                ratios = sorted(seconds / prior(backend, stage, run) for run, seconds in samples)
+                guess *= ratios[len(ratios) // 2]
+            return guess
+
+    def timeout(self, backend, stage, params, default, repeat=1):
+        """
+        Deadline for `repeat` back-to-back calls: `default` until the model has enough runs,
+        then the prediction stretched by its p99 overrun so far and LATENCY_TIMEOUT_MARGIN.
+        """
+        with self._lock:
+            fit = self._fit(backend, stage)
+            if fit is None:
+                return default
+            seconds = fit.predict(features(stage, params)) * max(1.0, fit.spread) * LATENCY_TIMEOUT_MARGIN
+        return min(LATENCY_MAX_TIMEOUT, max(LATENCY_MIN_TIMEOUT, seconds)) * repeat
+
+
+latency_model = LatencyModel()
+
+
+class Estimate:
+    """Predicted seconds of one job: waiting for a local slot, generating, and each StoryFace pass."""
+
+    def __init__(self, queue, generate, swap, refinement_steps):
+        self.queue = queue
+        self.generate = generate
+        self.swap = swap
+        self.refinement_steps = refinement_steps
+
+    @property
+    def total(self):
+        return self.queue + self.generate + self.refinement_steps * self.swap
+
+    def remaining(self, stage=None, elapsed=0.0):
+        """
+        Seconds left once `stage` ("generation", "refinement_step_N", None before either) has finished,
+        `elapsed` seconds ago. Never below zero, even when the job runs late.
+        """
+        if stage is None:
+            left = self.total
+        elif stage == "generation":
+            left = self.refinement_steps * self.swap
+        else:
+            left = max(0, self.refinement_steps - int(stage.rsplit("_", 1)[1])) * self.swap
+        return max(0.0, left - elapsed)
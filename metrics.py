@@ -0,0 +1,187 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#########################################################
+#METRICAS DE LATENCIA POR ETAPA (FORMATO PROMETHEUS)
+#########################################################
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Bucket bounds in seconds, from PNG encoding (ms) up to slow HF queue waits (minutes)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+QUANTILES = (0.5, 0.95, 0.99)
+RESERVOIR_SIZE = 1024
+
+trace_id = contextvars.ContextVar("trace_id", default="-")
+# Per-request usage record (see usage_log.py) that also receives every observation and counter of the request
+usage = contextvars.ContextVar("usage", default=None)
+
+
+class Histogram:
+    """Cumulative Prometheus buckets plus a window of recent samples for p50/p95/p99."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+        self.total += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return float("nan")
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, backend, seconds):
+        with self._lock:
+            histogram = self.histograms.get((stage, backend))
+            if histogram is None:
+                histogram = self.histograms[(stage, backend)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = [
+            "# HELP pulid_stage_seconds Duration of each pipeline stage.",
+            "# TYPE pulid_stage_seconds histogram",
+        ]
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            for (stage, backend), histogram in histograms:
+                labels = f'stage="{stage}",backend="{backend}"'
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    lines.append(f'pulid_stage_seconds_bucket{{{labels},le="{bound:g}"}} {count}')
+                lines.append(f'pulid_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"pulid_stage_seconds_sum{{{labels}}} {histogram.total:.6f}")
+                lines.append(f"pulid_stage_seconds_count{{{labels}}} {histogram.count}")
+
+            lines += [
+                "# HELP pulid_stage_latency_seconds Recent stage latency percentiles.",
+                "# TYPE pulid_stage_latency_seconds summary",
+            ]
+            for (stage, backend), histogram in histograms:
+                labels = f'stage="{stage}",backend="{backend}"'
+                for q in QUANTILES:
+                    lines.append(f'pulid_stage_latency_seconds{{{labels},quantile="{q:g}"}} {histogram.quantile(q):.6f}')
+
+            for name in sorted({name for (name, _), _ in counters}):
+                lines.append(f"# TYPE pulid_{name}_total counter")
+                for (counter_name, labels), value in counters:
+                    if counter_name == name:
+                        rendered = ",".join(f'{key}="{label}"' for key, label in labels)
+                        lines.append(f"pulid_{name}_total{{{rendered}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def observe(stage, backend, seconds):
+    registry.observe(stage, backend, seconds)
+    record = usage.get()
+    if record is not None:
+        record.observe(stage, seconds)
+
+
+def count(name, amount=1, **labels):
+    """Increment counter `name` (errors, retries, timeouts, ...) with the given labels."""
+    registry.increment(name, amount, **labels)
+    record = usage.get()
+    if record is not None:
+        record.count(name, amount)
+
+
+@contextmanager
+def span(stage, backend="-"):
+    """Time the enclosed block (sync or inside a coroutine) as `stage` on `backend`; exceptions count as errors."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count("errors", stage=stage, backend=backend)
+        raise
+    finally:
+        observe(stage, backend, time.perf_counter() - start_time)
+
+#########################################################
+#TRACE ID POR PETICION EN LOS LOGS
+#########################################################
+
+def new_trace():
+    """Start a trace for the current request; tasks spawned from here inherit it."""
+    value = uuid.uuid4().hex[:12]
+    trace_id.set(value)
+    return value
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id.get()
+        return True
+
+
+def install_trace_logging():
+    """Add the trace id to every record handled by the root logger's handlers (use %(trace_id)s in formats)."""
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, TraceIdFilter) for f in handler.filters):
+            handler.addFilter(TraceIdFilter())
+
+#########################################################
+#ENDPOINT DE SCRAPE
+#########################################################
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep scrapes out of the logs
+
+
+_server = None
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics from a daemon thread (idempotent). Set METRICS_PORT=0 to disable."""
+    global _server
+    if _server is None and port:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server
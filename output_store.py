@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from PIL import Image
+
+from preprocess import encode_image
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#ALMACEN DE RESULTADOS EN DISCO (DIRECCIONADO POR CONTENIDO)
+#########################################################
+
+# Served as static files: by nginx in production, by the Gradio app / API otherwise
+OUTPUT_DIR = os.path.abspath(os.getenv("OUTPUT_STORE_DIR", "outputs"))
+# Public base URL of OUTPUT_DIR when nginx serves it (e.g. https://example.com/outputs); used by the API
+OUTPUT_PUBLIC_URL = os.getenv("OUTPUT_PUBLIC_URL", "").rstrip("/")
+# Kept outside OUTPUT_DIR so user histories are never served
+HISTORY_DIR = os.getenv("OUTPUT_HISTORY_DIR", os.path.join(".cache", "history"))
+THUMBNAIL_SIZE = int(os.getenv("OUTPUT_THUMBNAIL_SIZE", "256"))
+HISTORY_LIMIT = int(os.getenv("OUTPUT_HISTORY_LIMIT", "48"))
+
+
+class StoredOutput:
+    """An image in the store; `path` and `thumbnail` are relative to OUTPUT_DIR."""
+
+    def __init__(self, key, path, thumbnail=None):
+        self.key = key
+        self.path = path
+        self.thumbnail = thumbnail
+
+    @property
+    def file(self):
+        return os.path.join(OUTPUT_DIR, self.path)
+
+    @property
+    def thumbnail_file(self):
+        return os.path.join(OUTPUT_DIR, self.thumbnail) if self.thumbnail else None
+
+
+def _write_once(path, data):
+    """Atomic write that skips files already present (same name means same content)."""
+    if os.path.exists(path):
+        os.utime(path)  # keeps a reused output from being pruned as old
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def make_thumbnail(image, size=THUMBNAIL_SIZE):
+    """WEBP thumbnail bytes of an EncodedImage, from a throwaway decode."""
+    thumbnail = image.open().convert("RGB")  # convert copies, so a cached decode is left untouched
+    thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+    return encode_image(thumbnail, "WEBP", 80)
+
+
+def put(image, thumbnail=False):
+    """Store an EncodedImage under the hash of its bytes (written once) and optionally its thumbnail. Blocking."""
+    data = image.data
+    key = hashlib.sha256(data).hexdigest()
+    path = os.path.join(key[:2], f"{key}.{image.extension}")
+    if _write_once(os.path.join(OUTPUT_DIR, path), data):
+        logger.debug(f"Stored output {path} ({len(data) / 1024:.0f}KB)")
+    thumbnail_path = None
+    if thumbnail:
+        thumbnail_path = os.path.join(key[:2], f"{key}.thumb.webp")
+        thumbnail_file = os.path.join(OUTPUT_DIR, thumbnail_path)
+        if os.path.exists(thumbnail_file):
+            os.utime(thumbnail_file)
+        else:
+            _write_once(thumbnail_file, make_thumbnail(image))
+    return StoredOutput(key, path, thumbnail_path)
+
+
+async def put_async(image, thumbnail=False):
+    return await asyncio.to_thread(put, image, thumbnail)
+
+
+def url_for(path, base_url=None):
+    """Public URL of a stored file: OUTPUT_PUBLIC_URL when nginx serves the store, else under `base_url`."""
+    return f"{OUTPUT_PUBLIC_URL or base_url}/{path}" if path else None
+
+#########################################################
+#HISTORIAL POR USUARIO
+#########################################################
+
+def _history_file(user):
+    return os.path.join(HISTORY_DIR, f"{hashlib.sha256(user.encode()).hexdigest()[:24]}.jsonl")
+
+
+def record(user, entry):
+    """Append a finished generation ({"outputs": [...], "params": ..., ...}) to `user`'s history. Blocking."""
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with open(_history_file(user), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"created_at": time.time(), **entry}) + "\n")
+
+
+def history(user, limit=HISTORY_LIMIT):
+    """`user`'s latest generations, newest first. A truncated last line (killed process) is skipped. Blocking."""
+    try:
+        with open(_history_file(user), encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    entries = []
+    for line in reversed(lines):
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+        if len(entries) >= limit:
+            break
+    return entries
+
+
+def prune(max_age_days):
+    """Delete stored files not modified for `max_age_days`. History entries pointing at them are left as they are."""
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for root, _, files in os.walk(OUTPUT_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the output store")
+    parser.add_argument("--prune-days", type=float, required=True, help="Delete outputs older than this many days")
+    args = parser.parse_args()
+    print(f"Removed {prune(args.prune_days)} files from {OUTPUT_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,867 @@
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import time
+import httpx
+from PIL import Image
+from dotenv import load_dotenv
+
+import backends
+import output_store
+import replicate_webhooks
+import usage_log
+import warm_keeper
+from circuit_breaker import CircuitOpen, get_breaker, retry_budget
+from encoded_image import EncodedImage, as_encoded
+from face_assets import asset_key, get_face_asset_cache, is_missing_asset
+from http_clients import get_client, get_replicate_client, iter_sse, request_with_retries, upstream_timeout
+from latency_model import latency_model
+from metrics import count, new_trace, observe, span, trace_id, usage
+from preprocess import EXTENSIONS, face_fingerprint, prepare_face, transfer_format
+from result_cache import cache_key, get_result_cache
+from scheduler import scheduler
+from single_flight import SINGLE_FLIGHT_ENABLED, jobs_in_flight
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+HF_SPACE_URL = os.getenv("HF_SPACE_URL", "https://yanze-pulid-flux.hf.space")
+# Poll interval bounds (seconds) for when the Space does not stream events
+HF_MIN_POLL_INTERVAL = float(os.getenv("HF_MIN_POLL_INTERVAL", "0.5"))
+HF_MAX_POLL_INTERVAL = float(os.getenv("HF_MAX_POLL_INTERVAL", "10"))
+HF_STREAM_READ_TIMEOUT = 60.0  # the Space sends heartbeats well within this
+# Consecutive failed polls of a HF job before giving up on it (each retry also draws on the retry budget)
+HF_MAX_POLL_ERRORS = int(os.getenv("HF_MAX_POLL_ERRORS", "5"))
+# Upper bound for a whole Replicate prediction, queueing included, until the latency model has learned one
+REPLICATE_PREDICTION_TIMEOUT = float(os.getenv("REPLICATE_PREDICTION_TIMEOUT", "600"))
+# Read timeout of one StoryFace swap until the latency model has learned one; a hung server fails the step
+# instead of pinning a worker
+STORYFACE_TIMEOUT = float(os.getenv("STORYFACE_TIMEOUT", "120"))
+# Adaptive refinement stops once a StoryFace pass changes the image by less than this
+# (mean absolute difference of 64px thumbnails, 0-1 scale)
+ADAPTIVE_REFINEMENT = os.getenv("ADAPTIVE_REFINEMENT", "0") == "1"
+REFINEMENT_CONVERGENCE_THRESHOLD = float(os.getenv("REFINEMENT_CONVERGENCE_THRESHOLD", "0.005"))
+CONVERGENCE_SIZE = 64
+REPLICATE_MODEL = "zsxkib/flux-pulid:8baa7ef2255075b46f4d91cd238c21d31181b3e6a864463f967960bb0112525b"
+
+# Generation parameters shared by every backend (the values show_app.py hard-codes)
+DEFAULT_PARAMS = {
+    "prompt": "portrait, color, cinematic",
+    "width": 896,
+    "height": 1152,
+    "num_steps": 20,
+    "neg_prompt": "bad quality, worst quality, text, signature, watermark, extra limbs",
+    "max_sequence_length": 128,
+    "id_weight": 1,
+    "start_step": 1,
+    "guidance_scale": 4,
+    "seed": -1,
+    "true_cfg": 1,
+    "timestep_to_start_cfg": 1,
+}
+
+
+def face_upload(face_bytes, filename="face.png"):
+    """
+    In-memory file object for a Replicate file input. The client uploads it straight from memory,
+    so nothing is written to disk and there is no file handle to leak.
+    """
+    upload = io.BytesIO(face_bytes)
+    upload.name = filename  # used by the client for the upload filename and content type
+    return upload
+
+
+def parse_seed(seed):
+    try:
+        return int(seed)
+    except (TypeError, ValueError):
+        return -1  # Default to -1 if conversion fails
+
+#########################################################
+#LLAMADA A FLUX PULL-ID EN EL HF SPACE
+#########################################################
+
+async def generate_image_pulid_flux_hf(prompt, id_image, width, height, num_steps, neg_prompt, max_sequence_length,
+                                       id_weight=1, start_step=0, guidance_scale=4, seed=-1, true_cfg=1,
+                                       timestep_to_start_cfg=1, on_event=None):
+    face = await prepare_face(id_image, "hf")
+    base64_image = base64.b64encode(face.data).decode('utf-8')
+
+    payload = {
+        "data": [
+            prompt,
+            base64_image,
+            start_step,
+            guidance_scale,
+            str(parse_seed(seed)),
+            true_cfg,
+            width,
+            height,
+            num_steps,
+            id_weight,
+            neg_prompt,
+            timestep_to_start_cfg,
+            max_sequence_length
+        ]
+    }
+
+    # Deadline and poll pacing come from past runs at this size and step count (the Space's queue included);
+    # with too few runs the deadline is 5 minutes, or 10 seconds per step when that is longer. A Space that has
+    # probably gone to sleep also gets the time it takes to wake up.
+    size = {"width": width, "height": height, "num_steps": num_steps, "max_sequence_length": max_sequence_length}
+    timeout = latency_model.timeout("hf", "generate", size, max(300, num_steps * 10))
+    timeout += warm_keeper.cold_penalty("hf")
+    expected_duration = latency_model.predict("hf", "generate", size)
+
+    # With a fixed seed the output is fully determined by the payload
+    cache = get_result_cache()
+    key = cache_key("hf", params=payload) if cache is not None and parse_seed(seed) != -1 else None
+    if key is not None:
+        cached = await cache.get_async(key)
+        count("cache_lookups", stage="generate", backend="hf", result="hit" if cached else "miss")
+        if cached is not None:
+            return EncodedImage.from_bytes(cached)
+
+    client = get_client("hf")
+
+    try:
+        logger.info(f"Starting image generation with a timeout of {timeout:.0f} seconds...")
+        # Initiate the job
+        with span("submit", "hf"):
+            response = await request_with_retries(
+                client, "POST", f"{HF_SPACE_URL}/call/generate_image", json=payload, timeout=30
+            )
+            response.raise_for_status()
+        count("bytes_sent", len(base64_image), backend="hf")
+        event_id = response.json()
+        if isinstance(event_id, dict):
+            event_id = event_id.get("event_id")
+
+        # Split the wait into queue time (until the Space starts generating) and inference time
+        submitted_at = time.perf_counter()
+        started = {}
+
+        def track_event(event, data):
+            if event in ("generating", "process_starts", "progress") and "at" not in started:
+                started["at"] = time.perf_counter()
+                observe("queue_wait", "hf", started["at"] - submitted_at)
+            _emit(on_event, event, data)
+
+        result_url = f"{HF_SPACE_URL}/call/generate_image/{event_id}"
+        output = await asyncio.wait_for(
+            wait_for_hf_result(client, result_url, expected_duration, track_event), timeout
+        )
+        observe("inference", "hf", time.perf_counter() - started.get("at", submitted_at))
+        logger.info("Image generation completed successfully.")
+        with span("download", "hf"):
+            image_data = await _hf_output_bytes(client, output[0])
+        count("bytes_received", len(image_data), backend="hf")
+        elapsed = time.perf_counter() - submitted_at
+        # A cold start says nothing about how long this size takes once the Space is up
+        if not warm_keeper.record_call("hf", elapsed, expected_duration):
+            await latency_model.record_async("hf", "generate", size, elapsed)
+        if key is not None:
+            await cache.put_async(key, image_data)
+        return EncodedImage.from_bytes(image_data)
+
+    except asyncio.TimeoutError:
+        count("timeouts", stage="generate", backend="hf")
+        logger.error("The operation timed out")
+    except httpx.HTTPError as e:
+        count("errors", stage="generate", backend="hf")
+        logger.error(f"Error in PuLID-FLUX generation: {str(e)}")
+    except Exception as e:
+        count("errors", stage="generate", backend="hf")
+        logger.error(f"Unexpected error in PuLID-FLUX generation: {str(e)}")
+
+    return None
+
+
+def _emit(on_event, event, data):
+    if on_event is not None:
+        try:
+            on_event(event, data)
+        except Exception as e:
+            logger.warning(f"Event callback failed: {e}")
+
+
+def next_poll_delay(status, elapsed, expected_duration, previous_delay):
+    """
+    Adaptive poll interval for the JSON fallback: wait roughly half of the reported ETA,
+    queue position times the expected job duration, or the expected time remaining,
+    and back off once the job runs past its expected duration.
+    """
+    eta = status.get("rank_eta", status.get("eta"))
+    rank = status.get("rank", status.get("queue_position"))
+    if eta is not None:
+        delay = float(eta) / 2
+    elif rank is not None:
+        delay = (int(rank) + 1) * expected_duration / 2
+    elif expected_duration > elapsed:
+        delay = (expected_duration - elapsed) / 2
+    else:
+        delay = previous_delay * 1.5
+    return min(max(delay, HF_MIN_POLL_INTERVAL), HF_MAX_POLL_INTERVAL)
+
+
+async def wait_for_hf_result(client, result_url, expected_duration, on_event=None):
+    """
+    Wait for a /call/generate_image job and return its output list.
+    The result endpoint is consumed as a server-sent event stream and returns on the `complete` event;
+    if the server answers with plain JSON instead, it is polled with an adaptive interval.
+    Every queue/progress/generating event is passed to `on_event(event, data)`.
+    """
+    start_time = time.monotonic()
+    delay = HF_MIN_POLL_INTERVAL
+    errors = 0
+
+    while True:
+        try:
+            async with client.stream(
+                "GET", result_url,
+                headers={"Accept": "text/event-stream"},
+                timeout=httpx.Timeout(30.0, read=HF_STREAM_READ_TIMEOUT),
+            ) as response:
+                response.raise_for_status()
+
+                if response.headers.get("content-type", "").startswith("text/event-stream"):
+                    async for event, data in iter_sse(response):
+                        _emit(on_event, event, data)
+                        if event == "complete":
+                            return data
+                        if event == "error":
+                            raise Exception(f"API Error: {data}")
+                    # The stream closed before the job finished: reconnect straight away
+                    delay = HF_MIN_POLL_INTERVAL
+                else:
+                    result_data = json.loads(await response.aread())
+
+                    if 'error' in result_data:
+                        raise Exception(f"API Error: {result_data['error']}")
+
+                    if result_data.get('status') == 'COMPLETE':
+                        _emit(on_event, "complete", result_data['data'])
+                        return result_data['data']
+
+                    event = "queue" if "rank" in result_data or "queue_position" in result_data else "progress"
+                    _emit(on_event, event, result_data)
+                    delay = next_poll_delay(result_data, time.monotonic() - start_time, expected_duration, delay)
+        except json.JSONDecodeError:
+            logger.warning("Received incomplete response. Retrying...")
+            delay = HF_MIN_POLL_INTERVAL
+        except httpx.HTTPError as e:
+            errors += 1
+            if errors >= HF_MAX_POLL_ERRORS or not retry_budget.try_retry("hf"):
+                raise
+            count("retries", stage="poll", backend="hf")
+            logger.warning(f"Error while polling: {str(e)}. Retrying...")
+            delay = 1
+        else:
+            errors = 0
+
+        await asyncio.sleep(delay)
+
+
+async def _hf_output_bytes(client, output):
+    # Gradio returns either a file reference ({"url": ..., "path": ...}) or a base64 string
+    if isinstance(output, dict):
+        url = output.get("url") or f"{HF_SPACE_URL}/file={output['path']}"
+        response = await request_with_retries(client, "GET", url)
+        response.raise_for_status()
+        image_data = response.content
+    else:
+        if output.startswith("data:"):
+            output = output.split(",", 1)[1]
+        image_data = base64.b64decode(output)
+    return image_data
+
+
+def describe_hf_event(event, data):
+    """Short human readable status for a HF Space event, or None if there is nothing to show."""
+    if isinstance(data, dict):
+        if "rank" in data or "queue_position" in data:
+            rank = data.get("rank", data.get("queue_position"))
+            size = data.get("queue_size")
+            eta = data.get("rank_eta", data.get("eta"))
+            text = f"Queue position {int(rank) + 1}" + (f" of {size}" if size else "")
+            return text + (f", about {eta:.0f}s" if eta is not None else "")
+        if data.get("progress_data"):
+            step = data["progress_data"][0]
+            if step.get("index") is not None and step.get("length"):
+                return f"Generating: step {step['index']} of {step['length']}"
+    if event in ("generating", "process_starts", "progress"):
+        return "Generating image..."
+    return None
+
+#########################################################
+#LLAMADA A FLUX PULL-ID EN REPLICATE
+#########################################################
+
+async def generate_images_pulid_flux_replicate(prompt, id_image, width, height, num_steps, neg_prompt,
+                                               max_sequence_length, id_weight=1, start_step=1, guidance_scale=4,
+                                               seed=-1, true_cfg=1, timestep_to_start_cfg=1, num_outputs=1):
+    """
+    Run one Replicate prediction producing `num_outputs` images (the model allows 1 to 4).
+    Returns the list of images, empty on failure.
+    """
+    model_input = {
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "true_cfg": true_cfg,
+        "id_weight": id_weight,
+        "num_steps": num_steps,
+        "start_step": start_step,
+        "num_outputs": num_outputs,
+        "output_format": "png",
+        "guidance_scale": guidance_scale,
+        "output_quality": 100,
+        "negative_prompt": neg_prompt,
+        "max_sequence_length": max_sequence_length,
+        "seed": parse_seed(seed),
+        "timestep_to_start_cfg": timestep_to_start_cfg
+    }
+
+    try:
+        face = await prepare_face(id_image, "replicate")
+
+        # With a fixed seed the output is fully determined by the face and the model input
+        cache = get_result_cache()
+        keys = None
+        if cache is not None and model_input["seed"] != -1:
+            params = {"model": REPLICATE_MODEL, **model_input}
+            keys = [
+                cache_key("replicate", face.data, params=params if index == 0 else {**params, "output_index": index})
+                for index in range(num_outputs)
+            ]
+            cached = await asyncio.gather(*(cache.get_async(key) for key in keys))
+            hit = all(value is not None for value in cached)
+            count("cache_lookups", stage="generate", backend="replicate", result="hit" if hit else "miss")
+            if hit:
+                return [EncodedImage.from_bytes(value) for value in cached]
+
+        # Queueing and inference (and the face upload unless it is cached) all happen inside this one call.
+        # The learned deadline is per output, so a prediction producing several gets it once for each.
+        timeout = latency_model.timeout("replicate", "generate", model_input, REPLICATE_PREDICTION_TIMEOUT,
+                                        repeat=num_outputs)
+        start_time = time.perf_counter()
+        with span("predict", "replicate"):
+            try:
+                output = await asyncio.wait_for(run_replicate_prediction(model_input, face), timeout)
+            except asyncio.TimeoutError:
+                count("timeouts", stage="predict", backend="replicate")
+                raise TimeoutError(f"Prediction took longer than {timeout:.0f}s")
+
+        if output and isinstance(output, list) and len(output) > 0:
+            client = get_client("replicate")
+            with span("download", "replicate"):
+                responses = await asyncio.gather(
+                    *(request_with_retries(client, "GET", image_url) for image_url in output)
+                )
+                for response in responses:
+                    response.raise_for_status()
+            count("bytes_received", sum(len(response.content) for response in responses), backend="replicate")
+            if keys is not None:
+                await asyncio.gather(
+                    *(cache.put_async(key, response.content) for key, response in zip(keys, responses))
+                )
+            if num_outputs == 1:
+                await latency_model.record_async("replicate", "generate", model_input, time.perf_counter() - start_time)
+            return [EncodedImage.from_bytes(response.content) for response in responses]
+        else:
+            count("errors", stage="generate", backend="replicate")
+            logger.error("Unexpected output format from Replicate API")
+            return []
+
+    except Exception as e:
+        count("errors", stage="generate", backend="replicate")
+        logger.error(f"Error in PuLID-FLUX generation: {str(e)}")
+        return []
+
+
+async def run_replicate_prediction(model_input, face):
+    """
+    Run the PuLID-FLUX model with `face` (a preprocess.PreparedFace) as main_face_image.
+    The face is referenced through the face asset cache; if Replicate can no longer find the cached file,
+    the reference is dropped and the prediction retried once with the face uploaded inline.
+    """
+    client = get_replicate_client()
+    # Identifies a repeated request, so webhook mode can reattach to a prediction whose waiter went away
+    fingerprint = cache_key("replicate-prediction", face.data, params={"model": REPLICATE_MODEL, **model_input})
+    assets = get_face_asset_cache()
+    if assets is not None:
+        face_url = await assets.url_for(client, face)
+        try:
+            return await _predict(client, {**model_input, "main_face_image": face_url}, fingerprint)
+        except Exception as e:
+            if not is_missing_asset(e, face_url):
+                raise
+            assets.invalidate(asset_key(face.data))
+            count("face_asset_fallbacks", backend="replicate")
+            logger.warning(f"Cached face upload is no longer available ({str(e)}), uploading inline")
+
+    count("bytes_sent", len(face.data), backend="replicate")
+    return await _predict(
+        client, {**model_input, "main_face_image": face_upload(face.data, face.filename)}, fingerprint
+    )
+
+
+async def _predict(client, model_input, fingerprint):
+    if replicate_webhooks.WEBHOOKS_ENABLED:
+        return await replicate_webhooks.run(client, REPLICATE_MODEL, model_input, fingerprint)
+    return await client.async_run(REPLICATE_MODEL, input=model_input)
+
+
+async def generate_image_pulid_flux_replicate(prompt, id_image, width, height, num_steps, neg_prompt,
+                                              max_sequence_length, id_weight=1, start_step=1, guidance_scale=4,
+                                              seed=-1, true_cfg=1, timestep_to_start_cfg=1):
+    images = await generate_images_pulid_flux_replicate(
+        prompt, id_image, width, height, num_steps, neg_prompt, max_sequence_length,
+        id_weight, start_step, guidance_scale, seed, true_cfg, timestep_to_start_cfg
+    )
+    return images[0] if images else None
+
+
+#########################################################
+#LLAMADA A STORYFACE
+#########################################################
+
+async def process_images_storyface(face_image, model_image, quality=100):
+    url = os.getenv('URL')
+    if not url:
+        logger.error("Error: StoryFace API URL not found in environment variables.")
+        return None
+
+    face = await prepare_face(face_image, "storyface")
+    with span("encode", "storyface"):
+        # The model image is the previous stage's output: its bytes go out as they arrived when the format allows,
+        # otherwise it is re-encoded in the transfer format (never downscaled)
+        image_format, image_quality = transfer_format("storyface")
+        model_image = as_encoded(model_image)
+        model_bytes, model_format = await asyncio.to_thread(model_image.encoded, image_format, image_quality)
+    model_extension, model_content_type = EXTENSIONS[model_format]
+    width, height = model_image.size
+    size = {"width": width, "height": height}
+
+    files = [
+        ('images', (face.filename, face.data, face.content_type)),
+        ('images', (f"model.{model_extension}", model_bytes, model_content_type))
+    ]
+    data = {
+        'watermark': 0,
+        'quality': quality
+    }
+
+    # Each StoryFace step is deterministic for a given face, model image and quality
+    cache = get_result_cache()
+    key = cache_key("storyface", face.data, model_bytes, params={"url": url, **data}) if cache is not None else None
+    if key is not None:
+        cached = await cache.get_async(key)
+        count("cache_lookups", stage="swap", backend="storyface", result="hit" if cached else "miss")
+        if cached is not None:
+            return EncodedImage.from_bytes(cached)
+
+    breaker = get_breaker("storyface")
+    try:
+        probe = breaker.before()
+    except CircuitOpen as e:
+        logger.error(f"Skipping StoryFace: {str(e)}")
+        return None
+    ok = None
+    try:
+        # Part of an already admitted job: wait for a StoryFace slot rather than being rejected
+        cost = latency_model.predict("storyface", "swap", size)
+        async with scheduler.slot("storyface", admission=False, cost=cost):
+            start_time = time.perf_counter()
+            with span("swap", "storyface"):
+                timeout = latency_model.timeout("storyface", "swap", size, STORYFACE_TIMEOUT) + \
+                    warm_keeper.cold_penalty("storyface")
+                response = await get_client("storyface").post(url, files=files, data=data,
+                                                              timeout=upstream_timeout(timeout))
+                # A rejected request still shows the server is up; only 5xx, 429 and transport errors trip the breaker
+                ok = response.status_code < 500 and response.status_code != 429
+                response.raise_for_status()
+        count("bytes_sent", len(face.data) + len(model_bytes), backend="storyface")
+        count("bytes_received", len(response.content), backend="storyface")
+        elapsed = time.perf_counter() - start_time
+        if not warm_keeper.record_call("storyface", elapsed, cost):
+            await latency_model.record_async("storyface", "swap", size, elapsed)
+        if key is not None:
+            await cache.put_async(key, response.content)
+        return EncodedImage.from_bytes(response.content)
+    except httpx.TimeoutException as e:
+        ok = False
+        count("timeouts", stage="swap", backend="storyface")
+        logger.error(f"StoryFace timed out ({type(e).__name__})")
+        return None
+    except httpx.HTTPError as e:
+        if ok is None:
+            ok = False  # no response at all
+        logger.error(f"Error in StoryFace processing: {str(e)}")
+        return None
+    finally:
+        breaker.after(ok, probe)
+
+#########################################################
+#iTERACION DE N LLAMADAS A STORYFACE
+#########################################################
+
+async def iterative_face_swap(face_image, initial_model_image, refinement_steps, quality=100, adaptive=None):
+    """
+    Iteratively apply face swap, using each result as the new model image.
+    Always uses the original face_image as the source face.
+    """
+    current_model = initial_model_image
+    steps = iterative_face_swap_stream(face_image, initial_model_image, refinement_steps, quality, adaptive)
+    async for _, current_model in steps:
+        pass
+    return current_model  # Last successful result
+
+
+async def iterative_face_swap_stream(face_image, initial_model_image, refinement_steps, quality=100, adaptive=None):
+    """
+    Streaming iterative_face_swap: yields (step, image) as each pass lands, stopping at the first failure.
+    With `adaptive` (default ADAPTIVE_REFINEMENT) it also stops once a pass has converged, see image_change.
+    """
+    adaptive = ADAPTIVE_REFINEMENT if adaptive is None else adaptive
+    current_model = initial_model_image
+    previous = None
+    if adaptive and refinement_steps > 1:
+        previous = await asyncio.to_thread(convergence_array, initial_model_image)
+
+    steps_run = 0
+    try:
+        for step in range(1, refinement_steps + 1):
+            with span(f"refinement_step_{step}", "storyface"):
+                result = await process_images_storyface(face_image, current_model, quality)
+            if result is None:
+                return
+            steps_run = step
+            current_model = result
+            yield step, result
+
+            if previous is not None and step < refinement_steps:
+                current = await asyncio.to_thread(convergence_array, result)
+                change = image_change(previous, current)
+                previous = current
+                if change < REFINEMENT_CONVERGENCE_THRESHOLD:
+                    skipped = refinement_steps - step
+                    count("refinement_steps", skipped, result="skipped")
+                    logger.info(f"Refinement converged after step {step}/{refinement_steps} "
+                                f"(change {change:.4f} < {REFINEMENT_CONVERGENCE_THRESHOLD}), skipping {skipped}")
+                    return
+    finally:
+        count("refinement_steps", steps_run, result="run")
+
+
+def convergence_array(image, size=CONVERGENCE_SIZE):
+    """Small float32 RGB array of `image` in 0-1, cheap enough to compare after every refinement step."""
+    import numpy as np  # only adaptive refinement needs it
+    if isinstance(image, EncodedImage):
+        image = image.open()  # the pixels are only needed for this comparison, don't keep them
+    thumbnail = image.convert("RGB").resize((size, size), Image.Resampling.BILINEAR)
+    return np.asarray(thumbnail, dtype=np.float32) / 255.0
+
+
+def image_change(previous, current):
+    """Mean absolute difference between two convergence arrays (0 = identical, 1 = inverted)."""
+    import numpy as np
+    return float(np.abs(current - previous).mean())
+
+#########################################################
+#PIPELINE COMPLETO
+#########################################################
+
+async def process_all(face_image, params, quality=100, face_refinement_steps=1, backend="replicate", adaptive=None):
+    """
+    Generate with PuLID-FLUX on `backend` (see backends.get_backend) and refine the result with StoryFace.
+    `params` holds the generation parameters (see DEFAULT_PARAMS); missing keys use the defaults.
+    Returns (pulid_flux_result, storyface_result) as EncodedImage (see encoded_image.py).
+    """
+    pulid_flux_result = storyface_result = None
+    updates = process_all_stream(face_image, params, quality, face_refinement_steps, backend, adaptive=adaptive)
+    async for stage, image in logged(updates, params, face_refinement_steps, 1, backend):
+        if stage == "generation":
+            pulid_flux_result = image
+        storyface_result = image  # a failed refinement leaves the last successful image
+    return pulid_flux_result, storyface_result
+
+
+async def process_all_stream(face_image, params, quality=100, face_refinement_steps=1, backend="replicate",
+                             on_event=None, adaptive=None):
+    """
+    Streaming process_all: yields (stage, image) the moment each stage finishes, "generation" for the
+    PuLID-FLUX result and then "refinement_step_N" for every StoryFace pass. Yields nothing if generation fails.
+    """
+    if face_image is None:
+        return
+    if trace_id.get() == "-":
+        new_trace()
+
+    with span("total", backend):
+        pulid_flux_result = await backends.get_backend(backend).generate(face_image, params, on_event)
+        if pulid_flux_result is None:
+            return
+        yield "generation", pulid_flux_result
+
+        async for step, image in iterative_face_swap_stream(face_image, pulid_flux_result, face_refinement_steps,
+                                                            quality, adaptive):
+            yield f"refinement_step_{step}", image
+
+
+# Largest num_outputs accepted by the Replicate model in a single prediction
+MAX_REPLICATE_OUTPUTS = 4
+
+
+async def generate_candidates(face_image, params, num_candidates, backend="replicate", strategy="num_outputs",
+                              on_event=None):
+    """
+    Generate `num_candidates` images for the same face and parameters.
+    strategy "num_outputs" asks Replicate for several outputs per prediction; "seeds" (and any non-Replicate
+    backend) runs parallel single-image calls with seeds seed, seed+1, ... (all random when seed is -1), each
+    reporting its HF queue/progress events to `on_event`.
+    """
+    params = {**DEFAULT_PARAMS, **params}
+
+    if backend == "replicate" and strategy == "num_outputs":
+        batches = [
+            min(MAX_REPLICATE_OUTPUTS, num_candidates - start)
+            for start in range(0, num_candidates, MAX_REPLICATE_OUTPUTS)
+        ]
+        # Each batch is one prediction, taking a Replicate slot and going through its circuit breaker
+        replicate = backends.get_backend("replicate")
+        results = await asyncio.gather(*(
+            replicate.generate_many(
+                face_image, {**params, "seed": _candidate_seed(params["seed"], index * MAX_REPLICATE_OUTPUTS)}, count
+            )
+            for index, count in enumerate(batches)
+        ))
+        return [image for images in results for image in images]
+
+    generator = backends.get_backend(backend)
+    results = await asyncio.gather(*(
+        generator.generate(face_image, {**params, "seed": _candidate_seed(params["seed"], index)}, on_event)
+        for index in range(num_candidates)
+    ))
+    return [image for image in results if image is not None]
+
+
+def _candidate_seed(seed, offset):
+    seed = parse_seed(seed)
+    return seed if seed == -1 else seed + offset
+
+
+async def process_candidates(face_image, params, quality=100, face_refinement_steps=1, num_candidates=1,
+                             backend="replicate", strategy="num_outputs", adaptive=None):
+    """
+    Fan-out version of process_all: generate N candidates and run each one's StoryFace refinement
+    chain concurrently, so N images take about as long as one.
+    Returns a list of (pulid_flux_result, storyface_result) pairs.
+    """
+    results = {}
+    async for index, stage, image in process_candidates_stream(face_image, params, quality, face_refinement_steps,
+                                                               num_candidates, backend, strategy, adaptive):
+        results[index] = (image, image) if stage == "generation" else (results[index][0], image)
+    return [results[index] for index in sorted(results)]
+
+
+async def process_candidates_stream(face_image, params, quality=100, face_refinement_steps=1, num_candidates=1,
+                                    backend="replicate", strategy="num_outputs", adaptive=None, on_event=None):
+    """
+    Streaming process_candidates: yields (index, stage, image) for every generated candidate, then for every
+    StoryFace pass of every candidate as it lands (the chains run concurrently, so steps arrive interleaved).
+    HF queue/progress events of the candidates go to `on_event`, as in process_all_stream.
+    """
+    if face_image is None:
+        return
+    if trace_id.get() == "-":
+        new_trace()
+
+    with span("total", backend):
+        candidates = await generate_candidates(face_image, params, num_candidates, backend, strategy, on_event)
+        for index, candidate in enumerate(candidates):
+            yield index, "generation", candidate
+
+        updates = asyncio.Queue()
+
+        async def refine(index, candidate):
+            try:
+                async for step, image in iterative_face_swap_stream(face_image, candidate, face_refinement_steps,
+                                                                    quality, adaptive):
+                    updates.put_nowait((index, f"refinement_step_{step}", image))
+            finally:
+                updates.put_nowait(None)
+
+        tasks = [asyncio.create_task(refine(index, candidate)) for index, candidate in enumerate(candidates)]
+        try:
+            running = len(tasks)
+            while running:
+                update = await updates.get()
+                if update is None:
+                    running -= 1
+                else:
+                    yield update
+        finally:
+            for task in tasks:
+                task.cancel()  # the consumer stopped listening
+
+
+def describe_stage(stage, face_refinement_steps):
+    """Human readable progress after `stage` ("generation" or "refinement_step_N") has finished."""
+    if stage == "generation":
+        if face_refinement_steps < 1:
+            return "Image generated"
+        return f"Image generated, refining face (1/{face_refinement_steps})"
+    step = int(stage.rsplit("_", 1)[1])
+    if step >= face_refinement_steps:
+        return f"Face refinement {step}/{face_refinement_steps} done"
+    return f"Face refinement {step}/{face_refinement_steps} done, refining ({step + 1}/{face_refinement_steps})"
+
+
+async def process_stream(face_image, params, quality=100, face_refinement_steps=1, num_candidates=1,
+                         backend="replicate", strategy="num_outputs", on_event=None, adaptive=None):
+    """
+    Yields (index, stage, image) like process_candidates_stream for any number of candidates.
+    A single candidate goes through process_all_stream (with `on_event` for HF queue/progress events).
+    Identical requests (same face pixels and settings) arriving while one is running attach to it and get
+    its images instead of starting their own upstream calls. Requests with a random seed always run on their own.
+    """
+    if face_image is None:
+        return
+    if not SINGLE_FLIGHT_ENABLED or parse_seed({**DEFAULT_PARAMS, **params}["seed"]) == -1:
+        updates = _process_stream(face_image, params, quality, face_refinement_steps, num_candidates, backend,
+                                  strategy, on_event, adaptive)
+        async for update in logged(updates, params, face_refinement_steps, num_candidates, backend):
+            yield update
+        return
+
+    key = cache_key("job", params={
+        "face": await face_fingerprint(face_image), "params": {**DEFAULT_PARAMS, **params}, "quality": quality,
+        "face_refinement_steps": face_refinement_steps, "num_candidates": num_candidates, "backend": backend,
+        "strategy": strategy, "adaptive": ADAPTIVE_REFINEMENT if adaptive is None else adaptive,
+    })
+
+    def run(on_event):
+        return _process_stream(face_image, params, quality, face_refinement_steps, num_candidates, backend,
+                               strategy, on_event, adaptive)
+
+    # A joined run's upstream time stays on the usage record of the request that started it
+    updates = logged(jobs_in_flight.stream(key, run, on_event), params, face_refinement_steps, num_candidates,
+                     backend, coalesced=key in jobs_in_flight)
+    async for update in updates:
+        yield update
+
+
+async def logged(updates, params, face_refinement_steps, num_candidates, backend, coalesced=False):
+    """
+    Pass `updates` through while collecting the request's usage record (see usage_log.py), written once they end:
+    "succeeded" when any image came out, "failed" when none did, "canceled" or "error" when they stopped early.
+    """
+    if trace_id.get() == "-":
+        new_trace()
+    record = usage_log.start(backend, {**DEFAULT_PARAMS, **params}, face_refinement_steps, num_candidates)
+    record.coalesced = coalesced
+    outcome = "error"
+    produced = False
+    try:
+        async for update in updates:
+            produced = True
+            yield update
+        outcome = "succeeded" if produced else "failed"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "canceled"
+        raise
+    finally:
+        usage.set(None)
+        usage_log.finish(record, outcome)
+
+
+async def _process_stream(face_image, params, quality, face_refinement_steps, num_candidates, backend, strategy,
+                          on_event, adaptive):
+    if num_candidates > 1:
+        updates = process_candidates_stream(face_image, params, quality, face_refinement_steps, num_candidates,
+                                            backend, strategy, adaptive, on_event)
+        async for update in updates:
+            yield update
+    else:
+        async for stage, image in process_all_stream(face_image, params, quality, face_refinement_steps, backend,
+                                                     on_event, adaptive):
+            yield 0, stage, image
+
+
+async def stream_results(face_image, params, quality=100, face_refinement_steps=1, num_candidates=1,
+                         backend="replicate", strategy="num_outputs", on_event=None, adaptive=None, user=None):
+    """
+    What the Gradio handlers show: yields (pulid_flux_result, storyface_result, gallery, status) every time a stage
+    finishes, where gallery holds the latest image of each candidate as (image, caption) pairs.
+    Images are file paths in the output store, so Gradio serves the stored bytes without decoding or re-encoding.
+    With `user`, the finished candidates (with thumbnails) are added to that user's history.
+    Statuses carry the time left as predicted by the latency model, starting with an ETA before any stage is done.
+    """
+    start_time = time.monotonic()
+    plan = backends.estimate(backend, params, face_refinement_steps)
+    yield None, None, [], f"Generating, about {plan.total:.0f}s"
+    updates = process_stream(face_image, params, quality, face_refinement_steps, num_candidates, backend, strategy,
+                             on_event, adaptive)
+
+    pulid_flux_result = storyface_result = None
+    latest = {}
+    generated = {}
+    finals = {}
+    async for index, stage, image in updates:
+        with span("store", backend):
+            stored = await output_store.put_async(image)
+        latest[index] = stored.file
+        finals[index] = image
+        if stage == "generation":
+            generated[index] = stored.path
+        if index == 0:
+            if stage == "generation":
+                pulid_flux_result = stored.file
+            else:
+                storyface_result = stored.file
+        gallery = [(latest[i], f"Candidate {i + 1}") for i in sorted(latest)]
+        status = describe_stage(stage, face_refinement_steps)
+        if num_candidates > 1:
+            status = f"Candidate {index + 1}: {status}"
+        timing = f"{time.monotonic() - start_time:.1f}s"
+        remaining = plan.remaining(stage)
+        if remaining >= 1:
+            timing += f", about {remaining:.0f}s left"
+        yield pulid_flux_result, storyface_result, gallery, f"{status} ({timing})"
+
+    if pulid_flux_result is None:
+        yield None, None, [], "Generation failed"
+        return
+    if user:
+        await remember(user, await store_finals(finals, generated, backend), params, backend)
+    gallery = [(latest[i], f"Candidate {i + 1}") for i in sorted(latest)]
+    status = f"Done in {time.monotonic() - start_time:.1f}s"
+    yield pulid_flux_result, storyface_result or pulid_flux_result, gallery, status
+
+
+async def store_finals(finals, generated, backend):
+    """
+    Thumbnail the final image of each candidate. Returns {index: {"image", "thumbnail", "generated"}}
+    with paths in the output store.
+    """
+    with span("store", backend):
+        stored = await asyncio.gather(*(
+            output_store.put_async(finals[index], thumbnail=True) for index in sorted(finals)
+        ))
+    return {
+        index: {"image": entry.path, "thumbnail": entry.thumbnail, "generated": generated.get(index)}
+        for index, entry in zip(sorted(finals), stored)
+    }
+
+
+async def remember(user, outputs, params, backend):
+    """Add the outputs of a finished generation (see store_finals) to `user`'s history."""
+    await asyncio.to_thread(output_store.record, user, {
+        "trace_id": trace_id.get(), "backend": backend, "params": {**DEFAULT_PARAMS, **params},
+        "outputs": [outputs[index] for index in sorted(outputs)],
+    })
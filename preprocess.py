@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import weakref
+from PIL import Image, ImageOps
+
+from metrics import count, span
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#NORMALIZACION DE LA CARA ANTES DE SUBIRLA
+#########################################################
+
+# Longest side (pixels) of the face sent upstream; PuLID only needs a modest resolution
+FACE_MAX_SIDE = int(os.getenv("FACE_MAX_SIDE", "1024"))
+# Transfer encoding per backend, overridable with FACE_FORMAT_<BACKEND> / FACE_QUALITY_<BACKEND>
+# (or FACE_FORMAT / FACE_QUALITY for all). StoryFace stays lossless because its output is what the user
+# sees and each refinement step re-encodes the previous result.
+DEFAULT_FORMATS = {"hf": ("JPEG", 95), "replicate": ("JPEG", 95), "storyface": ("PNG", 95)}
+EXTENSIONS = {"PNG": ("png", "image/png"), "JPEG": ("jpg", "image/jpeg"), "WEBP": ("webp", "image/webp")}
+
+
+class PreparedFace:
+    """A face image encoded for one backend."""
+
+    def __init__(self, data, format, size):
+        self.data = data
+        self.format = format
+        self.size = size
+
+    @property
+    def filename(self):
+        return f"face.{EXTENSIONS[self.format][0]}"
+
+    @property
+    def content_type(self):
+        return EXTENSIONS[self.format][1]
+
+
+def transfer_format(backend):
+    """(format, quality) used to send images to `backend`."""
+    default_format, default_quality = DEFAULT_FORMATS.get(backend, ("PNG", 95))
+    suffix = backend.upper()
+    image_format = os.getenv(f"FACE_FORMAT_{suffix}", os.getenv("FACE_FORMAT", default_format)).upper()
+    if image_format == "JPG":
+        image_format = "JPEG"
+    if image_format not in EXTENSIONS:
+        raise ValueError(f"Unsupported face format {image_format!r}, use one of {', '.join(EXTENSIONS)}")
+    quality = int(os.getenv(f"FACE_QUALITY_{suffix}", os.getenv("FACE_QUALITY", default_quality)))
+    return image_format, quality
+
+
+def encode_image(image, image_format="PNG", quality=95):
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        if image.mode != "RGB":
+            image = image.convert("RGB")  # JPEG has no alpha channel
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    elif image_format == "WEBP":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def normalize_face(image, max_side=FACE_MAX_SIDE):
+    """Apply the EXIF orientation and downscale so the longest side is at most `max_side` (0 disables)."""
+    image = ImageOps.exif_transpose(image)
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return image
+
+
+# Side of the patch whose PNG encode estimates the size of a face upload without a file
+ORIGINAL_SIZE_SAMPLE = 512
+
+
+def original_size(image):
+    """
+    Bytes the unprocessed face used to cost: the source file if known, else the full resolution PNG that used to be
+    uploaded (Gradio hands over decoded copies without a file). That PNG is estimated from a full resolution patch
+    of the center, scaled by area: encoding the whole image just for this metric would cost more than the
+    preprocessing saves.
+    """
+    filename = getattr(image, "filename", None)
+    if filename and os.path.exists(filename):
+        return os.path.getsize(filename)
+    width, height = image.size
+    if width * height <= ORIGINAL_SIZE_SAMPLE ** 2:
+        return len(encode_image(image, "PNG"))
+    sample_width, sample_height = min(width, ORIGINAL_SIZE_SAMPLE), min(height, ORIGINAL_SIZE_SAMPLE)
+    left, top = (width - sample_width) // 2, (height - sample_height) // 2
+    sample = image.crop((left, top, left + sample_width, top + sample_height))
+    return round(len(encode_image(sample, "PNG")) * width * height / (sample_width * sample_height))
+
+# Per source image: normalized face, original size and one PreparedFace per backend.
+# Keyed by id() (PIL images are unhashable) and dropped when the image is garbage collected.
+_prepared = {}
+
+
+def _entry(image):
+    key = id(image)
+    entry = _prepared.get(key)
+    if entry is None or entry["ref"]() is not image:
+        entry = _prepared[key] = {"ref": weakref.ref(image, lambda _, key=key: _prepared.pop(key, None)), "tasks": {}}
+    return entry
+
+
+def _prepare(image, entry, backend):
+    if "normalized" not in entry:
+        entry["original_size"] = original_size(image)
+        entry["normalized"] = normalize_face(image)
+    normalized = entry["normalized"]
+    image_format, quality = transfer_format(backend)
+    prepared = PreparedFace(encode_image(normalized, image_format, quality), image_format, normalized.size)
+
+    saved = entry["original_size"] - len(prepared.data)
+    count("face_bytes_sent", len(prepared.data), backend=backend)
+    count("face_bytes_saved", max(saved, 0), backend=backend)
+    logger.info(
+        f"Face for {backend}: {image.size[0]}x{image.size[1]} -> {prepared.size[0]}x{prepared.size[1]} "
+        f"{image_format}, {entry['original_size'] / 1024:.0f}KB -> {len(prepared.data) / 1024:.0f}KB "
+        f"(saved {saved / 1024:.0f}KB)"
+    )
+    return prepared
+
+
+async def prepare_face(image, backend):
+    """
+    Oriented, downscaled face encoded in `backend`'s transfer format. Done once per image and backend,
+    so candidates and refinement steps sharing a face reuse the same bytes.
+    """
+    entry = _entry(image)
+    task = entry["tasks"].get(backend)
+    if task is None or (not task.done() and task.get_loop() is not asyncio.get_running_loop()):
+        task = entry["tasks"][backend] = asyncio.ensure_future(_prepare_in_thread(image, entry, backend))
+    return await asyncio.shield(task)
+
+
+def _fingerprint(image):
+    digest = hashlib.sha256(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+async def face_fingerprint(image):
+    """Hash of the face's pixels, computed once per image: two uploads of the same photo get the same value."""
+    entry = _entry(image)
+    if "fingerprint" not in entry:
+        entry["fingerprint"] = await asyncio.to_thread(_fingerprint, image)
+    return entry["fingerprint"]
+
+
+async def _prepare_in_thread(image, entry, backend):
+    with span("preprocess", backend):
+        return await asyncio.to_thread(_prepare, image, entry, backend)
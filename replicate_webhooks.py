@@ -0,0 +1,290 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import time
+
+from metrics import count, span
+
+try:
+    import fcntl  # serializes TRACKING_FILE updates between processes; not available on Windows
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#PREDICCIONES DE REPLICATE CON WEBHOOK
+#########################################################
+
+WEBHOOKS_ENABLED = os.getenv("REPLICATE_WEBHOOKS", "0") == "1"
+# Local receiver; REPLICATE_WEBHOOK_URL is the address Replicate calls (e.g. through nginx) and must reach it
+WEBHOOK_HOST = os.getenv("REPLICATE_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("REPLICATE_WEBHOOK_PORT", "8765"))
+WEBHOOK_PATH = "/replicate/webhook"
+WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL", f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+# Signing secret from https://api.replicate.com/v1/webhooks/default/secret (whsec_...); when set, unsigned calls are refused
+WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET")
+# Safety net: a waiter polls the prediction this often in case its webhook never arrives
+WEBHOOK_FALLBACK_POLL = float(os.getenv("REPLICATE_WEBHOOK_FALLBACK_POLL", "30"))
+TRACKING_FILE = os.getenv("REPLICATE_TRACKING_FILE", os.path.join(".cache", "replicate_predictions.json"))
+TRACKING_TTL = float(os.getenv("REPLICATE_TRACKING_TTL", "3600"))
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+def verify_signature(secret, headers, body):
+    """Check Replicate's webhook signature (webhook-id.webhook-timestamp.body, HMAC-SHA256)."""
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature", "")
+    if not webhook_id or not timestamp or abs(time.time() - int(timestamp)) > 300:
+        return False
+    key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    expected = base64.b64encode(
+        hmac.new(key, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+    ).decode()
+    return any(
+        hmac.compare_digest(expected, signature.split(",", 1)[-1]) for signature in signatures.split()
+    )
+
+
+class PredictionTracker:
+    """
+    Predictions created in webhook mode, persisted to TRACKING_FILE until their output has been handed over.
+    A prediction whose waiter went away (UI disconnect, process restart) keeps running upstream; the next
+    identical request (same fingerprint) reattaches to it instead of paying for a new one.
+    """
+
+    def __init__(self, path=TRACKING_FILE, ttl=TRACKING_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.records = self._load()
+        self._futures = {}
+        self._waiters = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        cutoff = time.time() - self.ttl
+        return {key: record for key, record in records.items() if record["created_at"] >= cutoff}
+
+    def _save(self, prediction_id):
+        """
+        Write this process's record of `prediction_id` (or its removal) to TRACKING_FILE, keeping the
+        predictions other processes track there and picking them up.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            records = self._load()
+            record = self.records.get(prediction_id)
+            if record is None:
+                records.pop(prediction_id, None)
+            else:
+                records[prediction_id] = record
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(records, f)
+            os.replace(tmp_path, self.path)
+        self.records = records
+
+    def track(self, prediction_id, fingerprint):
+        self.records[prediction_id] = {
+            "fingerprint": fingerprint, "status": "starting", "created_at": time.time(), "payload": None,
+        }
+        self._save(prediction_id)
+
+    def orphan(self, fingerprint):
+        """Id of an unclaimed prediction for `fingerprint` that nobody in this process is waiting on."""
+        cutoff = time.time() - self.ttl
+        for prediction_id, record in self.records.items():
+            if (record["fingerprint"] == fingerprint and record["created_at"] >= cutoff
+                    and not self._waiters.get(prediction_id)):
+                return prediction_id
+        return None
+
+    def complete(self, payload):
+        """Record a terminal prediction payload (from a webhook or a poll) and wake its waiters."""
+        if payload.get("status") not in TERMINAL_STATUSES:
+            return
+        record = self.records.get(payload.get("id"))
+        if record is not None and record["payload"] is None:
+            record["status"] = payload["status"]
+            record["payload"] = payload
+            self._save(payload["id"])
+        # Also when another process has already claimed the prediction, so a waiter here is not left hanging
+        future = self._futures.get(payload["id"])
+        if future is not None and not future.done():
+            future.set_result(payload)
+
+    def claim(self, prediction_id):
+        """The output has been delivered: stop tracking the prediction."""
+        self._futures.pop(prediction_id, None)
+        if self.records.pop(prediction_id, None) is not None:
+            self._save(prediction_id)
+
+    async def wait(self, client, prediction_id):
+        """Terminal payload of `prediction_id`, without holding a thread while the prediction runs."""
+        record = self.records.get(prediction_id)
+        if record is not None and record["payload"] is not None:
+            return record["payload"]
+
+        future = self._futures.get(prediction_id)
+        if future is None or future.get_loop() is not asyncio.get_running_loop():
+            future = self._futures[prediction_id] = asyncio.get_running_loop().create_future()
+        self._waiters[prediction_id] = self._waiters.get(prediction_id, 0) + 1
+        try:
+            while True:
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), WEBHOOK_FALLBACK_POLL)
+                except asyncio.TimeoutError:
+                    prediction = await client.predictions.async_get(prediction_id)
+                    if prediction.status in TERMINAL_STATUSES:
+                        count("webhook_fallback_polls", backend="replicate")
+                        logger.warning(f"No webhook for prediction {prediction_id}, got its result by polling")
+                        self.complete(prediction.dict())
+        finally:
+            self._waiters[prediction_id] -= 1
+            if not self._waiters[prediction_id]:
+                del self._waiters[prediction_id]
+
+
+class WebhookReceiver:
+    """
+    HTTP endpoint for Replicate's completion webhooks, served on the event loop that waits for them.
+    Only one process can hold the port; the others poll their predictions instead.
+    """
+
+    def __init__(self, tracker, host=WEBHOOK_HOST, port=WEBHOOK_PORT, secret=WEBHOOK_SECRET):
+        self.tracker = tracker
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self._loop = None
+        self._server = None
+        self._task = None
+        self._unavailable = None  # loop on which the port could not be bound
+
+    def app(self):
+        from starlette.applications import Starlette
+        from starlette.responses import JSONResponse
+        from starlette.routing import Route
+
+        async def webhook(request):
+            body = await request.body()
+            if self.secret and not verify_signature(self.secret, request.headers, body):
+                count("webhook_rejections", backend="replicate")
+                return JSONResponse({"detail": "Invalid signature"}, status_code=401)
+            count("webhooks", backend="replicate")
+            self.tracker.complete(json.loads(body))
+            return JSONResponse({"ok": True})
+
+        return Starlette(routes=[Route(WEBHOOK_PATH, webhook, methods=["POST"])])
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        if os.name != "nt":
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # on Windows this would share the port
+        try:
+            sock.bind((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    async def _serve(self, sock):
+        try:
+            await self._server.serve(sockets=[sock])
+        except SystemExit:
+            # uvicorn exits the process when it cannot start; only the receiver should stop
+            logger.error(f"Webhook receiver on {self.host}:{self.port} stopped")
+
+    async def ensure_started(self):
+        """True once the receiver listens on the running loop, False if the port is taken (e.g. by another process)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return True
+        if self._unavailable is loop:
+            return False
+        try:
+            sock = self._bind()
+        except OSError as e:
+            self._unavailable = loop
+            logger.warning(f"Webhook receiver could not listen on {self.host}:{self.port} ({e}), "
+                           "polling Replicate predictions instead")
+            return False
+        import uvicorn  # the server stack is only loaded once webhook mode is actually used
+        config = uvicorn.Config(self.app(), log_level="warning", access_log=False, lifespan="off")
+        self._server = uvicorn.Server(config)
+        self._loop = loop
+        self._task = loop.create_task(self._serve(sock))
+        while not self._server.started:
+            if self._task.done():
+                self._loop = None
+                self._unavailable = loop
+                sock.close()
+                logger.warning("Webhook receiver did not start, polling Replicate predictions instead")
+                return False
+            await asyncio.sleep(0.05)
+        logger.info(f"Replicate webhook receiver listening on {self.host}:{self.port}{WEBHOOK_PATH}")
+        return True
+
+    async def stop(self):
+        if self._server is not None and self._loop is asyncio.get_running_loop():
+            self._server.should_exit = True
+            await self._task
+        self._loop = self._server = None
+
+
+tracker = PredictionTracker()
+receiver = WebhookReceiver(tracker)
+
+
+async def run(client, model, model_input, fingerprint):
+    """
+    Webhook-mode counterpart of Client.async_run: create the prediction with a completion webhook and
+    wait for it. Reattaches to an orphaned prediction with the same `fingerprint` when there is one.
+    Without the receiver (its port is held by another process) the prediction is polled like in Client.async_run.
+    """
+    if not await receiver.ensure_started():
+        return await client.async_run(model, input=model_input)
+
+    prediction_id = tracker.orphan(fingerprint)
+    if prediction_id is not None:
+        count("prediction_reattaches", backend="replicate")
+        logger.info(f"Reattaching to Replicate prediction {prediction_id}")
+        if tracker.records[prediction_id]["payload"] is None:
+            # Its webhook may have arrived while nobody was listening (e.g. during a restart)
+            prediction = await client.predictions.async_get(prediction_id)
+            tracker.complete(prediction.dict())
+    else:
+        with span("submit", "replicate"):
+            prediction = await client.predictions.async_create(
+                version=model.split(":", 1)[1], input=model_input,
+                webhook=WEBHOOK_URL, webhook_events_filter=["completed"],
+            )
+        prediction_id = prediction.id
+        tracker.track(prediction_id, fingerprint)
+
+    payload = await tracker.wait(client, prediction_id)
+    tracker.claim(prediction_id)
+    if payload["status"] != "succeeded":
+        from replicate.exceptions import ModelError
+        from replicate.prediction import Prediction
+        try:
+            prediction = Prediction(**payload)
+        except ValueError:
+            raise RuntimeError(f"Prediction {prediction_id} {payload['status']}: {payload.get('error')}")
+        raise ModelError(prediction)
+    return payload["output"]
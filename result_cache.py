@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+#########################################################
+#CACHE DE RESULTADOS DIRECCIONADA POR CONTENIDO
+#########################################################
+
+CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(".cache", "results"))
+CACHE_MEMORY_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_BYTES", str(256 * 1024 * 1024)))
+CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(4 * 1024 * 1024 * 1024)))
+
+
+def cache_key(kind, *blobs, params=None):
+    """
+    Hash the inputs of a deterministic stage: `kind` names the stage/backend, `blobs` are raw image
+    bytes and `params` is a JSON-serialisable dict (serialised with sorted keys so order doesn't matter).
+    """
+    digest = hashlib.sha256(kind.encode())
+    for blob in blobs:
+        digest.update(len(blob).to_bytes(8, "big"))
+        digest.update(blob)
+    if params is not None:
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class MemoryLRU:
+    """In-memory LRU bounded by the total size of the stored values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._items[key] = value
+            self.total_bytes += len(value)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+
+class DiskStore:
+    """
+    Size-bounded on-disk store, one file per key under `<directory>/<key[:2]>/<key>`.
+    Least recently used files (by mtime, which reads refresh) are deleted once the total size exceeds `max_bytes`.
+    The index is built from the directory in a background thread, and rebuilt after every `max_bytes` / 10 written,
+    so files written by other processes sharing the directory count too.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+        self._scanning = False
+        self._written = 0  # bytes written since the last scan
+        self._fresh = set()  # keys written since the last scan started
+        self._rescan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _rescan(self):
+        with self._lock:
+            if self._scanning:
+                return
+            self._scanning = True
+            self._written = 0
+            self._fresh = set()
+        threading.Thread(target=self._scan, name="result-cache-scan", daemon=True).start()
+
+    def _scan(self):
+        try:
+            entries = []
+            if os.path.isdir(self.directory):
+                for shard in os.scandir(self.directory):
+                    if not shard.is_dir():
+                        continue
+                    for entry in os.scandir(shard.path):
+                        if entry.is_file() and not entry.name.endswith(".tmp"):
+                            try:
+                                stat = entry.stat()
+                            except FileNotFoundError:
+                                continue  # evicted by another process
+                            entries.append((stat.st_mtime, entry.name, stat.st_size))
+            with self._lock:
+                sizes = OrderedDict((key, size) for _, key, size in sorted(entries))
+                for key in self._fresh:
+                    if key not in sizes and key in self._sizes:
+                        sizes[key] = self._sizes[key]  # written while the scan was running
+                self._sizes = sizes
+                self.total_bytes = sum(sizes.values())
+                evicted = self._evict()
+            self._remove(evicted)
+        finally:
+            self._scanning = False
+
+    def _evict(self):
+        """Drop least recently used keys until the total fits. Call with the lock held; returns them for _remove."""
+        evicted = []
+        while self.total_bytes > self.max_bytes and self._sizes:
+            old_key, size = self._sizes.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(old_key)
+        return evicted
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.total_bytes -= self._sizes.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.total_bytes += len(value) - self._sizes.pop(key, 0)
+            self._sizes[key] = len(value)
+            self._written += len(value)
+            self._fresh.add(key)
+            rescan = self._written > self.max_bytes // 10
+            evicted = self._evict()
+        self._remove(evicted)
+        if rescan:
+            self._rescan()
+
+
+class ResultCache:
+    """Two-tier cache: a memory LRU in front of a size-bounded disk store. Values are encoded image bytes."""
+
+    def __init__(self, memory_bytes=CACHE_MEMORY_BYTES, directory=CACHE_DIR, disk_bytes=CACHE_DISK_BYTES):
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskStore(directory, disk_bytes) if directory and disk_bytes > 0 else None
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    async def get_async(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = await asyncio.to_thread(self.get, key)
+        return value
+
+    async def put_async(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, value)
+
+
+_result_cache = None
+
+
+def get_result_cache():
+    """Process-wide cache instance, or None when RESULT_CACHE_ENABLED=0."""
+    global _result_cache
+    if not CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
@@ -0,0 +1,178 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import count, observe
+
+#########################################################
+#PLANIFICADOR CON CONTROL DE ADMISION
+#########################################################
+
+# Priority classes: lower runs first
+INTERACTIVE = 0
+BATCH = 1
+
+DEFAULT_CONCURRENCY = int(os.getenv("SCHED_CONCURRENCY", "4"))
+DEFAULT_MAX_QUEUE = int(os.getenv("SCHED_MAX_QUEUE", "32"))
+# Assumed service time (seconds) per upstream call until real ones have been measured
+DEFAULT_SERVICE_TIME = {"hf": 60.0, "replicate": 30.0, "storyface": 10.0, "stub": 0.5}
+
+current_priority = contextvars.ContextVar("current_priority", default=INTERACTIVE)
+
+
+class SchedulerFull(Exception):
+    """Raised immediately when a backend's wait queue is full, instead of letting the job time out."""
+
+    def __init__(self, backend, estimated_wait):
+        super().__init__(f"{backend} is at capacity, try again in about {estimated_wait:.0f}s")
+        self.backend = backend
+        self.estimated_wait = estimated_wait
+
+
+class BackendLimiter:
+    """Concurrency cap for one upstream, with a bounded wait queue ordered by priority then arrival."""
+
+    def __init__(self, name, concurrency, max_queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._service_times = deque(maxlen=50)
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def service_time(self):
+        if self._service_times:
+            return sum(self._service_times) / len(self._service_times)
+        return DEFAULT_SERVICE_TIME.get(self.name, 30.0)
+
+    def estimated_wait(self, priority=INTERACTIVE):
+        """
+        Seconds a new job of `priority` would wait for a slot: the expected cost of the jobs queued ahead of it
+        (their predicted latency when known, else the average service time) plus one slot freeing up.
+        """
+        if self.active < self.concurrency and not self._waiters:
+            return 0.0
+        service_time = self.service_time()
+        ahead = sum(entry[3] or service_time for entry in self._waiters if entry[0] <= priority)
+        return (ahead + service_time) / self.concurrency
+
+    async def acquire(self, priority=INTERACTIVE, admission=True, cost=None):
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return
+        if admission and len(self._waiters) >= self.max_queue:
+            count("rejections", backend=self.name)
+            raise SchedulerFull(self.name, self.estimated_wait(priority))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._counter), future, cost)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over just as we were cancelled
+            else:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future, _ = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)  # hand the slot straight to the next waiter
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=INTERACTIVE, admission=True, cost=None):
+        queued_at = time.monotonic()
+        await self.acquire(priority, admission, cost)
+        start_time = time.monotonic()
+        observe("scheduler_wait", self.name, start_time - queued_at)
+        try:
+            yield
+        finally:
+            self._service_times.append(time.monotonic() - start_time)
+            self.release()
+
+
+class Scheduler:
+    """
+    Per-backend limiters sitting in front of every upstream call. Caps come from
+    SCHED_CONCURRENCY_<BACKEND> / SCHED_MAX_QUEUE_<BACKEND>, falling back to SCHED_CONCURRENCY / SCHED_MAX_QUEUE.
+    """
+
+    def __init__(self):
+        self._limiters = {}
+        self._share = (0, 1)
+
+    def split(self, index, processes):
+        """
+        Make this process the `index`-th of `processes` sharing the concurrency caps (queue workers), so the
+        upstreams see the configured totals rather than one cap per process. Call before the first slot.
+        """
+        self._share = (index, processes)
+        self._limiters.clear()
+
+    def concurrency(self, backend):
+        """This process's part of `backend`'s cap; at least 1, so a cap below the process count is exceeded."""
+        total = int(os.getenv(f"SCHED_CONCURRENCY_{backend.upper()}", DEFAULT_CONCURRENCY))
+        index, processes = self._share
+        return max(1, total // processes + (index < total % processes))
+
+    def limiter(self, backend):
+        limiter = self._limiters.get(backend)
+        if limiter is None:
+            limiter = BackendLimiter(
+                backend,
+                self.concurrency(backend),
+                int(os.getenv(f"SCHED_MAX_QUEUE_{backend.upper()}", DEFAULT_MAX_QUEUE)),
+            )
+            self._limiters[backend] = limiter
+        return limiter
+
+    def slot(self, backend, admission=True, cost=None):
+        """
+        Hold one of `backend`'s slots for the duration of an upstream call, at the current priority.
+        With admission=True a full queue raises SchedulerFull; stages of an already admitted job
+        pass admission=False so they wait instead of failing half way. `cost` is the call's predicted
+        latency (see latency_model), used for the wait estimates of the jobs queued behind it.
+        """
+        return self.limiter(backend).slot(current_priority.get(), admission, cost)
+
+    def check_admission(self, backend):
+        """Fast rejection before a job starts. Returns the estimated wait in seconds."""
+        limiter = self.limiter(backend)
+        priority = current_priority.get()
+        if limiter.queued >= limiter.max_queue:
+            count("rejections", backend=backend)
+            raise SchedulerFull(backend, limiter.estimated_wait(priority))
+        return limiter.estimated_wait(priority)
+
+    def estimated_wait(self, backend):
+        return self.limiter(backend).estimated_wait(current_priority.get())
+
+
+@contextmanager
+def priority(level):
+    """Run the enclosed jobs (and tasks they spawn) at priority `level`."""
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+scheduler = Scheduler()
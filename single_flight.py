@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+
+from metrics import count, trace_id
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#PETICIONES IDENTICAS EN CURSO COMPARTIDAS (SINGLE-FLIGHT)
+#########################################################
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") != "0"
+
+
+class Flight:
+    """One shared run: the updates produced so far and the callers attached to it."""
+
+    def __init__(self):
+        self.updates = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.listeners = []
+        self.trace_id = trace_id.get()
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        # Wake every waiter, then start a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def changed(self):
+        await self._changed.wait()
+
+    def emit(self, event, data):
+        for listener in list(self.listeners):
+            try:
+                listener(event, data)
+            except Exception as e:
+                logger.warning(f"Event callback failed: {e}")
+
+
+class SingleFlight:
+    """
+    Runs one async generator per key at a time. A caller arriving while the same key is in flight attaches to it
+    instead of starting another run: it first gets the updates already produced, then the rest as they come.
+    The run lives in its own task, so it keeps going while any caller is still attached and is only cancelled
+    when the last one leaves.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+
+    @property
+    def in_flight(self):
+        return len(self._flights)
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    async def stream(self, key, factory, on_event=None):
+        """
+        Yield the items of `factory(on_event)` (an async generator), shared with concurrent callers of `key`.
+        Events the run emits reach the `on_event` of every attached caller.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+            count("single_flight", kind=self.name, result="leader")
+        else:
+            count("single_flight", kind=self.name, result="joined")
+            logger.info(f"Identical {self.name} already in flight (trace {flight.trace_id}), attaching to it")
+        flight.waiters += 1
+        if on_event is not None:
+            flight.listeners.append(on_event)
+        position = 0
+        try:
+            while True:
+                while position < len(flight.updates):
+                    yield flight.updates[position]
+                    position += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed()
+        finally:
+            flight.waiters -= 1
+            if on_event is not None:
+                flight.listeners.remove(on_event)
+            if not flight.waiters and not flight.done:
+                # Nobody is listening any more
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    async def _run(self, key, flight, factory):
+        try:
+            async for update in factory(flight.emit):
+                flight.updates.append(update)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(key, flight)
+            flight.notify()
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+jobs_in_flight = SingleFlight("job")
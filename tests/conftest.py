@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# The modules read their settings at import: keep the tests off the network-facing caches and the working tree
+_state = tempfile.mkdtemp(prefix="pulid-tests-")
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+os.environ.setdefault("REPLICATE_FACE_ASSETS", "0")
+os.environ.setdefault("REPLICATE_WEBHOOKS", "0")
+os.environ.setdefault("LATENCY_HISTORY_FILE", os.path.join(_state, "latency_runs.jsonl"))
+os.environ.setdefault("USAGE_LOG_DIR", "")
+os.environ.setdefault("WARM_KEEPER_ENABLED", "0")
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
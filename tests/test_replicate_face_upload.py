@@ -0,0 +1,69 @@
+import asyncio
+import glob
+import io
+import os
+
+import httpx
+import pytest
+from PIL import Image
+
+import pipeline
+
+CALLS = 300
+
+
+class StubReplicateClient:
+    """Stands in for replicate.Client: reads the uploaded face like the real client would and returns one URL."""
+
+    def __init__(self):
+        self.uploads = 0
+
+    async def async_run(self, model, input):
+        face = input["main_face_image"]
+        assert isinstance(face, io.IOBase), "the face should be uploaded from memory"
+        assert face.read()
+        self.uploads += 1
+        return ["https://replicate.delivery/stub/output.png"]
+
+
+def open_descriptors():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def png_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 150, 120)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to count descriptors")
+def test_replicate_face_upload_leaks_no_descriptors_or_files(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)  # the old code left temp_image_*.png in the working directory
+    stub = StubReplicateClient()
+    monkeypatch.setattr(pipeline, "get_replicate_client", lambda: stub)
+    output = png_bytes()
+    face = Image.new("RGB", (256, 256), (180, 140, 110))
+
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=output))
+        async with httpx.AsyncClient(transport=transport) as client:
+            monkeypatch.setattr(pipeline, "get_client", lambda backend: client)
+
+            async def generate(seed):
+                image = await pipeline.generate_image_pulid_flux_replicate(
+                    id_image=face, **{**pipeline.DEFAULT_PARAMS, "seed": seed}
+                )
+                assert image is not None
+
+            for seed in range(10):  # warm up lazily created pools and caches
+                await generate(seed)
+            before = open_descriptors()
+            for seed in range(CALLS):
+                await generate(seed)
+            return before, open_descriptors()
+
+    before, after = asyncio.run(run())
+
+    assert stub.uploads == CALLS + 10
+    assert after <= before, f"descriptors grew from {before} to {after} over {CALLS} calls"
+    assert not glob.glob(str(tmp_path / "temp_image_*"))
@@ -0,0 +1,192 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+from metrics import count, trace_id, usage
+
+#########################################################
+#REGISTRO DE USO POR PETICION (ESCRITURA EN SEGUNDO PLANO)
+#########################################################
+
+# One JSON line per request in <dir>/usage-YYYY-MM-DD.jsonl (UTC days); empty disables the log
+USAGE_LOG_DIR = os.getenv("USAGE_LOG_DIR", "usage_logs")
+# Days older than yesterday are gzipped; days older than this are deleted
+USAGE_LOG_RETENTION_DAYS = int(os.getenv("USAGE_LOG_RETENTION_DAYS", "400"))
+# Records waiting for the writer thread; when it falls this far behind new records are dropped, never waited on
+USAGE_LOG_QUEUE_SIZE = int(os.getenv("USAGE_LOG_QUEUE_SIZE", "10000"))
+
+FILE_PREFIX = "usage-"
+
+
+class UsageRecord:
+    """
+    What one request cost: its parameters plus the stage durations and bytes the metrics layer reports while
+    it runs (stages of concurrent candidates add up, so they measure upstream time spent, not wall time).
+    """
+
+    def __init__(self, backend, params, face_refinement_steps=0, num_candidates=1):
+        self.started_at = time.time()
+        self._start_time = time.monotonic()
+        self.trace_id = trace_id.get()
+        self.backend = backend
+        self.width = params.get("width")
+        self.height = params.get("height")
+        self.steps = params.get("num_steps")
+        self.refinement_steps = face_refinement_steps
+        self.candidates = num_candidates
+        self.coalesced = False
+        self.stages = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.finished = False
+
+    def observe(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name, amount):
+        if name == "bytes_sent":
+            self.bytes_sent += amount
+        elif name == "bytes_received":
+            self.bytes_received += amount
+
+    def to_dict(self, outcome):
+        record = {
+            "ts": round(self.started_at, 3),
+            "trace": self.trace_id,
+            "backend": self.backend,
+            "w": self.width,
+            "h": self.height,
+            "steps": self.steps,
+            "refine": self.refinement_steps,
+            "cands": self.candidates,
+            "dur": round(time.monotonic() - self._start_time, 3),
+            "stages": {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+            "tx": self.bytes_sent,
+            "rx": self.bytes_received,
+            "outcome": outcome,
+        }
+        if self.coalesced:
+            record["coalesced"] = True
+        return record
+
+
+def start(backend, params, face_refinement_steps=0, num_candidates=1):
+    """Begin the current request's usage record; every stage timing and byte count from here on goes into it."""
+    record = UsageRecord(backend, params, face_refinement_steps, num_candidates)
+    usage.set(record)
+    return record
+
+
+def finish(record, outcome):
+    """Hand `record` to the writer thread with `outcome` ("succeeded", "failed", "canceled" or "error")."""
+    if record.finished:
+        return
+    record.finished = True
+    if USAGE_LOG_DIR:
+        _usage_logger().info(json.dumps(record.to_dict(outcome), separators=(",", ":")))
+
+#########################################################
+#ESCRITURA: COLA + FICHERO DIARIO
+#########################################################
+
+class DailyFileHandler(logging.Handler):
+    """
+    Appends each message as one line to <directory>/usage-YYYY-MM-DD.jsonl. Lines are written and flushed one
+    at a time, so several processes (app, API, workers) can share a day's file. When the day changes, finished
+    days are gzipped and days past the retention are deleted.
+    """
+
+    def __init__(self, directory, retention_days=USAGE_LOG_RETENTION_DAYS):
+        super().__init__()
+        self.directory = directory
+        self.retention_days = retention_days
+        self.day = None
+        self.stream = None
+
+    def emit(self, record):
+        try:
+            day = time.strftime("%Y-%m-%d", time.gmtime(record.created))
+            if day != self.day:
+                self._open(day)
+            self.stream.write(record.getMessage() + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def _open(self, day):
+        if self.stream is not None:
+            self.stream.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.stream = open(os.path.join(self.directory, f"{FILE_PREFIX}{day}.jsonl"), "a", encoding="utf-8")
+        self.day = day
+        self._housekeeping()
+
+    def _housekeeping(self):
+        now = time.time()
+        yesterday = time.strftime("%Y-%m-%d", time.gmtime(now - 86400))
+        oldest = time.strftime("%Y-%m-%d", time.gmtime(now - self.retention_days * 86400))
+        for name in os.listdir(self.directory):
+            if not name.startswith(FILE_PREFIX):
+                continue
+            day = name[len(FILE_PREFIX):len(FILE_PREFIX) + 10]
+            path = os.path.join(self.directory, name)
+            try:
+                if day < oldest:
+                    os.remove(path)
+                elif day < yesterday and name.endswith(".jsonl"):
+                    compress(path)
+            except OSError:
+                pass  # another process got there first
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        super().close()
+
+
+def compress(path):
+    """Replace a finished day's .jsonl with .jsonl.gz (atomic, safe to race with another process)."""
+    tmp_path = f"{path}.gz.{os.getpid()}.tmp"
+    with open(path, "rb") as source, gzip.open(tmp_path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.replace(tmp_path, f"{path}.gz")
+    os.remove(path)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records (and counts them) instead of blocking when the queue is full."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            count("usage_records_dropped")
+
+
+_logger = None
+_lock = threading.Lock()
+
+
+def _usage_logger():
+    """The "usage" logger, feeding a background thread that does all disk writes (started on first use)."""
+    global _logger
+    with _lock:
+        if _logger is None:
+            records = queue.Queue(USAGE_LOG_QUEUE_SIZE)
+            listener = logging.handlers.QueueListener(records, DailyFileHandler(USAGE_LOG_DIR))
+            listener.start()
+            atexit.register(listener.stop)  # writes what is still queued
+            logger = logging.getLogger("usage")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(DroppingQueueHandler(records))
+            _logger = logger
+        return _logger
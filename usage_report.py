@@ -0,0 +1,266 @@
+"""
+Usage analytics over the per-request usage log (see usage_log.py): outcomes, latency percentiles, throughput over
+time and where the upstream time (and money) goes.
+
+    python usage_report.py --since 2026-09-01 --interval day --price replicate=0.0014 --price hf=0
+
+Each finished day is reduced once to a small rollup (counts, sums and log-bucketed histograms, cached next to the
+log as usage-YYYY-MM-DD.rollup.json), so a report over months only parses the raw lines of today.
+"""
+import argparse
+import glob
+import gzip
+import json
+import math
+import os
+import time
+from collections import defaultdict
+
+from usage_log import FILE_PREFIX, USAGE_LOG_DIR
+
+#########################################################
+#AGREGADOS DIARIOS
+#########################################################
+
+ROLLUP_VERSION = 1
+# Histogram buckets are 5% wide, which bounds the error of every percentile in the report
+BUCKET_WIDTH = math.log(1.05)
+OUTCOMES = ("succeeded", "failed", "canceled", "error")
+# The stage that is billed by each upstream, with its per-second price given on the command line
+BILLED_STAGES = {"inference": "hf", "predict": "replicate", "swap": "storyface"}
+
+
+def bucket(seconds):
+    return str(math.floor(math.log(max(seconds, 0.001)) / BUCKET_WIDTH))
+
+
+def percentile(histogram, fraction):
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for index in sorted(histogram, key=int):
+        seen += histogram[index]
+        if seen >= fraction * total:
+            return math.exp((int(index) + 0.5) * BUCKET_WIDTH)
+
+
+def merge_histogram(target, source):
+    for index, n in source.items():
+        target[index] = target.get(index, 0) + n
+
+
+def empty_group():
+    return {"n": 0, "outcomes": {}, "coalesced": 0, "dur_sum": 0.0, "dur": {}, "stages": {}, "tx": 0, "rx": 0}
+
+
+def add_record(rollup, record):
+    group_key = "|".join(str(record.get(field)) for field in ("backend", "w", "h", "steps", "refine", "cands"))
+    group = rollup["groups"].setdefault(group_key, empty_group())
+    group["n"] += 1
+    outcome = record.get("outcome", "error")
+    group["outcomes"][outcome] = group["outcomes"].get(outcome, 0) + 1
+    group["coalesced"] += 1 if record.get("coalesced") else 0
+    group["dur_sum"] += record["dur"]
+    merge_histogram(group["dur"], {bucket(record["dur"]): 1})
+    for stage, seconds in record.get("stages", {}).items():
+        totals = group["stages"].setdefault(stage, {"sum": 0.0, "hist": {}})
+        totals["sum"] += seconds
+        merge_histogram(totals["hist"], {bucket(seconds): 1})
+    group["tx"] += record.get("tx", 0)
+    group["rx"] += record.get("rx", 0)
+
+    hour = rollup["hours"].setdefault(time.strftime("%Y-%m-%dT%H", time.gmtime(record["ts"])), {"n": 0, "ok": 0})
+    hour["n"] += 1
+    hour["ok"] += outcome == "succeeded"
+
+
+def merge_rollup(target, source):
+    for group_key, group in source["groups"].items():
+        merged = target["groups"].setdefault(group_key, empty_group())
+        for field in ("n", "coalesced", "dur_sum", "tx", "rx"):
+            merged[field] += group[field]
+        for outcome, n in group["outcomes"].items():
+            merged["outcomes"][outcome] = merged["outcomes"].get(outcome, 0) + n
+        merge_histogram(merged["dur"], group["dur"])
+        for stage, totals in group["stages"].items():
+            merged_stage = merged["stages"].setdefault(stage, {"sum": 0.0, "hist": {}})
+            merged_stage["sum"] += totals["sum"]
+            merge_histogram(merged_stage["hist"], totals["hist"])
+    for hour, totals in source["hours"].items():
+        merged = target["hours"].setdefault(hour, {"n": 0, "ok": 0})
+        merged["n"] += totals["n"]
+        merged["ok"] += totals["ok"]
+
+
+def read_day(path):
+    """Rollup of one day's log file (.jsonl, or .jsonl.gz once the day is over)."""
+    rollup = {"version": ROLLUP_VERSION, "groups": {}, "hours": {}}
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as lines:
+        for line in lines:
+            try:
+                add_record(rollup, json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                continue  # a line cut short by a crash
+    return rollup
+
+
+def day_rollup(day, path, today):
+    """Cached rollup for finished days, rebuilt when the log file is newer; today is always read live."""
+    cache_path = os.path.join(os.path.dirname(path), f"{FILE_PREFIX}{day}.rollup.json")
+    if day < today:
+        try:
+            if os.path.getmtime(cache_path) >= os.path.getmtime(path):
+                with open(cache_path, encoding="utf-8") as f:
+                    rollup = json.load(f)
+                if rollup.get("version") == ROLLUP_VERSION:
+                    return rollup
+        except (OSError, ValueError):
+            pass
+    rollup = read_day(path)
+    if day < today:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(rollup, f, separators=(",", ":"))
+        os.replace(tmp_path, cache_path)
+    return rollup
+
+
+def day_files(directory, since=None, until=None):
+    """{day: path} of the log files between `since` and `until` (YYYY-MM-DD, inclusive), picked by file name."""
+    files = {}
+    for path in sorted(glob.glob(os.path.join(directory, f"{FILE_PREFIX}*.jsonl*"))):
+        name = os.path.basename(path)
+        if not (name.endswith(".jsonl") or name.endswith(".jsonl.gz")):
+            continue
+        day = name[len(FILE_PREFIX):len(FILE_PREFIX) + 10]
+        if (since and day < since) or (until and day > until):
+            continue
+        if day not in files or path.endswith(".gz"):
+            files[day] = path  # mid-compression both exist with the same lines
+    return files
+
+
+def load(directory, since=None, until=None):
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+    rollup = {"version": ROLLUP_VERSION, "groups": {}, "hours": {}}
+    for day, path in sorted(day_files(directory, since, until).items()):
+        merge_rollup(rollup, day_rollup(day, path, today))
+    return rollup
+
+#########################################################
+#INFORME
+#########################################################
+
+def _seconds(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def _percentiles(histogram):
+    return "  ".join(f"{_seconds(percentile(histogram, fraction)):>7}" for fraction in (0.5, 0.9, 0.99))
+
+
+def report(rollup, interval="day", prices=None, top=15):
+    prices = prices or {}
+    groups = rollup["groups"]
+    total = sum(group["n"] for group in groups.values())
+    if not total:
+        print("No usage records in this range")
+        return
+    hours = sorted(rollup["hours"])
+    outcomes = defaultdict(int)
+    for group in groups.values():
+        for outcome, n in group["outcomes"].items():
+            outcomes[outcome] += n
+    coalesced = sum(group["coalesced"] for group in groups.values())
+    print(f"Usage {hours[0][:10]} .. {hours[-1][:10]}: {total} requests, {coalesced / total:.1%} joined an identical "
+          f"request in flight")
+    order = sorted(outcomes, key=lambda outcome: OUTCOMES.index(outcome) if outcome in OUTCOMES else len(OUTCOMES))
+    print("Outcomes: " + ", ".join(f"{outcome} {outcomes[outcome] / total:.1%}" for outcome in order))
+
+    # Latency percentiles per requested backend, then per stage
+    by_backend = defaultdict(lambda: {"n": 0, "dur": {}})
+    stages = defaultdict(dict)
+    for group_key, group in groups.items():
+        for name in ("all", group_key.split("|")[0]):
+            by_backend[name]["n"] += group["n"]
+            merge_histogram(by_backend[name]["dur"], group["dur"])
+        for stage, totals in group["stages"].items():
+            merge_histogram(stages[stage], totals["hist"])
+    print(f"\n{'Request duration (s)':<24}{'requests':>9}{'p50':>9}{'p90':>9}{'p99':>9}")
+    for name in sorted(by_backend, key=lambda name: (name != "all", name)):
+        print(f"{name:<24}{by_backend[name]['n']:>9}  {_percentiles(by_backend[name]['dur'])}")
+    print(f"\n{'Stage duration (s)':<24}{'runs':>9}{'p50':>9}{'p90':>9}{'p99':>9}")
+    for stage in sorted(stages, key=lambda stage: -sum(stages[stage].values())):
+        print(f"{stage:<24}{sum(stages[stage].values()):>9}  {_percentiles(stages[stage])}")
+
+    # Throughput over time
+    buckets = defaultdict(lambda: {"n": 0, "ok": 0})
+    for hour, totals in rollup["hours"].items():
+        key = hour if interval == "hour" else hour[:10]
+        buckets[key]["n"] += totals["n"]
+        buckets[key]["ok"] += totals["ok"]
+    busiest = max(totals["n"] for totals in buckets.values())
+    print(f"\nThroughput per {interval}")
+    for key in sorted(buckets):
+        totals = buckets[key]
+        bar = "#" * max(1, round(40 * totals["n"] / busiest))
+        print(f"{key:<16}{totals['n']:>8} requests {totals['ok'] / totals['n']:>7.1%} ok  {bar}")
+
+    # Upstream time is what the GPU providers bill for
+    billed = defaultdict(float)
+    for group in groups.values():
+        for stage, upstream in BILLED_STAGES.items():
+            billed[upstream] += group["stages"].get(stage, {}).get("sum", 0.0)
+    billed_total = sum(billed.values()) or 1.0
+    print(f"\n{'Upstream':<24}{'seconds':>12}{'share':>9}{'cost':>12}")
+    for upstream in sorted(billed, key=lambda upstream: -billed[upstream]):
+        cost = f"${billed[upstream] * prices[upstream]:.2f}" if upstream in prices else "-"
+        print(f"{upstream:<24}{billed[upstream]:>12.0f}{billed[upstream] / billed_total:>9.1%}{cost:>12}")
+
+    def group_cost(group):
+        return sum(group["stages"].get(stage, {}).get("sum", 0.0) * prices.get(upstream, 0.0)
+                   for stage, upstream in BILLED_STAGES.items())
+
+    def group_seconds(group):
+        return sum(group["stages"].get(stage, {}).get("sum", 0.0) for stage in BILLED_STAGES)
+
+    print(f"\n{'Request type':<40}{'requests':>9}{'mean s':>8}{'upstream s':>12}{'cost':>10}{'MB out':>9}{'MB in':>9}")
+    for group_key in sorted(groups, key=lambda key: -group_seconds(groups[key]))[:top]:
+        group = groups[group_key]
+        backend, width, height, steps, refine, candidates = group_key.split("|")
+        label = f"{backend} {width}x{height} {steps} steps r{refine} x{candidates}"
+        cost = f"${group_cost(group):.2f}" if prices else "-"
+        print(f"{label:<40}{group['n']:>9}{group['dur_sum'] / group['n']:>8.1f}{group_seconds(group):>12.0f}"
+              f"{cost:>10}{group['tx'] / 1e6:>9.1f}{group['rx'] / 1e6:>9.1f}")
+    if len(groups) > top:
+        print(f"... {len(groups) - top} more request types (--top)")
+
+
+def parse_price(value):
+    upstream, _, price = value.partition("=")
+    if upstream not in BILLED_STAGES.values():
+        raise argparse.ArgumentTypeError(f"unknown upstream {upstream!r} (one of {', '.join(BILLED_STAGES.values())})")
+    return upstream, float(price)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on the usage log (see usage_log.py)")
+    parser.add_argument("--dir", default=USAGE_LOG_DIR, help="Usage log directory (default: USAGE_LOG_DIR)")
+    parser.add_argument("--since", help="First day, YYYY-MM-DD (UTC)")
+    parser.add_argument("--until", help="Last day, YYYY-MM-DD (UTC)")
+    parser.add_argument("--interval", choices=("day", "hour"), default="day", help="Throughput bucket size")
+    parser.add_argument("--price", type=parse_price, action="append", default=[],
+                        help="Upstream price per billed second, e.g. replicate=0.0014 (repeatable)")
+    parser.add_argument("--top", type=int, default=15, help="Request types listed in the cost breakdown")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    rollup = load(args.dir, args.since, args.until)
+    report(rollup, args.interval, dict(args.price), args.top)
+    print(f"\n({time.perf_counter() - start_time:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
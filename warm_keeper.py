@@ -0,0 +1,337 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urljoin
+
+import httpx
+
+from http_clients import upstream_timeout
+from metrics import count, observe
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#ARRANQUES EN FRIO: SONDEOS, DETECCION Y PRECALENTAMIENTO
+#########################################################
+
+WARM_KEEPER_ENABLED = os.getenv("WARM_KEEPER_ENABLED", "1") != "0"
+# Upstreams that go to sleep when idle and are worth keeping warm
+WARM_BACKENDS = [name.strip() for name in os.getenv("WARM_BACKENDS", "hf,storyface").split(",") if name.strip()]
+# Seconds between health probes while traffic is expected; a real call counts as a probe
+WARM_PROBE_INTERVAL = float(os.getenv("WARM_PROBE_INTERVAL", "60"))
+# Backends are kept warm this long after the last request or pre-warm, then left to sleep; 0 keeps them warm for good
+WARM_KEEP_ALIVE = float(os.getenv("WARM_KEEP_ALIVE", "1800"))
+# A probe waking a sleeping Space can take minutes
+WARM_PROBE_TIMEOUT = float(os.getenv("WARM_PROBE_TIMEOUT", "300"))
+# Seconds without any contact after which a backend is assumed to have gone back to sleep
+WARM_IDLE_TIMEOUT = float(os.getenv("WARM_IDLE_TIMEOUT", "600"))
+# A call this many times slower than predicted (or a probe slower than its usual answer and WARM_COLD_PROBE_SECONDS)
+# after the backend sat idle is counted as a cold start
+WARM_COLD_START_FACTOR = float(os.getenv("WARM_COLD_START_FACTOR", "3"))
+WARM_COLD_PROBE_SECONDS = float(os.getenv("WARM_COLD_PROBE_SECONDS", "2"))
+# Extra seconds a cold backend is expected to need until a cold start has been measured
+WARM_COLD_START_PENALTY = float(os.getenv("WARM_COLD_START_PENALTY", "60"))
+# Consecutive failed probes that mark a backend as down
+WARM_DOWN_AFTER = int(os.getenv("WARM_DOWN_AFTER", "3"))
+# Probe results the queue worker supervisor shares with its worker processes, which do not probe themselves
+WARM_STATE_FILE = os.getenv("WARM_STATE_FILE", os.path.join(".cache", "warm_state.json"))
+# Seconds between reads of WARM_STATE_FILE in a worker process
+WARM_STATE_POLL = float(os.getenv("WARM_STATE_POLL", "5"))
+
+UNKNOWN, WARM, COLD, DOWN = "unknown", "warm", "cold", "down"
+
+
+def probe_url(name):
+    """Cheap endpoint that answers once the upstream is up: the Space's Gradio config, StoryFace's /health."""
+    if name == "hf":
+        default = f"{os.getenv('HF_SPACE_URL', 'https://yanze-pulid-flux.hf.space')}/config"
+    elif name == "storyface":
+        default = urljoin(os.getenv("URL", ""), "health") if os.getenv("URL") else None
+    else:
+        default = None
+    return os.getenv(f"WARM_{name.upper()}_PROBE_URL", default)
+
+
+class BackendHealth:
+    """
+    What is known about one upstream's warmth: the last probe, recent warm probe latencies (the baseline a cold
+    start is measured against), the measured cold start cost and when it was last used or expected to be.
+    """
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.state = UNKNOWN
+        self.failures = 0
+        self.last_contact = None
+        self.last_probe_at = None
+        self.last_probe_seconds = None
+        self.probe_latencies = deque(maxlen=20)
+        self.cold_start_seconds = None
+        self.expected_until = time.monotonic() + WARM_KEEP_ALIVE  # traffic is expected right after a start
+        self.probe_now = False
+        self.wake = threading.Event()
+
+    @property
+    def idle_seconds(self):
+        return None if self.last_contact is None else time.monotonic() - self.last_contact
+
+    @property
+    def likely_cold(self):
+        if self.state != WARM:
+            return True
+        return self.idle_seconds is not None and self.idle_seconds > WARM_IDLE_TIMEOUT
+
+    @property
+    def is_down(self):
+        return self.state == DOWN
+
+    def penalty(self):
+        """Seconds a call made now is expected to lose to a cold start."""
+        if not self.likely_cold:
+            return 0.0
+        return WARM_COLD_START_PENALTY if self.cold_start_seconds is None else self.cold_start_seconds
+
+    def _cold_start(self, extra, source):
+        count("cold_starts", backend=self.name, source=source)
+        logger.warning(f"{self.name} cold start detected from a {source}, about {extra:.0f}s lost")
+        # Moving average, so one unusually slow wake does not dominate
+        self.cold_start_seconds = extra if self.cold_start_seconds is None else \
+            0.7 * self.cold_start_seconds + 0.3 * extra
+
+    def record_probe(self, seconds, ok):
+        observe("health_probe", self.name, seconds)
+        self.last_probe_at = time.monotonic()
+        self.last_probe_seconds = seconds
+        count("health_probes", backend=self.name, result="ok" if ok else "failed")
+        if not ok:
+            self.failures += 1
+            if self.failures >= WARM_DOWN_AFTER and self.state != DOWN:
+                logger.warning(f"{self.name} failed {self.failures} health probes in a row, marking it down")
+                self.state = DOWN
+            return
+        baseline = sorted(self.probe_latencies)[len(self.probe_latencies) // 2] if self.probe_latencies else 0.0
+        if self.likely_cold and seconds > max(WARM_COLD_START_FACTOR * baseline, WARM_COLD_PROBE_SECONDS):
+            self._cold_start(seconds - baseline, "probe")
+        else:
+            self.probe_latencies.append(seconds)
+        if self.state != WARM:
+            logger.info(f"{self.name} is warm (health probe answered in {seconds:.1f}s)")
+        self.failures = 0
+        self.state = WARM
+        self.last_contact = time.monotonic()
+
+    def record_call(self, seconds, expected):
+        """
+        Report a successful real call that took `seconds` against `expected` (the latency model's prediction).
+        Returns True if it was a cold start, which tells nothing about the backend's usual speed.
+        """
+        cold = self.likely_cold and expected > 0 and seconds > WARM_COLD_START_FACTOR * expected
+        if cold:
+            self._cold_start(seconds - expected, "call")
+        self.failures = 0
+        self.state = WARM
+        self.last_contact = time.monotonic()
+        self.expect_traffic()
+        return cold
+
+    def expect_traffic(self):
+        self.expected_until = max(self.expected_until, time.monotonic() + WARM_KEEP_ALIVE)
+        self.wake.set()  # the probe loop may be waiting for traffic
+
+    def next_probe_in(self):
+        """Seconds until the next probe is due, or None while no traffic is expected."""
+        if self.probe_now:
+            return 0.0
+        if WARM_KEEP_ALIVE and time.monotonic() > self.expected_until:
+            return None
+        last = max((at for at in (self.last_contact, self.last_probe_at) if at is not None), default=None)
+        if last is None:
+            return 0.0
+        return max(0.0, last + WARM_PROBE_INTERVAL - time.monotonic())
+
+    def shared(self):
+        """Probe results for WARM_STATE_FILE, with wall clock times so other processes can read them."""
+        offset = time.time() - time.monotonic()
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "last_contact": None if self.last_contact is None else self.last_contact + offset,
+            "probed_at": None if self.last_probe_at is None else self.last_probe_at + offset,
+            "last_probe_seconds": self.last_probe_seconds,
+            "cold_start_seconds": self.cold_start_seconds,
+        }
+
+    def apply(self, shared):
+        """Take over probe results another process published (see shared), unless they are too old to tell."""
+        offset = time.time() - time.monotonic()
+        if shared.get("probed_at") is None or time.time() - shared["probed_at"] > WARM_IDLE_TIMEOUT:
+            return
+        self.state = shared["state"]
+        self.failures = shared["failures"]
+        self.last_probe_at = shared["probed_at"] - offset
+        self.last_probe_seconds = shared["last_probe_seconds"]
+        if shared["last_contact"] is not None:
+            self.last_contact = max(self.last_contact or 0.0, shared["last_contact"] - offset)
+        if shared["cold_start_seconds"] is not None:
+            self.cold_start_seconds = shared["cold_start_seconds"]
+
+    def status(self):
+        return {
+            "state": COLD if self.state == WARM and self.likely_cold else self.state,
+            "idle_seconds": None if self.idle_seconds is None else round(self.idle_seconds, 1),
+            "last_probe_seconds": self.last_probe_seconds,
+            "cold_start_seconds": self.cold_start_seconds,
+            "kept_warm": self.next_probe_in() is not None,
+        }
+
+
+_health = {}
+_lock = threading.Lock()
+_started = False
+
+
+def get_health(name):
+    """Health of `name`, or None for upstreams that are not kept warm (or have no probe URL)."""
+    if name not in WARM_BACKENDS:
+        return None
+    with _lock:
+        health = _health.get(name)
+        if health is None:
+            url = probe_url(name)
+            if not url:
+                return None
+            health = _health[name] = BackendHealth(name, url)
+        return health
+
+
+def record_call(name, seconds, expected):
+    """See BackendHealth.record_call; False for upstreams without health tracking."""
+    health = get_health(name)
+    return health.record_call(seconds, expected) if health is not None else False
+
+
+def cold_penalty(name):
+    """Extra seconds to allow for a call to `name` right now because it has probably gone to sleep."""
+    health = get_health(name)
+    return health.penalty() if health is not None else 0.0
+
+
+def is_down(name):
+    health = get_health(name)
+    return health is not None and health.is_down
+
+
+def upstreams(backend):
+    """Kept-warm upstreams a job on `backend` will call: its generator (any routed one for "auto") and StoryFace."""
+    names = WARM_BACKENDS if backend == "auto" else [backend, "storyface"]
+    return [name for name in names if name in WARM_BACKENDS]
+
+
+def prewarm(backend):
+    """
+    Traffic for `backend` is coming (a face was uploaded, a job admitted): keep its upstreams warm for
+    WARM_KEEP_ALIVE seconds and probe the ones that are probably asleep right away, so they wake up now
+    rather than inside the request. Never blocks.
+    """
+    for name in upstreams(backend):
+        health = get_health(name)
+        if health is None:
+            continue
+        if health.likely_cold and WARM_KEEPER_ENABLED and not health.probe_now:
+            count("prewarms", backend=name)
+            health.probe_now = True
+        health.expect_traffic()
+
+
+def status():
+    return {name: health.status() for name, health in list(_health.items())}
+
+
+def _publish():
+    """Write every upstream's probe results to WARM_STATE_FILE for the worker processes (see follow)."""
+    with _lock:
+        state = {name: health.shared() for name, health in _health.items()}
+        try:
+            os.makedirs(os.path.dirname(WARM_STATE_FILE) or ".", exist_ok=True)
+            tmp_path = f"{WARM_STATE_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, WARM_STATE_FILE)
+        except OSError as e:
+            logger.warning(f"Could not share the health probe results: {e}")
+
+
+def _keep_warm(health, share=False):
+    client = httpx.Client(timeout=upstream_timeout(WARM_PROBE_TIMEOUT), follow_redirects=True)
+    while True:
+        delay = health.next_probe_in()
+        if delay is None or delay > 0:
+            # Sleeps until the probe is due, or for good while no traffic is expected; new traffic wakes it
+            health.wake.wait(delay)
+            health.wake.clear()
+            continue
+        health.probe_now = False
+        start_time = time.monotonic()
+        try:
+            ok = client.get(health.url).status_code < 500
+        except httpx.HTTPError as e:
+            logger.warning(f"Health probe of {health.name} failed: {type(e).__name__}")
+            ok = False
+        health.record_probe(time.monotonic() - start_time, ok)
+        if share:
+            _publish()
+
+
+def start(share=False):
+    """
+    Probe every kept-warm upstream from its own daemon thread (idempotent). With `share`, each probe result is
+    also written to WARM_STATE_FILE for processes that only follow() it. WARM_KEEPER_ENABLED=0 disables.
+    """
+    global _started
+    with _lock:
+        if _started or not WARM_KEEPER_ENABLED:
+            return
+        _started = True
+    for name in WARM_BACKENDS:
+        health = get_health(name)
+        if health is None:
+            logger.info(f"No health probe URL for {name}, not keeping it warm")
+            continue
+        threading.Thread(target=_keep_warm, args=(health, share), name=f"warm-{name}", daemon=True).start()
+    logger.info(f"Keeping {', '.join(_health) or 'nothing'} warm: probes every {WARM_PROBE_INTERVAL:.0f}s "
+                f"for {WARM_KEEP_ALIVE:.0f}s after the last request")
+
+
+def _follow():
+    modified = None
+    while True:
+        try:
+            mtime = os.path.getmtime(WARM_STATE_FILE)
+            if mtime != modified:
+                with open(WARM_STATE_FILE, encoding="utf-8") as f:
+                    state = json.load(f)
+                modified = mtime
+                for name, shared in state.items():
+                    health = get_health(name)
+                    if health is not None:
+                        health.apply(shared)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # not written yet, or being replaced
+        time.sleep(WARM_STATE_POLL)
+
+
+def follow():
+    """
+    Take the probe results another process publishes (start(share=True)) instead of probing, from a daemon
+    thread (idempotent). Used by queue workers, whose supervisor probes for all of them.
+    """
+    global _started
+    with _lock:
+        if _started or not WARM_KEEPER_ENABLED:
+            return
+        _started = True
+    threading.Thread(target=_follow, name="warm-follow", daemon=True).start()
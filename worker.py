@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from dotenv import load_dotenv
+from PIL import Image
+
+import backends
+import job_queue
+import metrics
+import output_store
+import pipeline
+import warm_keeper
+from http_clients import close_clients
+from scheduler import priority, scheduler
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+#########################################################
+#TRABAJADORES DE LA COLA DE TRABAJOS (UN PROCESO POR NUCLEO)
+#########################################################
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "0")) or os.cpu_count() or 1
+# Jobs each worker process runs at once; they mostly wait on upstreams, so a process handles several
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+# On SIGTERM running jobs get this long to finish before they are put back in the queue for the next start
+JOB_SHUTDOWN_GRACE = float(os.getenv("JOB_SHUTDOWN_GRACE", "10"))
+# The supervisor serves its /metrics (health probes) on this port and worker N on this port + 1 + N; 0 disables.
+# The app itself uses METRICS_PORT
+JOB_WORKER_METRICS_PORT = int(os.getenv("JOB_WORKER_METRICS_PORT", str(metrics.METRICS_PORT + 1 if metrics.METRICS_PORT
+                                                                       else 0)))
+
+
+def load_face(data):
+    with Image.open(io.BytesIO(data)) as image:
+        return image.convert("RGB")
+
+
+async def run_job(job, worker_id):
+    """Run one claimed job through the pipeline, reporting every stage to the queue as it lands."""
+    metrics.trace_id.set(job["trace_id"] or job["id"][:12])  # same trace id as the UI request that queued it
+    request = job["request"]
+    face_refinement_steps = request["face_refinement_steps"]
+    num_candidates = request["num_candidates"]
+    start_time = time.monotonic()
+    result = {"candidates": {}}
+    finals = {}
+    state = {"result": None, "message": None}
+
+    async def keep_lease(task):
+        # Renews the lease and saves the latest progress; stops the job when it is canceled or taken over
+        while not task.done():
+            outcome = await asyncio.to_thread(job_queue.heartbeat, job["id"], worker_id, state["result"],
+                                              state["message"])
+            if outcome != "ok":
+                logger.info(f"Job {job['id']} {'canceled' if outcome == 'cancel' else 'taken over'}, stopping it")
+                state["stopped"] = outcome
+                task.cancel()
+                return
+            await asyncio.sleep(job_queue.JOB_LEASE_SECONDS / 3)
+
+    async def work():
+        face_image = await asyncio.to_thread(load_face, job["face"])
+        plan = backends.estimate(request["backend"], request["params"], face_refinement_steps)
+        async for index, stage, image in pipeline.process_stream(
+            face_image, request["params"], request["quality"], face_refinement_steps, num_candidates,
+            request["backend"], request["strategy"], adaptive=request["adaptive"],
+        ):
+            stored = await output_store.put_async(image)
+            finals[index] = image
+            candidate = result["candidates"].setdefault(str(index), {"generated": None, "refined": None})
+            candidate["generated" if stage == "generation" else "refined"] = stored.path
+            status = pipeline.describe_stage(stage, face_refinement_steps)
+            if num_candidates > 1:
+                status = f"Candidate {index + 1}: {status}"
+            remaining = plan.remaining(stage)
+            if remaining >= 1:
+                status += f", about {remaining:.0f}s left"
+            # Saved right away so the UI shows each stage as soon as it lands
+            state["result"], state["message"] = result, status
+            outcome = await asyncio.to_thread(job_queue.heartbeat, job["id"], worker_id, result, status)
+            if outcome != "ok":
+                state["stopped"] = outcome
+                return
+        if finals and request.get("user"):
+            generated = {int(index): candidate["generated"] for index, candidate in result["candidates"].items()}
+            outputs = await pipeline.store_finals(finals, generated, request["backend"])
+            await pipeline.remember(request["user"], outputs, request["params"], request["backend"])
+
+    task = asyncio.create_task(work())
+    lease = asyncio.create_task(keep_lease(task))
+    error = None
+    try:
+        await task
+    except asyncio.CancelledError:
+        if "stopped" not in state:
+            raise  # the worker is shutting down
+    except Exception as e:
+        logger.error(f"Job {job['id']} failed: {e}")
+        error = str(e)
+    finally:
+        lease.cancel()
+
+    stopped = state.get("stopped")
+    if stopped == "lost":
+        return
+    if stopped == "cancel":
+        status, message = "canceled", "Canceled"
+    elif error or not result["candidates"]:
+        status, message = "failed", "Generation failed"
+    else:
+        status, message = "succeeded", f"Done in {time.monotonic() - start_time:.1f}s"
+    await asyncio.to_thread(job_queue.finish, job["id"], worker_id, status, result, message, error)
+    logger.info(f"Job {job['id']} {status} in {time.monotonic() - start_time:.1f}s (attempt {job['attempts']})")
+
+
+async def run_worker(concurrency=JOB_WORKER_CONCURRENCY, stop=None):
+    """Claim and run up to `concurrency` jobs at a time until `stop` is set, then hand unfinished jobs back."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop = stop or asyncio.Event()
+    stopped = asyncio.create_task(stop.wait())
+    running = {}
+    logger.info(f"Worker {worker_id} started, {concurrency} jobs at a time")
+    try:
+        while not stop.is_set():
+            if len(running) >= concurrency:
+                await asyncio.wait([*running, stopped], return_when=asyncio.FIRST_COMPLETED)
+                continue
+            job = await asyncio.to_thread(job_queue.claim, worker_id)
+            if job is None:
+                await asyncio.wait([stopped], timeout=job_queue.JOB_POLL_INTERVAL)
+                continue
+            with priority(job["priority"]):
+                task = asyncio.create_task(run_job(job, worker_id))
+            running[task] = job["id"]
+            task.add_done_callback(lambda task: running.pop(task, None))
+    finally:
+        stopped.cancel()
+        if running:
+            logger.info(f"Worker {worker_id} stopping, waiting up to {JOB_SHUTDOWN_GRACE:.0f}s "
+                        f"for {len(running)} jobs")
+            await asyncio.wait(list(running), timeout=JOB_SHUTDOWN_GRACE)
+        for task, job_id in list(running.items()):
+            task.cancel()
+            await asyncio.to_thread(job_queue.release, job_id, worker_id)
+            logger.info(f"Job {job_id} put back in the queue")
+        await close_clients()
+
+
+def serve_metrics(offset):
+    if not JOB_WORKER_METRICS_PORT:
+        return
+    try:
+        metrics.start_metrics_server(JOB_WORKER_METRICS_PORT + offset)
+    except OSError as e:
+        logger.warning(f"Could not serve metrics on port {JOB_WORKER_METRICS_PORT + offset}: {e}")
+
+
+def worker_process(concurrency, slot=0, workers=1):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s [%(trace_id)s] %(message)s')
+    metrics.install_trace_logging()
+    warm_keeper.follow()
+    # The upstream caps are totals for the whole pool, not per process
+    scheduler.split(slot, workers)
+    serve_metrics(1 + slot)
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await run_worker(concurrency, stop)
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued generation jobs (see job_queue.py)")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS, help="Worker processes (default: one per core)")
+    parser.add_argument("--concurrency", type=int, default=JOB_WORKER_CONCURRENCY,
+                        help="Jobs each worker process runs at once")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s %(message)s')
+    removed = job_queue.prune()
+    if removed:
+        logger.info(f"Pruned {removed} finished jobs")
+
+    if os.getenv("REPLICATE_WEBHOOKS") == "1":
+        # Only one process could hold the receiver's port and get the webhooks; the workers poll instead
+        logger.warning("REPLICATE_WEBHOOKS=1 is not supported by queue workers, they poll Replicate predictions")
+        os.environ["REPLICATE_WEBHOOKS"] = "0"  # inherited by the spawned workers
+
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    stopping = False
+
+    def start(slot):
+        process = context.Process(target=worker_process, args=(args.concurrency, slot, args.workers),
+                                  name=f"worker-{slot}")
+        process.start()
+        processes[slot] = process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for slot in range(args.workers):
+        start(slot)
+    logger.info(f"Started {args.workers} workers, {args.concurrency} jobs each, queue {job_queue.JOB_QUEUE_DB}")
+    # One set of health probes for all workers; waiting jobs keep the upstreams warm
+    warm_keeper.start(share=True)
+    serve_metrics(0)
+
+    # Replace crashed workers; the jobs they held are picked up again once their lease expires
+    while not stopping:
+        time.sleep(1)
+        if warm_keeper.WARM_KEEPER_ENABLED and job_queue.pending():
+            warm_keeper.prewarm("auto")
+        for slot, process in list(processes.items()):
+            if process.exitcode is not None and not stopping:
+                logger.warning(f"{process.name} exited with code {process.exitcode}, restarting it")
+                start(slot)
+
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()  # SIGTERM: the worker hands its unfinished jobs back
+    for process in processes.values():
+        process.join(JOB_SHUTDOWN_GRACE + 10)
+        if process.is_alive():
+            process.kill()
+
+
+if __name__ == "__main__":
+    main()